@@ -110,9 +110,13 @@ class HKUCampusDatasetCreator:
         })
         return conversations
     
-    def create_dataset(self):
+    def create_dataset(self, consolidate_max_tokens=None):
         """
         创建完整的数据集
+        
+        Args:
+            consolidate_max_tokens: 设置后，将同一张图片的单轮问答合并为不超过该文本token数的多轮对话，
+                图片只需经过一次视觉编码器（见 src/dataset/consolidate_qa.py）
         """
         dataset = []
         sample_id = 0
@@ -148,6 +152,13 @@ class HKUCampusDatasetCreator:
         # 添加多轮对话示例
         dataset.extend(self.create_multi_turn_examples())
         
+        # 合并同一张图片的问答
+        if consolidate_max_tokens is not None:
+            from src.dataset.consolidate_qa import consolidate_samples
+            num_samples = len(dataset)
+            dataset = consolidate_samples(dataset, max_text_tokens=consolidate_max_tokens)
+            print(f"合并问答: {num_samples} 个样本 -> {len(dataset)} 个样本")
+        
         # 随机打乱数据
         random.shuffle(dataset)
         
@@ -3,10 +3,11 @@ import json
 from PIL import Image
 from pathlib import Path
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 class ImagePreprocessor:
-    def __init__(self, source_dir, output_dir, target_size=(1920, 1080)):
+    def __init__(self, source_dir, output_dir, target_size=(1920, 1080), dedup_threshold=None, num_workers=8):
         """
         初始化图片预处理器
         
@@ -14,11 +15,15 @@ class ImagePreprocessor:
             source_dir: 原始图片目录（包含按建筑名分类的子文件夹）
             output_dir: 输出目录
             target_size: 目标尺寸 (width, height)
+            dedup_threshold: 近似重复图片的感知哈希汉明距离阈值（64位中，建议 4-8），None 表示不去重
+            num_workers: 计算感知哈希的线程数
         """
         self.source_dir = Path(source_dir)
         self.output_dir = Path(output_dir)
         self.images_dir = self.output_dir / "images"
         self.target_size = target_size
+        self.dedup_threshold = dedup_threshold
+        self.num_workers = num_workers
         
         # 创建输出目录
         self.images_dir.mkdir(parents=True, exist_ok=True)
@@ -68,6 +73,112 @@ class ImagePreprocessor:
             print(f"处理图片 {image_path} 时出错: {e}")
             return False
     
+    @staticmethod
+    def compute_dhash(image_path):
+        """
+        计算图片的感知哈希（64位 dHash）和原始像素数
+        """
+        try:
+            with Image.open(image_path) as img:
+                num_pixels = img.width * img.height
+                # JPEG 直接以降低的分辨率解码，哈希只需要很小的图
+                img.draft("L", (64, 64))
+                small = img.convert("L").resize((9, 8), Image.Resampling.BILINEAR)
+            pixels = small.tobytes()
+            hash_value = 0
+            for row in range(8):
+                for col in range(8):
+                    hash_value = (hash_value << 1) | int(pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+            return hash_value, num_pixels
+        except Exception as e:
+            print(f"计算图片 {image_path} 的哈希时出错: {e}")
+            return None
+    
+    @staticmethod
+    def can_load(image_path):
+        """
+        检查图片能否完整解码（计算哈希时只解码了缩小的草图）
+        """
+        try:
+            with Image.open(image_path) as img:
+                img.load()
+            return True
+        except Exception as e:
+            print(f"读取图片 {image_path} 时出错: {e}")
+            return False
+    
+    @staticmethod
+    def find_duplicate_clusters(hashes, threshold, can_represent=None):
+        """
+        按顺序把每个哈希归入汉明距离不超过 threshold 的最近代表，返回每个哈希所属代表的索引
+        
+        每个哈希都和簇的代表比较，而不是和簇中任意成员比较，所以 A~B、B~C 不会把差得更远的 C 也去掉。
+        没有匹配到代表的哈希自己成为新的代表，但只有 can_represent(i) 为真时才可以；
+        否则它的索引为 None，也不会吸收后面的哈希。
+        
+        把 64 位哈希切成 threshold + 1 段：距离不超过 threshold 的两个哈希至少有一段完全相同，
+        所以只需比较同一段值相同的代表，而不是所有图片两两比较。
+        """
+        num_chunks = min(threshold + 1, 64)
+        bounds = [64 * i // num_chunks for i in range(num_chunks + 1)]
+        masks = [(1 << (bounds[chunk + 1] - bounds[chunk])) - 1 for chunk in range(num_chunks)]
+        # 每一段的值 -> 该段取这个值的代表
+        buckets = [{} for _ in range(num_chunks)]
+        
+        roots = []
+        for i, hash_value in enumerate(hashes):
+            chunks = [(hash_value >> bounds[chunk]) & masks[chunk] for chunk in range(num_chunks)]
+            candidates = {rep for chunk, value in enumerate(chunks) for rep in buckets[chunk].get(value, [])}
+            distances = [(bin(hash_value ^ hashes[rep]).count("1"), rep) for rep in candidates]
+            matches = [match for match in distances if match[0] <= threshold]
+            if matches:
+                roots.append(min(matches)[1])
+            elif can_represent is None or can_represent(i):
+                for chunk, value in enumerate(chunks):
+                    buckets[chunk].setdefault(value, []).append(i)
+                roots.append(i)
+            else:
+                roots.append(None)
+        
+        return roots
+    
+    def deduplicate_images(self, image_files):
+        """
+        去除近似重复的图片（连拍、几乎相同的画面），每个簇保留分辨率最高、能正常读取的一张
+        
+        Returns:
+            kept: 保留的图片路径列表
+            duplicates: 保留的图片路径 -> 被去掉的重复图片路径列表
+        """
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            results = list(tqdm(executor.map(self.compute_dhash, image_files), total=len(image_files), desc="计算感知哈希"))
+        
+        # 无法读取的图片不参与去重，交给后面的处理步骤报错
+        hashed = [(path, result) for path, result in zip(image_files, results) if result is not None]
+        unhashed = [path for path, result in zip(image_files, results) if result is None]
+        # 分辨率高的图片先成为代表
+        hashed.sort(key=lambda member: (-member[1][1], member[0].name))
+        roots = self.find_duplicate_clusters(
+            [result[0] for _, result in hashed],
+            self.dedup_threshold,
+            can_represent=lambda i: self.can_load(hashed[i][0]),
+        )
+        
+        kept = list(unhashed)
+        duplicates = {}
+        for i, ((path, _), root) in enumerate(zip(hashed, roots)):
+            if root is None:
+                # 不能完整读取，也不和任何代表重复，交给后面的处理步骤报错
+                kept.append(path)
+            elif root == i:
+                kept.append(path)
+                duplicates[path] = []
+            else:
+                duplicates[hashed[root][0]].append(path)
+        # 保持原来的文件顺序，图片编号不受去重影响
+        kept = set(kept)
+        return [path for path in image_files if path in kept], duplicates
+    
     def process_all_images(self):
         """
         处理所有图片
@@ -89,6 +200,13 @@ class ImagePreprocessor:
             image_files = list(building_dir.glob("*.jpg")) + list(building_dir.glob("*.JPG")) + \
                          list(building_dir.glob("*.png")) + list(building_dir.glob("*.PNG"))
             
+            # 去除近似重复的图片
+            duplicates = {}
+            if self.dedup_threshold is not None:
+                num_images = len(image_files)
+                image_files, duplicates = self.deduplicate_images(image_files)
+                print(f"去重: {num_images} 张图片 -> {len(image_files)} 张")
+            
             for img_path in tqdm(image_files, desc=f"处理 {building_name} 的图片"):
                 # 生成新的文件名
                 new_filename = f"hku_{building_name}_{image_counter:06d}.jpg"
@@ -103,6 +221,11 @@ class ImagePreprocessor:
                         "original_path": str(img_path),
                         "processed_path": str(output_path)
                     })
+                    # 记录被去掉的近似重复图片
+                    if duplicates.get(img_path):
+                        building_images[-1]["duplicates"] = [
+                            {"original_name": path.name, "original_path": str(path)} for path in duplicates[img_path]
+                        ]
                     image_counter += 1
             
             # 保存该建筑的图片信息
@@ -128,7 +251,8 @@ if __name__ == "__main__":
     preprocessor = ImagePreprocessor(
         source_dir=source_directory,
         output_dir=output_directory,
-        target_size=(1920, 1080)  # 可以根据需要调整
+        target_size=(1920, 1080),  # 可以根据需要调整
+        dedup_threshold=None  # 设为 4-8 之间的值（如 6）可去除近似重复的图片，None 表示不去重
     )
     
     # 处理所有图片
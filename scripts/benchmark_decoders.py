@@ -0,0 +1,76 @@
+import argparse
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from src.dataset.data_utils import IMAGE_DECODERS, decode_image
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp")
+
+
+def list_images(image_dir, num_images):
+    paths = []
+    for root, _, files in os.walk(image_dir):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)[:num_images]
+
+
+def load_resized(path, decoder, min_pixels, max_pixels):
+    """Decodes and resizes an image like `get_image_info` does."""
+    image, size = decode_image(path, min_pixels, max_pixels, decoder=decoder)
+    return image.convert("RGB").resize(size, Image.Resampling.BICUBIC)
+
+
+def benchmark(paths, decoder, min_pixels, max_pixels, reference=None):
+    decode_seconds = 0.0
+    diffs = []
+    for i, path in enumerate(paths):
+        start = time.perf_counter()
+        image = load_resized(path, decoder, min_pixels, max_pixels)
+        decode_seconds += time.perf_counter() - start
+        if reference is not None:
+            diffs.append(np.abs(np.asarray(image, dtype=np.float32) - reference[i]).mean())
+    return {
+        "images_per_second": len(paths) / decode_seconds,
+        "ms_per_image": 1000 * decode_seconds / len(paths),
+        # Mean absolute pixel difference (0-255) to the full resolution decode.
+        "mean_abs_diff": float(np.mean(diffs)) if diffs else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the throughput of the image decoders on a directory of images.")
+    parser.add_argument("--image_dir", type=str, required=True, help="Directory of sample images (searched recursively).")
+    parser.add_argument("--num_images", type=int, default=200, help="Number of images to decode.")
+    parser.add_argument("--decoders", type=str, default=",".join(IMAGE_DECODERS), help="Comma-separated decoders to compare.")
+    parser.add_argument("--min_pixels", type=int, default=256 * 28 * 28)
+    parser.add_argument("--max_pixels", type=int, default=1280 * 28 * 28)
+    args = parser.parse_args()
+
+    paths = list_images(args.image_dir, args.num_images)
+    if not paths:
+        raise ValueError(f"No images found in {args.image_dir}.")
+
+    # Warm up the page cache, so the first decoder doesn't pay for the disk reads.
+    for path in paths:
+        with open(path, "rb") as f:
+            f.read()
+    reference = [np.asarray(load_resized(path, "pil", args.min_pixels, args.max_pixels), dtype=np.float32) for path in paths]
+
+    print(f"{len(paths)} images, max_pixels={args.max_pixels}")
+    print(f"{'decoder':<12}{'images/s':>12}{'ms/image':>12}{'mean abs diff':>16}")
+    for decoder in args.decoders.split(","):
+        try:
+            result = benchmark(paths, decoder, args.min_pixels, args.max_pixels, reference=reference)
+        except ImportError as e:
+            print(f"{decoder:<12}skipped: {e}")
+            continue
+        print(f"{decoder:<12}{result['images_per_second']:>12.1f}{result['ms_per_image']:>12.2f}{result['mean_abs_diff']:>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
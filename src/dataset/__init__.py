@@ -1,9 +1,17 @@
-from .dpo_dataset import make_dpo_data_module
-from .sft_dataset import make_supervised_data_module
-from .grpo_dataset import make_grpo_data_module
-
-__all__ =[
-    "make_dpo_data_module",
-    "make_supervised_data_module",
-    "make_grpo_data_module"
-]
\ No newline at end of file
+import importlib
+
+# The data modules are imported on first use, so a single module (e.g. the samplers) can be imported
+# without the dependencies of the whole data pipeline.
+_DATA_MODULES = {
+    "make_dpo_data_module": ".dpo_dataset",
+    "make_supervised_data_module": ".sft_dataset",
+    "make_grpo_data_module": ".grpo_dataset",
+}
+
+__all__ = list(_DATA_MODULES)
+
+
+def __getattr__(name):
+    if name in _DATA_MODULES:
+        return getattr(importlib.import_module(_DATA_MODULES[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,135 @@
+import random
+import re
+from dataclasses import dataclass, field
+from typing import Optional
+
+import ujson as json
+from transformers import AutoTokenizer, HfArgumentParser
+
+from src.constants import LLAVA_IMAGE_TOKEN
+
+# Tokens of the chat template around every message (`<|im_start|>role\n ... <|im_end|>\n`).
+TURN_OVERHEAD_TOKENS = 5
+IMAGE_TOKEN_PATTERN = re.compile(r"\n?" + re.escape(LLAVA_IMAGE_TOKEN) + r"\n?")
+CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+@dataclass
+class ConsolidateArguments:
+    data_path: str = field(default=None, metadata={"help": "LLaVA-format JSON file to consolidate."})
+    output_path: str = field(default=None, metadata={"help": "Where the consolidated JSON file is written."})
+    model_id: Optional[str] = field(
+        default=None,
+        metadata={"help": "Tokenizer used to count the text tokens. Without it they are estimated from the characters."}
+    )
+    max_text_tokens: int = field(default=1024, metadata={"help": "Text token budget of one consolidated sample."})
+    seed: int = field(default=42, metadata={"help": "Seed of the order in which the QA pairs of an image are grouped."})
+
+
+def estimate_text_tokens(text):
+    """Rough token count without a tokenizer: one token per CJK character and per four other characters."""
+    num_cjk = len(CJK_PATTERN.findall(text))
+    return num_cjk + (len(text) - num_cjk + 3) // 4
+
+
+def _single_turn_qa(sample):
+    """`(image, question, answer)` of a single-turn sample on one image, or `None` if it can't be merged."""
+    image = sample.get("image")
+    conversations = sample.get("conversations", [])
+    if not isinstance(image, str) or "video" in sample or len(conversations) != 2:
+        return None
+    question, answer = conversations
+    if question["from"] != "human" or answer["from"] != "gpt" or LLAVA_IMAGE_TOKEN not in question["value"]:
+        return None
+    if LLAVA_IMAGE_TOKEN in answer["value"] or question["value"].count(LLAVA_IMAGE_TOKEN) != 1:
+        return None
+    return image, IMAGE_TOKEN_PATTERN.sub("", question["value"]).strip(), answer["value"]
+
+
+def _with_image_token(conversations):
+    """Puts the image placeholder back at the start of the first question."""
+    conversations = [dict(turn) for turn in conversations]
+    conversations[0]["value"] = f"{LLAVA_IMAGE_TOKEN}\n{conversations[0]['value']}"
+    return conversations
+
+
+def consolidate_samples(samples, max_text_tokens=1024, count_tokens=estimate_text_tokens, seed=42):
+    """
+    Merges the single-turn samples that ask about the same image into multi-turn samples of at most
+    `max_text_tokens` text tokens, so the vision tower encodes the image once for all of them.
+    Other samples are kept as they are. Merged samples are marked with `shuffle_turns`, and
+    `SupervisedDataset` shuffles their QA pairs every time it loads them, i.e. once per epoch.
+    """
+    rng = random.Random(seed)
+    groups = {}
+    consolidated = []
+    for sample in samples:
+        qa = _single_turn_qa(sample)
+        if qa is None:
+            consolidated.append(sample)
+            continue
+        image, question, answer = qa
+        groups.setdefault(image, []).append((sample.get("id"), question, answer))
+
+    for image, pairs in groups.items():
+        rng.shuffle(pairs)
+        chunks = []
+        chunk_tokens = 0
+        for sample_id, question, answer in pairs:
+            num_tokens = count_tokens(question) + count_tokens(answer) + 2 * TURN_OVERHEAD_TOKENS
+            if not chunks or chunk_tokens + num_tokens > max_text_tokens:
+                chunks.append([])
+                chunk_tokens = 0
+            chunks[-1].append((sample_id, question, answer))
+            chunk_tokens += num_tokens
+
+        for chunk in chunks:
+            conversations = []
+            for _, question, answer in chunk:
+                conversations.append({"from": "human", "value": question})
+                conversations.append({"from": "gpt", "value": answer})
+            sample = {
+                "id": chunk[0][0] if len(chunk) == 1 else f"{chunk[0][0]}+{len(chunk) - 1}",
+                "image": image,
+                "conversations": _with_image_token(conversations),
+            }
+            if len(chunk) > 1:
+                sample["shuffle_turns"] = True
+            consolidated.append(sample)
+    return consolidated
+
+
+def shuffle_turns(conversations, rng=random):
+    """Shuffles the QA pairs of a consolidated sample, keeping the image placeholder in the first question."""
+    pairs = [
+        [dict(conversations[i]), dict(conversations[i + 1])]
+        for i in range(0, len(conversations) - 1, 2)
+    ]
+    pairs[0][0]["value"] = IMAGE_TOKEN_PATTERN.sub("", pairs[0][0]["value"]).strip()
+    rng.shuffle(pairs)
+    return _with_image_token([turn for pair in pairs for turn in pair])
+
+
+def consolidate_dataset():
+    """Merges the same-image QA samples of a LLaVA-format JSON file, e.g.
+    `python -m src.dataset.consolidate_qa --data_path train.json --output_path train_merged.json --model_id Qwen/Qwen2.5-VL-7B-Instruct`
+    """
+    parser = HfArgumentParser(ConsolidateArguments)
+    args, = parser.parse_args_into_dataclasses()
+
+    with open(args.data_path, "r") as f:
+        samples = json.load(f)
+
+    count_tokens = estimate_text_tokens
+    if args.model_id is not None:
+        tokenizer = AutoTokenizer.from_pretrained(args.model_id)
+        count_tokens = lambda text: len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    consolidated = consolidate_samples(samples, args.max_text_tokens, count_tokens=count_tokens, seed=args.seed)
+    with open(args.output_path, "w") as f:
+        json.dump(consolidated, f, ensure_ascii=False, indent=2)
+    print(f"Consolidated {len(samples)} samples into {len(consolidated)} samples, written to {args.output_path}.")
+
+
+if __name__ == "__main__":
+    consolidate_dataset()
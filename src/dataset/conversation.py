@@ -0,0 +1,308 @@
+from typing import Dict
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from qwen_vl_utils.vision_process import smart_resize
+
+from src.constants import (
+    IGNORE_INDEX,
+    DEFAULT_IM_START_TOKEN,
+    DEFAULT_IM_END_TOKEN,
+    DEFAULT_IMAGE_TOKEN,
+    DEFAULT_VIDEO_TOKEN,
+    SYSTEM_MESSAGE,
+    VISION_START_TOKEN,
+    VISION_END_TOKEN,
+)
+
+from .data_utils import VisionPatchifier, image_to_frames
+
+
+class ConversationEncoder(object):
+    """Turns an OpenAI-style conversation into `input_ids` and `labels` with one tokenizer call.
+
+    The fixed template pieces (system block, `<|im_end|>\\n`, `<|im_start|>{role}\\n`) are tokenized once.
+    Special tokens split the text before BPE runs, so tokenizing every `{role}\\n{content}` body on its own
+    and joining them with the cached pieces gives exactly the ids of the full chat template. All bodies of a
+    sample go through a single batched call of the fast tokenizer. Vision placeholders are expanded to one
+    token per merged patch from the grids of the image processor, like the processor does.
+
+    With `max_length`, samples are truncated without ever splitting a vision block: trailing turns are
+    dropped first, then the images and videos are down-scaled to fit, and only then is the tail cut.
+    """
+
+    def __init__(self, processor, model_id, defer_vision=False):
+        self.processor = processor
+        self.tokenizer = processor.tokenizer
+        self.model_id = model_id
+        self.merge_length = processor.image_processor.merge_size ** 2
+        # Only compute the grids here and leave patchify / normalize to the collator.
+        self.defer_vision = defer_vision
+        self.patchifier = VisionPatchifier.from_image_processor(processor.image_processor)
+
+        self.im_start_id = self.tokenizer.convert_tokens_to_ids(DEFAULT_IM_START_TOKEN)
+        self.im_end_ids = [self.tokenizer.convert_tokens_to_ids(DEFAULT_IM_END_TOKEN)] + self._tokenize("\n")
+        self.image_pad_id = self.tokenizer.convert_tokens_to_ids(DEFAULT_IMAGE_TOKEN)
+        self.video_pad_id = self.tokenizer.convert_tokens_to_ids(DEFAULT_VIDEO_TOKEN)
+        self.vision_start_id = self.tokenizer.convert_tokens_to_ids(VISION_START_TOKEN)
+        self.vision_end_id = self.tokenizer.convert_tokens_to_ids(VISION_END_TOKEN)
+
+        self.system_ids = []
+        if len(SYSTEM_MESSAGE) > 0:
+            self.system_ids = self._tokenize(f"{DEFAULT_IM_START_TOKEN}system\n{SYSTEM_MESSAGE}{DEFAULT_IM_END_TOKEN}\n")
+        self._role_header_ids = {}
+
+    def _tokenize(self, text):
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def _role_header(self, role):
+        if role not in self._role_header_ids:
+            self._role_header_ids[role] = [self.im_start_id] + self._tokenize(f"{role}\n")
+        return self._role_header_ids[role]
+
+    def _expand(self, ids, pad_id, num_tokens, cursor):
+        """Repeats every `pad_id` in `ids` by the number of tokens of the matching image or video."""
+        if pad_id not in ids:
+            return ids, cursor
+        expanded = []
+        for token in ids:
+            if token == pad_id:
+                expanded.extend([pad_id] * num_tokens[cursor])
+                cursor += 1
+            else:
+                expanded.append(token)
+        return expanded, cursor
+
+    def _num_vision_tokens(self, item):
+        """Number of tokens of a resized PIL image or a `[T, C, H, W]` video."""
+        if isinstance(item, torch.Tensor):
+            grid_t, grid_h, grid_w = self.patchifier.get_grid_thw(item)
+        else:
+            width, height = item.size
+            grid_t, grid_h, grid_w = 1, height // self.patchifier.patch_size, width // self.patchifier.patch_size
+        return grid_t * grid_h * grid_w // self.merge_length
+
+    def _downscale(self, item, scale):
+        """Resizes an image or video to about `scale` times its pixels, keeping the patch grid alignment."""
+        factor = self.patchifier.patch_size * self.patchifier.merge_size
+        if isinstance(item, torch.Tensor):
+            height, width = item.shape[-2:]
+        else:
+            width, height = item.size
+        resized_height, resized_width = smart_resize(
+            height, width, factor=factor, min_pixels=factor * factor, max_pixels=max(int(height * width * scale), factor * factor)
+        )
+        if (resized_height, resized_width) == (height, width):
+            return item
+        if isinstance(item, torch.Tensor):
+            resized = F.interpolate(item.float(), size=(resized_height, resized_width), mode="bicubic", antialias=True)
+            return resized.clamp(0, 255).to(item.dtype)
+        return item.resize((resized_width, resized_height), Image.BICUBIC)
+
+    def tokenize_turns(self, conversation):
+        """
+        Token ids of the body of every turn. They can be passed to `num_text_tokens` and `encode`,
+        so a sample is tokenized once even when its text length is needed before the images are loaded.
+        """
+        # One batched call for every turn: user turns keep their role header in the body, so the
+        # text around the first special token is tokenized exactly as in the full template.
+        bodies = []
+        for j in range(0, len(conversation), 2):
+            bodies.append(f"{conversation[j]['role']}\n{conversation[j]['content']}")
+            bodies.append(conversation[j + 1]["content"])
+        return self.tokenizer(bodies, add_special_tokens=False)["input_ids"]
+
+    def _turn_text_lengths(self, conversation, body_ids):
+        """Number of tokens of every user / assistant turn pair, without the tokens its placeholders expand to."""
+        lengths = []
+        for j in range(0, len(conversation), 2):
+            num_placeholders = body_ids[j].count(self.image_pad_id) + body_ids[j].count(self.video_pad_id)
+            lengths.append(
+                1 + len(body_ids[j]) + 2 * len(self.im_end_ids) + len(self._role_header(conversation[j + 1]["role"]))
+                + len(body_ids[j + 1]) - num_placeholders
+            )
+        return lengths
+
+    def num_text_tokens(self, conversation, body_ids=None):
+        """Number of tokens of a conversation without its image and video tokens."""
+        if body_ids is None:
+            body_ids = self.tokenize_turns(conversation)
+        return len(self.system_ids) + sum(self._turn_text_lengths(conversation, body_ids))
+
+    def _fit(self, conversation, body_ids, images, videos, video_fps, max_length):
+        """
+        Drops trailing turns, then down-scales the vision inputs, until the sample has at most `max_length` tokens.
+        The first turn is always kept, so the result can still be too long; `encode` cuts the tail in that case.
+        """
+        image_tokens = [self._num_vision_tokens(image) for image in images]
+        video_tokens = [self._num_vision_tokens(video) for video in videos]
+
+        total_length = len(self.system_ids)
+        num_turns = 0
+        num_images = 0
+        num_videos = 0
+        for j, text_length in zip(range(0, len(conversation), 2), self._turn_text_lengths(conversation, body_ids)):
+            turn_images = body_ids[j].count(self.image_pad_id)
+            turn_videos = body_ids[j].count(self.video_pad_id)
+            turn_length = (
+                text_length
+                + sum(image_tokens[num_images:num_images + turn_images])
+                + sum(video_tokens[num_videos:num_videos + turn_videos])
+            )
+            if num_turns > 0 and total_length + turn_length > max_length:
+                break
+            total_length += turn_length
+            num_turns += 1
+            num_images += turn_images
+            num_videos += turn_videos
+
+        truncated = num_turns * 2 < len(conversation)
+        conversation = conversation[:num_turns * 2]
+        body_ids = body_ids[:num_turns * 2]
+        images = images[:num_images]
+        videos = videos[:num_videos]
+        video_fps = video_fps[:num_videos] if video_fps is not None else None
+
+        vision_length = sum(image_tokens[:num_images]) + sum(video_tokens[:num_videos])
+        budget = max_length - (total_length - vision_length)
+        if total_length > max_length and vision_length > 0 and budget > 0:
+            truncated = True
+            scale = budget / vision_length
+            # The grids are rounded to whole merged patches, so shrink a bit more until it fits.
+            for _ in range(10):
+                resized_images = [self._downscale(image, scale) for image in images]
+                resized_videos = [self._downscale(video, scale) for video in videos]
+                resized_length = (
+                    sum(self._num_vision_tokens(image) for image in resized_images)
+                    + sum(self._num_vision_tokens(video) for video in resized_videos)
+                )
+                if resized_length <= budget:
+                    break
+                scale *= 0.9
+            images, videos = resized_images, resized_videos
+
+        return conversation, body_ids, images, videos, video_fps, truncated
+
+    def _cut(self, data_dict, max_length):
+        """Cuts the tail of an encoded sample to `max_length`, moving the cut before a vision block it would split."""
+        input_ids = data_dict["input_ids"]
+        cut = max_length
+        starts = (input_ids == self.vision_start_id).nonzero().flatten().tolist()
+        ends = (input_ids == self.vision_end_id).nonzero().flatten().tolist()
+        kept_images = 0
+        kept_videos = 0
+        for start, end in zip(starts, ends):
+            if end < cut:
+                if input_ids[start + 1] == self.image_pad_id:
+                    kept_images += 1
+                elif input_ids[start + 1] == self.video_pad_id:
+                    kept_videos += 1
+            elif start < cut:
+                cut = start
+
+        data_dict["input_ids"] = input_ids[:cut]
+        data_dict["labels"] = data_dict["labels"][:cut]
+
+        for pixel_key, frames_key, grid_key, kept in [
+            ("pixel_values", "image_frames", "image_grid_thw", kept_images),
+            ("pixel_values_videos", "video_frames", "video_grid_thw", kept_videos),
+        ]:
+            if grid_key not in data_dict:
+                continue
+            grid_thw = data_dict[grid_key]
+            if kept == 0:
+                for key in [pixel_key, frames_key, grid_key]:
+                    data_dict.pop(key, None)
+                if grid_key == "video_grid_thw":
+                    data_dict.pop("second_per_grid_ts", None)
+                continue
+            if frames_key in data_dict:
+                data_dict[frames_key] = data_dict[frames_key][:kept]
+            else:
+                data_dict[pixel_key] = data_dict[pixel_key][:int(grid_thw[:kept].prod(-1).sum())]
+            data_dict[grid_key] = grid_thw[:kept]
+            if grid_key == "video_grid_thw" and "second_per_grid_ts" in data_dict:
+                data_dict["second_per_grid_ts"] = data_dict["second_per_grid_ts"][:kept]
+        return data_dict
+
+    def encode(self, conversation, images=None, videos=None, video_fps=None, max_length=None, body_ids=None) -> Dict[str, torch.Tensor]:
+        """
+        conversation: list of {"role", "content"} dicts, alternating user and assistant turns.
+        images / videos: decoded inputs for the vision placeholders, in order of appearance.
+        video_fps: sampling fps of every video, used for `second_per_grid_ts` of Qwen2.5-VL.
+        max_length: truncates the sample to this many tokens and reports it in `truncated`.
+        body_ids: output of `tokenize_turns` for this conversation, if it was already tokenized.
+        With `defer_vision`, the resized frames are returned as `image_frames` / `video_frames` instead of pixel values.
+        """
+        if body_ids is None:
+            body_ids = self.tokenize_turns(conversation)
+
+        truncated = False
+        if max_length is not None:
+            conversation, body_ids, images, videos, video_fps, truncated = self._fit(
+                conversation, body_ids, list(images or []), list(videos or []), video_fps, max_length
+            )
+            images = images if len(images) > 0 else None
+            videos = videos if len(videos) > 0 else None
+
+        data_dict = {}
+        image_tokens = []
+        video_tokens = []
+        if images is not None:
+            if self.defer_vision:
+                frames = [image_to_frames(image) for image in images]
+                data_dict["image_frames"] = frames
+                data_dict["image_grid_thw"] = torch.tensor([self.patchifier.get_grid_thw(f) for f in frames], dtype=torch.long)
+            else:
+                vision_inputs = self.processor.image_processor(images=images, do_resize=False, return_tensors="pt")
+                data_dict["pixel_values"] = vision_inputs["pixel_values"]
+                data_dict["image_grid_thw"] = vision_inputs["image_grid_thw"]
+            image_tokens = (data_dict["image_grid_thw"].prod(-1) // self.merge_length).tolist()
+        if videos is not None:
+            if self.defer_vision:
+                data_dict["video_frames"] = list(videos)
+                data_dict["video_grid_thw"] = torch.tensor([self.patchifier.get_grid_thw(v) for v in videos], dtype=torch.long)
+            else:
+                vision_inputs = self.processor.image_processor(images=None, videos=videos, do_resize=False, return_tensors="pt")
+                data_dict["pixel_values_videos"] = vision_inputs["pixel_values_videos"]
+                data_dict["video_grid_thw"] = vision_inputs["video_grid_thw"]
+            video_tokens = (data_dict["video_grid_thw"].prod(-1) // self.merge_length).tolist()
+            if "Qwen2.5" in self.model_id:
+                temporal_patch_size = self.processor.image_processor.temporal_patch_size
+                data_dict["second_per_grid_ts"] = [temporal_patch_size / fps for fps in video_fps]
+
+        segments = [(self.system_ids, False)]
+        image_cursor = 0
+        video_cursor = 0
+        for j in range(0, len(conversation), 2):
+            user_ids, response_ids = body_ids[j], body_ids[j + 1]
+            user_ids, image_cursor = self._expand(user_ids, self.image_pad_id, image_tokens, image_cursor)
+            user_ids, video_cursor = self._expand(user_ids, self.video_pad_id, video_tokens, video_cursor)
+            segments.append(([self.im_start_id], False))
+            segments.append((user_ids, False))
+            segments.append((self.im_end_ids, False))
+            segments.append((self._role_header(conversation[j + 1]["role"]), False))
+            segments.append((response_ids, True))
+            segments.append((self.im_end_ids, True))
+
+        total_length = sum(len(ids) for ids, _ in segments)
+        input_ids = torch.empty(total_length, dtype=torch.long)
+        labels = torch.full((total_length,), IGNORE_INDEX, dtype=torch.long)
+        offset = 0
+        for ids, is_target in segments:
+            end = offset + len(ids)
+            input_ids[offset:end] = torch.tensor(ids, dtype=torch.long)
+            if is_target:
+                labels[offset:end] = input_ids[offset:end]
+            offset = end
+
+        data_dict["input_ids"] = input_ids
+        data_dict["labels"] = labels
+        if max_length is not None:
+            if total_length > max_length:
+                data_dict = self._cut(data_dict, max_length)
+                truncated = True
+            data_dict["truncated"] = truncated
+        data_dict["attention_mask"] = torch.ones_like(data_dict["input_ids"])
+        return data_dict
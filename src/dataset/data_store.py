@@ -0,0 +1,45 @@
+import numpy as np
+import ujson as json
+
+
+class SampleStore(object):
+    """Read-only, array-backed storage for annotation records.
+
+    A Python list of nested dicts is slowly copied into every forked dataloader worker, because reading
+    an object updates its refcount and dirties the page it lives on. Here every record is serialized to
+    JSON and kept in one `uint8` buffer plus an `int64` offsets array. Neither holds Python objects, so
+    the pages stay shared between workers, and a record is only decoded when it is accessed.
+    """
+
+    def __init__(self, records):
+        chunks = []
+        offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        for i, record in enumerate(records):
+            chunk = json.dumps(record, ensure_ascii=False).encode("utf-8")
+            chunks.append(chunk)
+            offsets[i + 1] = offsets[i] + len(chunk)
+
+        self.buffer = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+        self.offsets = offsets
+
+    @classmethod
+    def from_json(cls, data_path):
+        with open(data_path, "r") as f:
+            return cls(json.load(f))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return json.loads(self.buffer[start:end].tobytes().decode("utf-8"))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def nbytes(self):
+        return self.buffer.nbytes + self.offsets.nbytes
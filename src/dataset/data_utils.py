@@ -1,7 +1,14 @@
+import hashlib
+import io
 import re
+import numpy as np
 import torch
 
+from PIL import Image
 from qwen_vl_utils import process_vision_info
+from qwen_vl_utils.vision_process import IMAGE_FACTOR, VIDEO_TOTAL_PIXELS, smart_nframes, smart_resize
+from transformers import AutoConfig
+from transformers.image_utils import OPENAI_CLIP_MEAN, OPENAI_CLIP_STD
 
 from src.constants import (
     DEFAULT_IMAGE_TOKEN,
@@ -68,9 +75,145 @@ def pad_sequence(sequences, padding_side='right', padding_value=0):
             output.data[i, -length:] = seq
     return output
 
-def get_image_info(image_path, min_pixel, max_pixel, width, height):
+def get_padded_length(length, pad_to_multiple_of=None, buckets=None):
+    """
+    Length a batch is padded to: the smallest bucket that fits, otherwise `length` rounded up to `pad_to_multiple_of`.
+    A few recurring shapes let the caching allocators reuse their blocks instead of fragmenting.
+    """
+    if buckets:
+        for bucket in buckets:
+            if bucket >= length:
+                return bucket
+    if pad_to_multiple_of:
+        return -(-length // pad_to_multiple_of) * pad_to_multiple_of
+    return length
+
+def pad_to_length(sequences, padded_length, padding_value=0, mask=None):
+    """
+    Right-pads 1D sequences into a `[batch, padded_length]` tensor with a single scatter instead of a copy per row.
+    mask: boolean `[batch, padded_length]` tensor of the positions holding tokens, built from the lengths if not given.
+    Returns the padded tensor and the mask, which is the attention mask of the batch.
+    """
+    if mask is None:
+        lengths = torch.tensor([len(seq) for seq in sequences], dtype=torch.long)
+        mask = torch.arange(padded_length) < lengths[:, None]
+    output = sequences[0].new_full((len(sequences), padded_length), padding_value)
+    output[mask] = torch.cat(sequences)
+    return output, mask
+
+def deduplicate_tensors(tensors):
+    """
+    Drops the tensors whose shape and content already appeared in the list.
+    Returns the distinct tensors and, for every input tensor, the index of its copy among them.
+    """
+    unique = []
+    index = []
+    seen = {}
+    for tensor in tensors:
+        data = tensor.detach().contiguous().reshape(-1).view(torch.uint8).numpy()
+        key = (tuple(tensor.shape), tensor.dtype, hashlib.blake2b(data, digest_size=16).digest())
+        if key not in seen:
+            seen[key] = len(unique)
+            unique.append(tensor)
+        index.append(seen[key])
+    return unique, torch.tensor(index, dtype=torch.long)
+
+def _decode_pil(image_file, get_target_size):
+    image = Image.open(image_file)
+    image.load()
+    return image
+
+def _decode_pil_draft(image_file, get_target_size):
+    image = Image.open(image_file)
+    # JPEGs are decoded at 1/2, 1/4 or 1/8 of their size by the DCT, as long as that stays above the target size.
+    image.draft("RGB", get_target_size(*image.size))
+    image.load()
+    return image
+
+_turbojpeg = None
+
+def _decode_turbojpeg(image_file, get_target_size):
+    global _turbojpeg
+    try:
+        import turbojpeg
+    except ImportError as e:
+        raise ImportError("The `turbojpeg` image decoder needs PyTurboJPEG: `pip install PyTurboJPEG`.") from e
+    if _turbojpeg is None:
+        # Loads libjpeg-turbo once per process.
+        _turbojpeg = turbojpeg.TurboJPEG()
+
+    if isinstance(image_file, str):
+        with open(image_file, "rb") as f:
+            data = f.read()
+    else:
+        # The header may have been read already, e.g. to compute the token budget of the sample.
+        image_file.seek(0)
+        data = image_file.read()
+    if not data.startswith(b"\xff\xd8"):
+        # Not a JPEG.
+        return _decode_pil_draft(io.BytesIO(data), get_target_size)
+
+    width, height, _, _ = _turbojpeg.decode_header(data)
+    target_width, target_height = get_target_size(width, height)
+    # Smallest DCT scaling that is still at least the target size.
+    scaling_factor = min(
+        (
+            factor for factor in _turbojpeg.scaling_factors
+            if factor[0] <= factor[1]
+            and width * factor[0] // factor[1] >= target_width
+            and height * factor[0] // factor[1] >= target_height
+        ),
+        key=lambda factor: factor[0] / factor[1],
+        default=None,
+    )
+    # TurboJPEG decodes to BGR by default.
+    array = _turbojpeg.decode(data, pixel_format=turbojpeg.TJPF_RGB, scaling_factor=scaling_factor)
+    return Image.fromarray(array)
+
+IMAGE_DECODERS = {
+    "pil": _decode_pil,
+    "pil_draft": _decode_pil_draft,
+    "turbojpeg": _decode_turbojpeg,
+}
+
+def get_resized_image_size(image_width, image_height, min_pixel, max_pixel, width=None, height=None):
+    """`(width, height)` an image is resized to by `get_image_info`, like `qwen_vl_utils` computes it."""
+    if width is not None and height is not None:
+        resized_height, resized_width = smart_resize(height, width, factor=IMAGE_FACTOR)
+    else:
+        resized_height, resized_width = smart_resize(
+            image_height, image_width, factor=IMAGE_FACTOR, min_pixels=min_pixel, max_pixels=max_pixel
+        )
+    return resized_width, resized_height
+
+def decode_image(image_file, min_pixel, max_pixel, width=None, height=None, decoder="pil"):
+    """
+    Decodes a local image (a path or a file object) with one of `IMAGE_DECODERS`.
+    Decoders other than `pil` may decode large JPEGs at a reduced resolution that is still above the final size.
+    Returns the image and the `(width, height)` it has to be resized to.
+    """
+    target_size = []
+
+    def get_target_size(image_width, image_height):
+        target_size.append(get_resized_image_size(image_width, image_height, min_pixel, max_pixel, width, height))
+        return target_size[-1]
+
+    image = IMAGE_DECODERS[decoder](image_file, get_target_size)
+    if not target_size:
+        # The decoder didn't need it, so the image has its full size.
+        get_target_size(*image.size)
+    return image, target_size[0]
+
+def get_image_info(image_path, min_pixel, max_pixel, width, height, cache=None, decoder="pil", key_path=None):
     # Using this because of process_vision_info function
     # Need to fix this in the future
+    # `key_path` is the file the cache keys on when `image_path` is a copy of it, e.g. staged on local disk.
+    key_path = image_path if key_path is None else key_path
+    key = cache.make_key(key_path, min_pixel, max_pixel, width, height, decoder) if cache is not None else None
+    if key is not None:
+        image = cache.get(key)
+        if image is not None:
+            return image
 
 
     content = {
@@ -83,6 +226,15 @@ def get_image_info(image_path, min_pixel, max_pixel, width, height):
     if width is not None and height is not None:
         content["resized_width"] = width
         content["resized_height"] = height
+
+    # `qwen_vl_utils` only opens paths and URLs, so file objects (e.g. from a tar shard) are always decoded here.
+    if not isinstance(image_path, str) or (decoder != "pil" and not image_path.startswith(("http://", "https://", "data:"))):
+        if isinstance(image_path, str) and image_path.startswith("file://"):
+            image_path = image_path[len("file://"):]
+        # The size is computed from the original image, a reduced resolution decode would change it.
+        content["image"], (content["resized_width"], content["resized_height"]) = decode_image(
+            image_path, min_pixel, max_pixel, width, height, decoder=decoder
+        )
     
     messages = [
         {"role": "user", 
@@ -92,11 +244,21 @@ def get_image_info(image_path, min_pixel, max_pixel, width, height):
 
     image_input, _ = process_vision_info(messages)
 
+    if key is not None:
+        cache.put(key, image_input[0])
+
     return image_input[0]
 
-def get_video_info(video_path, min_pixels, max_pixels, width, height, fps):
+def get_video_info(video_path, min_pixels, max_pixels, width, height, fps, cache=None, key_path=None):
     # Using this because of process_vision_info function
     # Need to fix this in the future
+    # `key_path` is the file the cache keys on when `video_path` is a copy of it, e.g. staged on local disk.
+    key_path = video_path if key_path is None else key_path
+    key = cache.make_key(key_path, min_pixels, max_pixels, width, height, fps) if cache is not None else None
+    if key is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
     content = {
         "type": "video", 
         "video": video_path,
@@ -117,4 +279,253 @@ def get_video_info(video_path, min_pixels, max_pixels, width, height, fps):
 
     _, video_input, video_kwargs = process_vision_info(messages, return_video_kwargs=True)
 
-    return video_input[0], video_kwargs
\ No newline at end of file
+    if key is not None:
+        cache.put(key, video_input[0], video_kwargs)
+
+    return video_input[0], video_kwargs
+
+def estimate_image_tokens(image_path, min_pixel, max_pixel, width, height):
+    """
+    Number of image tokens after `get_image_info`, computed from the image header without decoding the pixels.
+    Images that can't be opened locally (e.g. URLs) are assumed to have the largest allowed size.
+    """
+    if width is not None and height is not None:
+        resized_height, resized_width = smart_resize(height, width, factor=IMAGE_FACTOR)
+    else:
+        try:
+            with Image.open(image_path) as image:
+                image_width, image_height = image.size
+        except Exception:
+            return max_pixel // (IMAGE_FACTOR * IMAGE_FACTOR)
+        resized_height, resized_width = smart_resize(
+            image_height, image_width, factor=IMAGE_FACTOR, min_pixels=min_pixel, max_pixels=max_pixel
+        )
+    return (resized_height // IMAGE_FACTOR) * (resized_width // IMAGE_FACTOR)
+
+def get_image_max_pixels(image_paths, num_tokens, min_pixel, max_pixel):
+    """
+    Per-image `max_pixels` so that the images of one sample share about `num_tokens` vision tokens.
+    Every image is scaled by the same factor of its area (capped at `max_pixel`), but never below `min_pixel`.
+    The sizes are read from the image headers. Images that can't be opened locally count with `max_pixel`.
+    """
+    areas = []
+    for image_path in image_paths:
+        try:
+            with Image.open(image_path) as image:
+                width, height = image.size
+            areas.append(min(width * height, max_pixel))
+        except Exception:
+            areas.append(max_pixel)
+
+    budget = max(num_tokens, 0) * IMAGE_FACTOR * IMAGE_FACTOR
+    if sum(areas) <= budget:
+        return [max_pixel] * len(areas)
+    scale = budget / sum(areas)
+    return [max(int(area * scale), min_pixel) for area in areas]
+
+def estimate_video_tokens(video_path, min_pixels, max_pixels, width, height, fps):
+    """
+    Number of video tokens after `get_video_info`, computed from the container metadata.
+    This mirrors the frame sampling and resizing of `qwen_vl_utils`. Unreadable videos get the total pixel budget.
+    """
+    try:
+        import av
+
+        with av.open(video_path) as container:
+            stream = container.streams.video[0]
+            video_fps = float(stream.average_rate)
+            total_frames = stream.frames or int(float(stream.duration * stream.time_base) * video_fps)
+            frame_height, frame_width = stream.height, stream.width
+        nframes = smart_nframes({"fps": fps}, total_frames=total_frames, video_fps=video_fps)
+    except Exception:
+        return VIDEO_TOTAL_PIXELS // (IMAGE_FACTOR * IMAGE_FACTOR)
+
+    if width is not None and height is not None:
+        resized_height, resized_width = smart_resize(height, width, factor=IMAGE_FACTOR)
+    else:
+        max_pixels = min(max_pixels, max(VIDEO_TOTAL_PIXELS / nframes * 2, int(min_pixels * 1.05)))
+        resized_height, resized_width = smart_resize(
+            frame_height, frame_width, factor=IMAGE_FACTOR, min_pixels=min_pixels, max_pixels=max_pixels
+        )
+    # Two frames are merged into one temporal patch.
+    return (nframes // 2) * (resized_height // IMAGE_FACTOR) * (resized_width // IMAGE_FACTOR)
+
+def get_rope_kwargs(model_id):
+    """Model specific constants needed by `get_rope_index`."""
+    config = AutoConfig.from_pretrained(model_id)
+    return dict(
+        spatial_merge_size=config.vision_config.spatial_merge_size,
+        image_token_id=config.image_token_id,
+        video_token_id=config.video_token_id,
+        vision_start_token_id=config.vision_start_token_id,
+        # Qwen2.5-VL aligns the temporal position ids of videos to absolute time.
+        tokens_per_second=getattr(config.vision_config, "tokens_per_second", None) if "Qwen2.5" in model_id else None,
+    )
+
+def get_rope_index(
+    input_ids,
+    image_grid_thw=None,
+    video_grid_thw=None,
+    second_per_grid_ts=None,
+    spatial_merge_size=2,
+    image_token_id=None,
+    video_token_id=None,
+    vision_start_token_id=None,
+    tokens_per_second=None,
+):
+    """
+    3D mRoPE position ids of a single unpadded sequence.
+    This follows `get_rope_index` of the Qwen2-VL / Qwen2.5-VL models, so it can run in the data workers.
+    input_ids: 1D tensor of one sample. The grids only belong to this sample.
+    Returns position ids in [3, seq_len] shape and the rope delta.
+    """
+    input_tokens = input_ids.tolist()
+    vision_tokens = [input_tokens[i + 1] for i, token in enumerate(input_tokens[:-1]) if token == vision_start_token_id]
+    remain_images = vision_tokens.count(image_token_id)
+    remain_videos = vision_tokens.count(video_token_id)
+
+    llm_pos_ids_list = []
+    st = 0
+    image_index, video_index = 0, 0
+    for _ in range(remain_images + remain_videos):
+        ed_image = input_tokens.index(image_token_id, st) if remain_images > 0 else len(input_tokens) + 1
+        ed_video = input_tokens.index(video_token_id, st) if remain_videos > 0 else len(input_tokens) + 1
+
+        if ed_image < ed_video:
+            t, h, w = image_grid_thw[image_index].tolist()
+            second_per_grid_t = 0
+            image_index += 1
+            remain_images -= 1
+            ed = ed_image
+        else:
+            t, h, w = video_grid_thw[video_index].tolist()
+            second_per_grid_t = float(second_per_grid_ts[video_index]) if second_per_grid_ts is not None else 1.0
+            video_index += 1
+            remain_videos -= 1
+            ed = ed_video
+
+        llm_grid_t, llm_grid_h, llm_grid_w = t, h // spatial_merge_size, w // spatial_merge_size
+        text_len = ed - st
+        st_idx = llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
+        llm_pos_ids_list.append(torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx)
+
+        t_index = torch.arange(llm_grid_t).view(-1, 1).expand(-1, llm_grid_h * llm_grid_w)
+        if tokens_per_second is not None:
+            t_index = (t_index * second_per_grid_t * tokens_per_second).long()
+        t_index = t_index.flatten()
+        h_index = torch.arange(llm_grid_h).view(1, -1, 1).expand(llm_grid_t, -1, llm_grid_w).flatten()
+        w_index = torch.arange(llm_grid_w).view(1, 1, -1).expand(llm_grid_t, llm_grid_h, -1).flatten()
+        llm_pos_ids_list.append(torch.stack([t_index, h_index, w_index]) + text_len + st_idx)
+        st = ed + llm_grid_t * llm_grid_h * llm_grid_w
+
+    if st < len(input_tokens):
+        st_idx = llm_pos_ids_list[-1].max() + 1 if len(llm_pos_ids_list) > 0 else 0
+        text_len = len(input_tokens) - st
+        llm_pos_ids_list.append(torch.arange(text_len).view(1, -1).expand(3, -1) + st_idx)
+
+    position_ids = torch.cat(llm_pos_ids_list, dim=1).reshape(3, -1).to(torch.long)
+    rope_delta = int(position_ids.max()) + 1 - len(input_tokens)
+    return position_ids, rope_delta
+
+class VisionPatchifier(object):
+    """
+    Torch version of the rescale, normalize and patchify steps of the Qwen2-VL image processor.
+    Reshaping is done per image, the float conversion and normalization once for the whole batch.
+    """
+
+    def __init__(self, patch_size, temporal_patch_size, merge_size, image_mean, image_std):
+        self.patch_size = patch_size
+        self.temporal_patch_size = temporal_patch_size
+        self.merge_size = merge_size
+        self.image_mean = torch.tensor(image_mean, dtype=torch.float32)
+        self.image_std = torch.tensor(image_std, dtype=torch.float32)
+
+    @classmethod
+    def from_image_processor(cls, image_processor):
+        return cls(
+            patch_size=image_processor.patch_size,
+            temporal_patch_size=image_processor.temporal_patch_size,
+            merge_size=image_processor.merge_size,
+            image_mean=image_processor.image_mean,
+            image_std=image_processor.image_std,
+        )
+
+    @classmethod
+    def from_vision_config(cls, vision_config):
+        """Builds the patchifier on the model side. Qwen2-VL processors use the OpenAI CLIP mean and std."""
+        return cls(
+            patch_size=vision_config.patch_size,
+            temporal_patch_size=vision_config.temporal_patch_size,
+            merge_size=vision_config.spatial_merge_size,
+            image_mean=OPENAI_CLIP_MEAN,
+            image_std=OPENAI_CLIP_STD,
+        )
+
+    def get_grid_thw(self, frames):
+        """Grid of a resized `[T, C, H, W]` frame tensor, without processing it."""
+        num_frames, _, height, width = frames.shape
+        grid_t = -(-num_frames // self.temporal_patch_size)
+        return [grid_t, height // self.patch_size, width // self.patch_size]
+
+    def patchify(self, frames):
+        """
+        frames: `[T, C, H, W]` tensor of one image (T=1) or video, already resized to a multiple of the patch grid.
+        Returns un-normalized patches in `[grid_t * grid_h * grid_w, C, temporal_patch_size, patch_size, patch_size]` shape.
+        """
+        if frames.shape[0] % self.temporal_patch_size != 0:
+            repeats = self.temporal_patch_size - frames.shape[0] % self.temporal_patch_size
+            frames = torch.cat([frames, frames[-1:].expand(repeats, -1, -1, -1)], dim=0)
+        num_frames, channel, height, width = frames.shape
+        grid_t = num_frames // self.temporal_patch_size
+        grid_h, grid_w = height // self.patch_size, width // self.patch_size
+        patches = frames.reshape(
+            grid_t, self.temporal_patch_size, channel,
+            grid_h // self.merge_size, self.merge_size, self.patch_size,
+            grid_w // self.merge_size, self.merge_size, self.patch_size,
+        )
+        patches = patches.permute(0, 3, 6, 4, 7, 2, 1, 5, 8)
+        return patches.reshape(grid_t * grid_h * grid_w, channel, self.temporal_patch_size, self.patch_size, self.patch_size)
+
+    def normalize(self, patches, dtype=torch.float32):
+        """Rescales to [0, 1], normalizes and flattens patches returned by `patchify`."""
+        mean = self.image_mean.to(patches.device).view(1, -1, 1, 1, 1)
+        std = self.image_std.to(patches.device).view(1, -1, 1, 1, 1)
+        patches = (patches.to(torch.float32) * (1 / 255) - mean) / std
+        return patches.reshape(patches.shape[0], -1).to(dtype)
+
+    def flatten_frames(self, frames_list, is_video=False):
+        """
+        Packs resized frames into one flat uint8 tensor, so the batch crosses to the device at 1 byte per value.
+        Images keep their single frame, videos are padded to a multiple of `temporal_patch_size`.
+        """
+        flat = []
+        for frames in frames_list:
+            if frames.dtype != torch.uint8:
+                frames = frames.round().clamp(0, 255).to(torch.uint8)
+            if is_video and frames.shape[0] % self.temporal_patch_size != 0:
+                repeats = self.temporal_patch_size - frames.shape[0] % self.temporal_patch_size
+                frames = torch.cat([frames, frames[-1:].expand(repeats, -1, -1, -1)], dim=0)
+            flat.append(frames.reshape(-1))
+        return torch.cat(flat, dim=0)
+
+    def unflatten_frames(self, flat, grid_thw, is_video=False):
+        """Splits a tensor made by `flatten_frames` back into `[T, C, H, W]` frames using the grids."""
+        frames_list = []
+        offset = 0
+        for grid_t, grid_h, grid_w in grid_thw.tolist():
+            num_frames = grid_t * self.temporal_patch_size if is_video else grid_t
+            shape = (num_frames, len(self.image_mean), grid_h * self.patch_size, grid_w * self.patch_size)
+            numel = shape[0] * shape[1] * shape[2] * shape[3]
+            frames_list.append(flat[offset:offset + numel].view(shape))
+            offset += numel
+        return frames_list
+
+    def __call__(self, frames_list, dtype=torch.float32):
+        """Patchifies and normalizes a list of frame tensors into one `pixel_values` tensor."""
+        patches = torch.cat([self.patchify(frames) for frames in frames_list], dim=0)
+        return self.normalize(patches, dtype=dtype)
+
+
+def image_to_frames(image):
+    """PIL image to a `[1, C, H, W]` uint8 tensor."""
+    return torch.from_numpy(np.asarray(image.convert("RGB"), dtype=np.uint8)).permute(2, 0, 1).unsqueeze(0)
@@ -1,8 +1,6 @@
-import os
 from typing import Dict
 import torch
 import transformers
-import ujson as json
 from torch.utils.data import Dataset
 
 from src.params import DataArguments
@@ -15,6 +13,12 @@ from src.constants import (
 )
 
 from .data_utils import get_image_info, get_video_info, pad_sequence, replace_image_tokens
+from .data_store import SampleStore
+from .image_cache import build_image_cache, build_video_cache
+from .remote_fetch import build_remote_fetcher, get_remote_urls, is_remote_path
+from .staging import build_stager, get_local_files, resolve_local_file
+from .mixture import build_mixture_dataset, is_mixture_data_path
+from .streaming import StreamingDataset, is_streaming_data_path
 
 
 class DPODataset(Dataset):
@@ -30,9 +34,9 @@ class DPODataset(Dataset):
     ):
         super(DPODataset, self).__init__()
         if isinstance(data_path, str):
-            list_data_dict = json.load(open(data_path, "r"))
+            list_data_dict = SampleStore.from_json(data_path)
         else:
-            list_data_dict = data_path
+            list_data_dict = SampleStore(data_path)
 
         self.model_id = model_id
         self.processor = processor
@@ -48,13 +52,26 @@ class DPODataset(Dataset):
         self.video_resized_w = data_args.video_resized_width
         self.video_resized_h = data_args.video_resized_height
         self.fps = data_args.fps
+        self.image_cache = build_image_cache(data_args)
+        self.video_cache = build_video_cache(data_args)
+        self.fetcher = build_remote_fetcher(data_args)
+        self.stager = build_stager(data_args)
 
     def __len__(self):
         return len(self.list_data_dict)
     
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
-        sources = self.list_data_dict[i]
+        return self.process_sample(self.list_data_dict[i])
 
+    def prefetch(self, indices):
+        """Starts downloading the remote files, and staging the local files, of the given samples, see `LookaheadSampler`."""
+        records = [self.list_data_dict[i] for i in indices]
+        if self.fetcher is not None:
+            self.fetcher.prefetch([url for record in records for url in get_remote_urls(record)])
+        if self.stager is not None:
+            self.stager.prefetch([path for record in records for path in get_local_files(record, self.data_args.image_folder)])
+
+    def process_sample(self, sources) -> Dict[str, torch.Tensor]:
         is_video = False
         processor = self.processor
 
@@ -72,10 +89,17 @@ class DPODataset(Dataset):
             images = []
             
             for image_file in image_files:
-                if not os.path.exists(image_file):
-                    if not image_file.startswith("http"):
-                        image_file = os.path.join(image_folder, image_file)
-                images.append(get_image_info(image_file, self.image_min_pixel, self.image_max_pixel, self.image_resized_w, self.image_resized_h))
+                key_path = None
+                if is_remote_path(image_file):
+                    if self.fetcher is not None:
+                        image_file = self.fetcher.fetch(image_file)
+                else:
+                    # The caches key on the original file, a staged copy gets a new mtime every time it is copied.
+                    key_path, image_file = resolve_local_file(image_file, image_folder, self.stager)
+                images.append(get_image_info(
+                    image_file, self.image_min_pixel, self.image_max_pixel, self.image_resized_w, self.image_resized_h,
+                    cache=self.image_cache, decoder=self.data_args.image_decoder, key_path=key_path,
+                ))
 
         elif "video" in sources:
             is_video = True
@@ -91,10 +115,13 @@ class DPODataset(Dataset):
 
             videos = []
             for video_file in video_files:
-                if not os.path.exists(video_file):
-                    if not video_file.startswith("http"):
-                        video_file = os.path.join(video_folder, video_file)
-                video_input, video_kwargs = get_video_info(video_file, self.video_min_pixel, self.video_max_pixel, self.video_resized_w, self.video_resized_h, self.data_args.fps)
+                key_path = None
+                if is_remote_path(video_file):
+                    if self.fetcher is not None:
+                        video_file = self.fetcher.fetch(video_file)
+                else:
+                    key_path, video_file = resolve_local_file(video_file, video_folder, self.stager)
+                video_input, video_kwargs = get_video_info(video_file, self.video_min_pixel, self.video_max_pixel, self.video_resized_w, self.video_resized_h, self.data_args.fps, cache=self.video_cache, key_path=key_path)
                 videos.append(video_input)
         else:
             grid_key = None
@@ -243,9 +270,20 @@ class DataCollatorForDPODataset(object):
     
 def make_dpo_data_module(model_id, processor, data_args):
     """Make dataset and collator for DPO fine-tuning."""
-    dpo_dataset = DPODataset(
-        data_path=data_args.data_path, processor=processor, data_args=data_args, model_id=model_id
-    )
+    if is_mixture_data_path(data_args.data_path):
+        dpo_dataset = build_mixture_dataset(data_args, lambda source_data_args: DPODataset(
+            data_path=[], processor=processor, data_args=source_data_args, model_id=model_id
+        ))
+    elif data_args.lazy_preprocess and is_streaming_data_path(data_args.data_path):
+        dpo_dataset = StreamingDataset(
+            data_path=data_args.data_path,
+            dataset=DPODataset(data_path=[], processor=processor, data_args=data_args, model_id=model_id),
+            shuffle_buffer_size=data_args.shuffle_buffer_size,
+        )
+    else:
+        dpo_dataset = DPODataset(
+            data_path=data_args.data_path, processor=processor, data_args=data_args, model_id=model_id
+        )
     data_collator = DataCollatorForDPODataset(pad_token_id=processor.tokenizer.pad_token_id)
 
     return dict(train_dataset=dpo_dataset,
@@ -3,12 +3,16 @@ import os
 from typing import Dict
 import torch
 import transformers
-import ujson as json
 from torch.utils.data import Dataset
 
 from src.params import DataArguments
 from src.constants import SYSTEM_MESSAGE
 
+from .data_store import SampleStore
+from .remote_fetch import build_remote_fetcher, get_remote_urls
+from .mixture import build_mixture_dataset, is_mixture_data_path
+from .streaming import StreamingDataset, is_streaming_data_path
+
 import re
 
 def replace_image_tokens(input_string, is_video=False):
@@ -78,9 +82,9 @@ class GRPODataset(Dataset):
     ):
         super(GRPODataset, self).__init__()
         if isinstance(data_path, str):
-            list_data_dict = json.load(open(data_path, "r"))
+            list_data_dict = SampleStore.from_json(data_path)
         else:
-            list_data_dict = data_path
+            list_data_dict = SampleStore(data_path)
 
         self.model_id = model_id
         self.processor = processor
@@ -96,13 +100,20 @@ class GRPODataset(Dataset):
         self.video_resized_w = data_args.video_resized_width
         self.video_resized_h = data_args.video_resized_height
         self.fps = data_args.fps
+        self.fetcher = build_remote_fetcher(data_args)
 
     def __len__(self):
         return len(self.list_data_dict)
     
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
-        sources = self.list_data_dict[i]
+        return self.process_sample(self.list_data_dict[i])
+
+    def prefetch(self, indices):
+        """Starts downloading the remote files of the given samples, see `LookaheadSampler`."""
+        if self.fetcher is not None:
+            self.fetcher.prefetch([url for i in indices for url in get_remote_urls(self.list_data_dict[i])])
 
+    def process_sample(self, sources) -> Dict[str, torch.Tensor]:
         is_video = False
 
         contents = []
@@ -119,6 +130,8 @@ class GRPODataset(Dataset):
                 if not os.path.exists(image_file):
                     if not image_file.startswith("http"):
                         image_file = os.path.join(image_folder, image_file)
+                    elif self.fetcher is not None:
+                        image_file = self.fetcher.fetch(image_file)
                 contents.append(get_image_content(image_file, self.image_min_pixel, self.image_max_pixel, self.image_resized_w, self.image_resized_h))
 
         elif "video" in sources:
@@ -134,6 +147,8 @@ class GRPODataset(Dataset):
                 if not os.path.exists(video_file):
                     if not video_file.startswith("http"):
                         video_file = os.path.join(video_folder, video_file)
+                    elif self.fetcher is not None:
+                        video_file = self.fetcher.fetch(video_file)
                 contents.append(get_video_content(video_file, self.video_min_pixel, self.video_max_pixel, self.video_resized_w, self.video_resized_h, self.data_args.fps))
 
         conversations = copy.deepcopy(llava_to_openai(sources['conversations'], is_video=is_video))
@@ -160,9 +175,21 @@ class GRPODataset(Dataset):
     
 def make_grpo_data_module(model_id, processor, data_args):
     """Make dataset and collator for supervised fine-tuning."""
-    grpo_dataset = GRPODataset(
-        data_path=data_args.data_path, processor=processor, data_args=data_args, model_id=model_id
-    )
+    if is_mixture_data_path(data_args.data_path):
+        grpo_dataset = build_mixture_dataset(data_args, lambda source_data_args: GRPODataset(
+            data_path=[], processor=processor, data_args=source_data_args, model_id=model_id
+        ))
+    elif data_args.lazy_preprocess and is_streaming_data_path(data_args.data_path):
+        # `mini_repeat_count` is set by the trainer to the number of generations.
+        grpo_dataset = StreamingDataset(
+            data_path=data_args.data_path,
+            dataset=GRPODataset(data_path=[], processor=processor, data_args=data_args, model_id=model_id),
+            shuffle_buffer_size=data_args.shuffle_buffer_size,
+        )
+    else:
+        grpo_dataset = GRPODataset(
+            data_path=data_args.data_path, processor=processor, data_args=data_args, model_id=model_id
+        )
 
     return dict(train_dataset=grpo_dataset,
                 eval_dataset=None)
\ No newline at end of file
@@ -0,0 +1,180 @@
+import fcntl
+import hashlib
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import ujson as json
+from PIL import Image
+
+
+class ImageCache(object):
+    """On-disk cache of decoded and resized images, with an optional in-memory LRU in front of it.
+
+    An entry is the resized RGB image stored as a raw `uint8` `.npy` file, keyed by the image path, its
+    mtime and the resize parameters. Files are written to a temporary name and moved into place with
+    `os.replace`, so DataLoader workers and ranks on one node can share a directory and never read a
+    partial file. When the directory grows over `max_bytes`, the least recently used files are removed.
+
+    Args:
+        cache_dir: Directory of the cache. It is shared by every process that uses the same path.
+        max_bytes: Size cap of the directory. `None` disables eviction.
+        memory_items: Number of images kept in memory per process. `0` disables the in-memory cache.
+        evict_every: Number of writes between two checks of the directory size.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, memory_items=0, evict_every=100):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_items = memory_items
+        self.evict_every = evict_every
+        self._memory = OrderedDict()
+        self._num_writes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(path, *params):
+        """Returns the cache key of a local file and its processing parameters, or `None` if it can't be cached (e.g. URLs)."""
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except (OSError, TypeError, ValueError):
+            return None
+        key = "|".join(str(v) for v in [os.path.abspath(path), mtime, *params])
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def get(self, key):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return Image.fromarray(self._memory[key])
+
+        path = self._path(key)
+        try:
+            array = np.load(path)
+            # The mtime is the recency used for eviction.
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        self._remember(key, array)
+        return Image.fromarray(array)
+
+    def put(self, key, image):
+        array = np.asarray(image.convert("RGB"), dtype=np.uint8)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+        self._remember(key, array)
+
+        self._num_writes += 1
+        if self.max_bytes is not None and self._num_writes % self.evict_every == 0:
+            self.evict()
+
+    def _remember(self, key, array):
+        if self.memory_items <= 0:
+            return
+        self._memory[key] = array
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def evict(self):
+        """Removes the least recently used files until the directory is under `max_bytes`."""
+        with open(os.path.join(self.cache_dir, ".evict.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is already evicting.
+                return
+
+            entries = []
+            total_bytes = 0
+            for subdir in os.scandir(self.cache_dir):
+                if not subdir.is_dir():
+                    continue
+                for entry in os.scandir(subdir.path):
+                    if not entry.name.endswith(".npy"):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total_bytes += stat.st_size
+
+            if total_bytes <= self.max_bytes:
+                return
+            for _, size, path in sorted(entries):
+                for file_path in [path, path[:-len(".npy")] + ".json"]:
+                    try:
+                        os.remove(file_path)
+                    except FileNotFoundError:
+                        pass
+                total_bytes -= size
+                if total_bytes <= self.max_bytes:
+                    break
+
+
+class VideoFrameCache(ImageCache):
+    """On-disk cache of the sampled and resized frames of videos.
+
+    The frames are stored as a `[T, C, H, W]` uint8 `.npy` file that is read through a memory map, and the
+    `video_kwargs` of `qwen_vl_utils` (the sampling fps) go to a small `.json` file next to it. The `.json`
+    is written first, so a visible `.npy` always has its metadata. Eviction works like in `ImageCache`.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, evict_every=100):
+        super(VideoFrameCache, self).__init__(cache_dir, max_bytes=max_bytes, memory_items=0, evict_every=evict_every)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path[:-len(".npy")] + ".json", "r") as f:
+                video_kwargs = json.load(f)
+            frames = np.load(path, mmap_mode="r")
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return torch.from_numpy(np.ascontiguousarray(frames)).float(), video_kwargs
+
+    def put(self, key, frames, video_kwargs):
+        array = frames.round().clamp(0, 255).to(torch.uint8).numpy()
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(video_kwargs, f)
+        os.replace(tmp_path, path[:-len(".npy")] + ".json")
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, path)
+
+        self._num_writes += 1
+        if self.max_bytes is not None and self._num_writes % self.evict_every == 0:
+            self.evict()
+
+
+def build_image_cache(data_args):
+    """Builds the image cache from `DataArguments`, or returns `None` if it is disabled."""
+    if data_args.image_cache_dir is None:
+        return None
+    max_bytes = int(data_args.image_cache_max_gb * 1024 ** 3) if data_args.image_cache_max_gb is not None else None
+    return ImageCache(
+        data_args.image_cache_dir,
+        max_bytes=max_bytes,
+        memory_items=data_args.image_cache_memory_items,
+    )
+
+
+def build_video_cache(data_args):
+    """Builds the video frame cache from `DataArguments`, or returns `None` if it is disabled."""
+    if data_args.video_cache_dir is None:
+        return None
+    max_bytes = int(data_args.video_cache_max_gb * 1024 ** 3) if data_args.video_cache_max_gb is not None else None
+    return VideoFrameCache(data_args.video_cache_dir, max_bytes=max_bytes)
@@ -0,0 +1,130 @@
+import dataclasses
+import itertools
+import os
+import random
+
+import yaml
+
+from .streaming import StreamingDataset, is_streaming_data_path
+
+
+def is_mixture_data_path(data_path):
+    return isinstance(data_path, str) and data_path.endswith((".yaml", ".yml"))
+
+
+def load_mixture_config(config_path):
+    """
+    Reads a data mixture file. It lists the sources, each with a `.jsonl` `data_path`, a `weight` and optionally
+    its own `image_folder` and `name`:
+
+        sources:
+          - name: llava
+            data_path: /data/llava.jsonl
+            image_folder: /data/llava/images
+            weight: 3
+          - name: docvqa
+            data_path: /data/docvqa.jsonl
+            image_folder: /data/docvqa/images
+            weight: 1
+    """
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+
+    sources = config.get("sources") if isinstance(config, dict) else None
+    if not sources:
+        raise ValueError(f"{config_path} must list the data `sources`.")
+    for i, source in enumerate(sources):
+        if not is_streaming_data_path(source.get("data_path")):
+            raise ValueError(f"Source {i} of {config_path}: `data_path` must be a `.jsonl` file, got {source.get('data_path')}.")
+        if float(source.get("weight", 1.0)) <= 0:
+            raise ValueError(f"Source {i} of {config_path}: `weight` must be positive.")
+        source.setdefault("name", os.path.splitext(os.path.basename(source["data_path"]))[0])
+        source.setdefault("weight", 1.0)
+    return config
+
+
+class MixtureDataset(StreamingDataset):
+    """Streams several JSONL sources and interleaves them by weighted sampling.
+
+    Every source is streamed like a `StreamingDataset` (sharded per rank and worker, shuffled through a
+    buffer) and processed by its own map-style dataset, so each source can have its own `image_folder`.
+    Each sample is drawn from source `i` with probability `weights[i] / sum(weights)`. A source that runs
+    out starts its next epoch, so the mixture holds for the whole run. Samples are tagged with the index
+    of their source in `source`.
+
+    Args:
+        sources: `StreamingDataset` of every source.
+        weights: Sampling weight of every source.
+        names: Name of every source, used in the logs.
+        seed: Seed of the source choice. It is combined with the epoch and the shard id.
+        mini_repeat_count: Number of times each sample is yielded in a row (used for GRPO generations).
+    """
+
+    def __init__(self, sources, weights, names, seed=42, mini_repeat_count=1):
+        super(MixtureDataset, self).__init__(
+            data_path=None, dataset=None, shuffle_buffer_size=0, seed=seed, mini_repeat_count=mini_repeat_count
+        )
+        self.sources = sources
+        self.weights = [float(weight) for weight in weights]
+        self.names = names
+
+    def set_rank(self, rank, world_size):
+        super(MixtureDataset, self).set_rank(rank, world_size)
+        for source in self.sources:
+            source.set_rank(rank, world_size)
+
+    def _iter_source_records(self):
+        """Yields `(source index, record)` pairs forever, unless every source is empty."""
+        shard_id, _ = self._shard_info()
+        rng = random.Random((self.seed * 1000003 + self.epoch) * 1000003 + shard_id)
+        source_epochs = [self.epoch] * len(self.sources)
+        iterators = [source.iter_shuffled_records(self.epoch) for source in self.sources]
+        weights = list(self.weights)
+        source_ids = list(range(len(self.sources)))
+
+        while sum(weights) > 0:
+            i = rng.choices(source_ids, weights=weights)[0]
+            record = next(iterators[i], None)
+            if record is None:
+                source_epochs[i] += 1
+                iterators[i] = self.sources[i].iter_shuffled_records(source_epochs[i])
+                record = next(iterators[i], None)
+                if record is None:
+                    # This shard of the source is empty.
+                    weights[i] = 0.0
+                    continue
+            yield i, record
+
+    def _iter_samples(self, num_skip):
+        # Skipped records are only parsed and shuffled, so the source choices are the same as without resuming.
+        for i, record in itertools.islice(self._iter_source_records(), num_skip, None):
+            data_dict = self.sources[i].dataset.process_sample(record)
+            data_dict["source"] = i
+            for _ in range(self.mini_repeat_count):
+                yield data_dict
+
+
+def build_mixture_dataset(data_args, make_dataset):
+    """
+    Builds a `MixtureDataset` from the mixture file in `data_args.data_path`.
+    `make_dataset(source_data_args)` builds the map-style dataset that processes the samples of one source.
+    """
+    config = load_mixture_config(data_args.data_path)
+    sources = []
+    for source in config["sources"]:
+        source_data_args = dataclasses.replace(
+            data_args,
+            data_path=source["data_path"],
+            image_folder=source.get("image_folder", data_args.image_folder),
+        )
+        sources.append(StreamingDataset(
+            data_path=source["data_path"],
+            dataset=make_dataset(source_data_args),
+            shuffle_buffer_size=data_args.shuffle_buffer_size,
+        ))
+    return MixtureDataset(
+        sources,
+        weights=[source["weight"] for source in config["sources"]],
+        names=[source["name"] for source in config["sources"]],
+        seed=config.get("seed", 42),
+    )
@@ -0,0 +1,110 @@
+from dataclasses import dataclass, field
+from multiprocessing import Pool
+
+import ujson as json
+from tqdm import tqdm
+from transformers import HfArgumentParser
+
+from src.params import DataArguments
+
+from .data_store import SampleStore
+from .data_utils import get_image_info, get_video_info
+from .image_cache import build_image_cache, build_video_cache
+from .remote_fetch import is_remote_path
+from .staging import resolve_local_path
+
+
+@dataclass
+class PrepopulateArguments:
+    num_workers: int = field(default=16, metadata={"help": "Number of processes decoding in parallel."})
+
+
+_worker_state = {}
+
+
+def _init_worker(data_args):
+    _worker_state["data_args"] = data_args
+    _worker_state["image_cache"] = build_image_cache(data_args)
+    _worker_state["video_cache"] = build_video_cache(data_args)
+
+
+def _fill(item):
+    kind, path = item
+    data_args = _worker_state["data_args"]
+    try:
+        if kind == "video":
+            get_video_info(
+                path, data_args.video_min_pixels, data_args.video_max_pixels,
+                data_args.video_resized_width, data_args.video_resized_height, data_args.fps,
+                cache=_worker_state["video_cache"],
+            )
+        else:
+            get_image_info(
+                path, data_args.image_min_pixels, data_args.image_max_pixels,
+                data_args.image_resized_width, data_args.image_resized_height,
+                cache=_worker_state["image_cache"], decoder=data_args.image_decoder,
+            )
+    except Exception as e:
+        return f"{path}: {e}"
+    return None
+
+
+def _iter_records(data_path):
+    if data_path.endswith(".jsonl"):
+        with open(data_path, "r") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        yield from SampleStore.from_json(data_path)
+
+
+def collect_media(data_args):
+    """Unique (kind, path) pairs of the dataset, resolved against `image_folder` like the datasets do."""
+    kinds = []
+    if data_args.video_cache_dir is not None:
+        kinds.append("video")
+    if data_args.image_cache_dir is not None:
+        kinds.append("image")
+
+    items = {}
+    for record in _iter_records(data_args.data_path):
+        for kind in kinds:
+            files = record.get(kind)
+            if files is None:
+                continue
+            if isinstance(files, str):
+                files = [files]
+            for file in files:
+                if not is_remote_path(file):
+                    file = resolve_local_path(file, data_args.image_folder)
+                items[(kind, file)] = None
+    return list(items)
+
+
+def prepopulate_cache():
+    """Decodes every video (and image) of `data_path` once, so the training run starts with a warm cache.
+
+    It takes the same data arguments as the training scripts, e.g.
+    `python -m src.dataset.prepopulate_cache --data_path train.json --image_folder videos/ --video_cache_dir /nvme/frames --fps 1.0`
+    """
+    parser = HfArgumentParser((DataArguments, PrepopulateArguments))
+    data_args, prepopulate_args = parser.parse_args_into_dataclasses()
+
+    if data_args.video_cache_dir is None and data_args.image_cache_dir is None:
+        raise ValueError("Set `video_cache_dir` and/or `image_cache_dir`.")
+
+    items = collect_media(data_args)
+    failures = []
+    with Pool(prepopulate_args.num_workers, initializer=_init_worker, initargs=(data_args,)) as pool:
+        for failure in tqdm(pool.imap_unordered(_fill, items, chunksize=4), total=len(items), desc="Filling cache"):
+            if failure is not None:
+                failures.append(failure)
+
+    print(f"Cached {len(items) - len(failures)} of {len(items)} files.")
+    for failure in failures:
+        print(f"Failed: {failure}")
+
+
+if __name__ == "__main__":
+    prepopulate_cache()
@@ -0,0 +1,296 @@
+import os
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+import ujson as json
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from transformers import AutoProcessor, HfArgumentParser
+
+from src.params import DataArguments, ModelArguments
+
+# Column layout of the per-shard `index.npy`.
+# Offsets are in elements (tokens / pixel rows / grid rows) of the matching `.bin` file.
+INDEX_COLUMNS = ["token_offset", "num_tokens", "pixel_offset", "num_pixel_rows", "grid_offset", "num_grid_rows", "modality"]
+MODALITY_TEXT = 0
+MODALITY_IMAGE = 1
+MODALITY_VIDEO = 2
+
+PIXEL_DTYPES = {
+    "float32": (torch.float32, np.float32),
+    # numpy has no bfloat16, so the raw bits are stored as int16.
+    "bfloat16": (torch.bfloat16, np.int16),
+}
+
+
+@dataclass
+class PreprocessArguments:
+    output_dir: str = field(default=None, metadata={"help": "Directory to write the preprocessed shards to."})
+    shard_size: int = field(default=10000, metadata={"help": "Number of samples per shard."})
+    num_workers: int = field(default=8, metadata={"help": "Number of dataloader workers used for preprocessing."})
+    pixel_dtype: str = field(
+        default="float32",
+        metadata={"help": "Storage dtype of `pixel_values`. `bfloat16` halves the size and is lossless for bf16 training."}
+    )
+    max_seq_length: Optional[int] = field(
+        default=32768,
+        metadata={"help": "Truncates the samples to this many tokens. Must match the `max_seq_length` of the training script."}
+    )
+
+
+def _pixel_to_numpy(pixel_values, pixel_dtype):
+    torch_dtype, np_dtype = PIXEL_DTYPES[pixel_dtype]
+    pixel_values = pixel_values.to(torch_dtype).contiguous()
+    if torch_dtype == torch.bfloat16:
+        pixel_values = pixel_values.view(torch.int16)
+    return pixel_values.numpy().astype(np_dtype, copy=False)
+
+
+class SFTShardWriter(object):
+    """Writes processed SFT samples into flat binary shard files with an offset index."""
+
+    def __init__(self, output_dir, shard_size=10000, pixel_dtype="float32"):
+        if pixel_dtype not in PIXEL_DTYPES:
+            raise ValueError(f"Unsupported pixel_dtype `{pixel_dtype}`. Choose from {list(PIXEL_DTYPES)}.")
+        self.output_dir = output_dir
+        self.shard_size = shard_size
+        self.pixel_dtype = pixel_dtype
+        self.shards = []
+        self.num_samples = 0
+        self.pixel_dim = None
+        self._files = None
+        os.makedirs(output_dir, exist_ok=True)
+
+    def _open_shard(self):
+        name = f"shard-{len(self.shards):05d}"
+        shard_dir = os.path.join(self.output_dir, name)
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shards.append({"name": name, "num_samples": 0})
+        self._files = {
+            key: open(os.path.join(shard_dir, f"{key}.bin"), "wb")
+            for key in ["input_ids", "labels", "pixel_values", "grid_thw", "second_per_grid_ts"]
+        }
+        self._index = []
+        self._offsets = dict(tokens=0, pixels=0, grids=0)
+
+    def _close_shard(self):
+        if self._files is None:
+            return
+        for f in self._files.values():
+            f.close()
+        shard_dir = os.path.join(self.output_dir, self.shards[-1]["name"])
+        np.save(os.path.join(shard_dir, "index.npy"), np.asarray(self._index, dtype=np.int64).reshape(-1, len(INDEX_COLUMNS)))
+        self._files = None
+
+    def write(self, data_dict: Dict[str, torch.Tensor]):
+        if self._files is None or self.shards[-1]["num_samples"] >= self.shard_size:
+            self._close_shard()
+            self._open_shard()
+
+        input_ids = data_dict["input_ids"].to(torch.int32).numpy()
+        labels = data_dict["labels"].to(torch.int32).numpy()
+        self._files["input_ids"].write(input_ids.tobytes())
+        self._files["labels"].write(labels.tobytes())
+
+        if "pixel_values" in data_dict:
+            modality, pixel_key, grid_key = MODALITY_IMAGE, "pixel_values", "image_grid_thw"
+        elif "pixel_values_videos" in data_dict:
+            modality, pixel_key, grid_key = MODALITY_VIDEO, "pixel_values_videos", "video_grid_thw"
+        else:
+            modality, pixel_key, grid_key = MODALITY_TEXT, None, None
+
+        num_pixel_rows = 0
+        num_grid_rows = 0
+        if pixel_key is not None:
+            pixel_values = data_dict[pixel_key]
+            if self.pixel_dim is None:
+                self.pixel_dim = pixel_values.shape[1]
+            elif self.pixel_dim != pixel_values.shape[1]:
+                raise ValueError(f"Inconsistent pixel dim: expected {self.pixel_dim}, got {pixel_values.shape[1]}")
+            grid_thw = data_dict[grid_key].to(torch.int64).numpy()
+            self._files["pixel_values"].write(_pixel_to_numpy(pixel_values, self.pixel_dtype).tobytes())
+            self._files["grid_thw"].write(grid_thw.tobytes())
+            second_per_grid_ts = data_dict.get("second_per_grid_ts")
+            if second_per_grid_ts is None:
+                second_per_grid_ts = [0.0] * grid_thw.shape[0]
+            self._files["second_per_grid_ts"].write(
+                np.asarray([float(s) for s in second_per_grid_ts], dtype=np.float32).tobytes()
+            )
+            num_pixel_rows = pixel_values.shape[0]
+            num_grid_rows = grid_thw.shape[0]
+
+        self._index.append([
+            self._offsets["tokens"], len(input_ids),
+            self._offsets["pixels"], num_pixel_rows,
+            self._offsets["grids"], num_grid_rows,
+            modality,
+        ])
+        self._offsets["tokens"] += len(input_ids)
+        self._offsets["pixels"] += num_pixel_rows
+        self._offsets["grids"] += num_grid_rows
+        self.shards[-1]["num_samples"] += 1
+        self.num_samples += 1
+
+    def close(self, extra_meta: Optional[dict] = None):
+        self._close_shard()
+        meta = {
+            "num_samples": self.num_samples,
+            "shards": self.shards,
+            "pixel_dtype": self.pixel_dtype,
+            "pixel_dim": self.pixel_dim,
+            "index_columns": INDEX_COLUMNS,
+        }
+        if extra_meta:
+            meta.update(extra_meta)
+        with open(os.path.join(self.output_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+
+class SFTShardReader(object):
+    """Random access to shards written by `SFTShardWriter`.
+
+    Every file is opened as a read-only memmap, so forked dataloader workers share the page cache
+    instead of holding private copies.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.path = path
+        self.pixel_dim = self.meta["pixel_dim"]
+        self.pixel_torch_dtype, self.pixel_np_dtype = PIXEL_DTYPES[self.meta["pixel_dtype"]]
+
+        self.shards = []
+        num_samples = []
+        for shard in self.meta["shards"]:
+            shard_dir = os.path.join(path, shard["name"])
+            self.shards.append(dict(
+                index=np.load(os.path.join(shard_dir, "index.npy"), mmap_mode="r"),
+                input_ids=self._memmap(shard_dir, "input_ids", np.int32),
+                labels=self._memmap(shard_dir, "labels", np.int32),
+                pixel_values=self._memmap(shard_dir, "pixel_values", self.pixel_np_dtype),
+                grid_thw=self._memmap(shard_dir, "grid_thw", np.int64),
+                second_per_grid_ts=self._memmap(shard_dir, "second_per_grid_ts", np.float32),
+            ))
+            num_samples.append(shard["num_samples"])
+        self.cumulative_sizes = np.cumsum(num_samples)
+
+    @staticmethod
+    def _memmap(shard_dir, name, dtype):
+        file_path = os.path.join(shard_dir, f"{name}.bin")
+        if os.path.getsize(file_path) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode="r")
+
+    def __len__(self):
+        return int(self.cumulative_sizes[-1]) if len(self.cumulative_sizes) > 0 else 0
+
+    def get_lengths(self):
+        """Exact number of tokens of every sample, read from the shard indexes."""
+        if len(self.shards) == 0:
+            return np.zeros(0, dtype=np.int64)
+        column = INDEX_COLUMNS.index("num_tokens")
+        return np.concatenate([np.asarray(shard["index"][:, column]) for shard in self.shards])
+
+    def get_modalities(self):
+        """Modality (`MODALITY_TEXT`, `MODALITY_IMAGE` or `MODALITY_VIDEO`) of every sample."""
+        if len(self.shards) == 0:
+            return np.zeros(0, dtype=np.int64)
+        column = INDEX_COLUMNS.index("modality")
+        return np.concatenate([np.asarray(shard["index"][:, column]) for shard in self.shards])
+
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        shard_id = int(np.searchsorted(self.cumulative_sizes, i, side="right"))
+        local_id = i - (int(self.cumulative_sizes[shard_id - 1]) if shard_id > 0 else 0)
+        shard = self.shards[shard_id]
+        token_offset, num_tokens, pixel_offset, num_pixel_rows, grid_offset, num_grid_rows, modality = shard["index"][local_id].tolist()
+
+        input_ids = torch.from_numpy(np.array(shard["input_ids"][token_offset:token_offset + num_tokens])).to(torch.long)
+        labels = torch.from_numpy(np.array(shard["labels"][token_offset:token_offset + num_tokens])).to(torch.long)
+
+        data_dict = dict(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            labels=labels,
+        )
+
+        if modality == MODALITY_TEXT:
+            return data_dict
+
+        pixel_start, pixel_end = pixel_offset * self.pixel_dim, (pixel_offset + num_pixel_rows) * self.pixel_dim
+        pixel_values = torch.from_numpy(np.array(shard["pixel_values"][pixel_start:pixel_end]))
+        if self.pixel_torch_dtype == torch.bfloat16:
+            pixel_values = pixel_values.view(torch.bfloat16)
+        pixel_values = pixel_values.view(num_pixel_rows, self.pixel_dim)
+
+        grid_thw = torch.from_numpy(np.array(shard["grid_thw"][grid_offset * 3:(grid_offset + num_grid_rows) * 3])).view(-1, 3)
+
+        if modality == MODALITY_IMAGE:
+            data_dict["pixel_values"] = pixel_values
+            data_dict["image_grid_thw"] = grid_thw
+        else:
+            data_dict["pixel_values_videos"] = pixel_values
+            data_dict["video_grid_thw"] = grid_thw
+            if "Qwen2.5" in self.meta.get("model_id", ""):
+                second_per_grid_ts = shard["second_per_grid_ts"][grid_offset:grid_offset + num_grid_rows]
+                data_dict["second_per_grid_ts"] = [float(s) for s in second_per_grid_ts]
+
+        return data_dict
+
+
+def _unwrap_single(batch):
+    return batch[0]
+
+
+def preprocess_sft():
+    from .sft_dataset import SupervisedDataset
+
+    parser = HfArgumentParser((ModelArguments, DataArguments, PreprocessArguments))
+    model_args, data_args, preprocess_args = parser.parse_args_into_dataclasses()
+
+    if data_args.preprocessed_path is not None:
+        raise ValueError("`preprocessed_path` must not be set when running the preprocessing itself.")
+    if data_args.vision_preprocess_in_collator or data_args.uint8_pixels:
+        raise ValueError("The shards store processed pixel values, so `vision_preprocess_in_collator` and `uint8_pixels` must be False.")
+
+    processor = AutoProcessor.from_pretrained(model_args.model_id)
+    dataset = SupervisedDataset(
+        data_path=data_args.data_path, processor=processor, data_args=data_args, model_id=model_args.model_id,
+        max_seq_length=preprocess_args.max_seq_length,
+    )
+    if any(record.get("shuffle_turns") for record in dataset.list_data_dict):
+        # The shards would freeze the order of the turns, which the training dataset reshuffles every epoch.
+        raise ValueError("Samples marked with `shuffle_turns` cannot be preprocessed. Train on `data_path` directly instead.")
+    loader = DataLoader(
+        dataset,
+        batch_size=1,
+        shuffle=False,
+        num_workers=preprocess_args.num_workers,
+        collate_fn=_unwrap_single,
+    )
+
+    writer = SFTShardWriter(
+        preprocess_args.output_dir,
+        shard_size=preprocess_args.shard_size,
+        pixel_dtype=preprocess_args.pixel_dtype,
+    )
+    for data_dict in tqdm(loader, total=len(dataset), desc="Preprocessing"):
+        writer.write(data_dict)
+
+    writer.close(extra_meta=dict(
+        model_id=model_args.model_id,
+        data_path=data_args.data_path,
+        image_min_pixels=data_args.image_min_pixels,
+        image_max_pixels=data_args.image_max_pixels,
+        video_min_pixels=data_args.video_min_pixels,
+        video_max_pixels=data_args.video_max_pixels,
+        fps=data_args.fps,
+        max_seq_length=preprocess_args.max_seq_length,
+    ))
+    print(f"Wrote {writer.num_samples} samples in {len(writer.shards)} shards to {preprocess_args.output_dir}")
+
+
+if __name__ == "__main__":
+    preprocess_sft()
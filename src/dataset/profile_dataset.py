@@ -0,0 +1,159 @@
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+import numpy as np
+import ujson as json
+from transformers import AutoConfig, AutoProcessor, HfArgumentParser
+
+from src.params import DataArguments, ModelArguments
+
+from .mixture import is_mixture_data_path
+from .sft_dataset import SupervisedDataset
+from .streaming import is_streaming_data_path
+
+
+PERCENTILES = [50, 90, 95, 99, 99.9, 100]
+
+
+@dataclass
+class ProfileArguments:
+    output_path: str = field(default="dataset_profile.json", metadata={"help": "Where the JSON report is written."})
+    num_workers: int = field(default=16, metadata={"help": "Number of threads reading image and video headers."})
+    num_bins: int = field(default=20, metadata={"help": "Number of histogram bins."})
+    num_worst: int = field(default=50, metadata={"help": "Number of longest samples listed in the report."})
+    max_seq_length: Optional[int] = field(default=32768, metadata={"help": "Samples longer than this are counted as over the limit."})
+    global_batch_size: int = field(default=128, metadata={"help": "Samples per optimizer step, for the step time estimate."})
+    num_gpus: int = field(default=8, metadata={"help": "Number of GPUs, for the step time estimate."})
+    gpu_tflops: float = field(default=989.0, metadata={"help": "Peak dense bf16 TFLOPS of one GPU (989 for H100 SXM)."})
+    mfu: float = field(default=0.4, metadata={"help": "Expected model FLOPs utilization."})
+
+
+def count_parameters(config):
+    """Approximate compute-relevant parameter counts of the language model and the vision tower of a Qwen2-VL / Qwen2.5-VL config."""
+    text_config = getattr(config, "text_config", None) or config
+    hidden = text_config.hidden_size
+    head_dim = hidden // text_config.num_attention_heads
+    kv_dim = text_config.num_key_value_heads * head_dim
+    attention = 2 * hidden * hidden + 2 * hidden * kv_dim
+    mlp = 3 * hidden * text_config.intermediate_size
+    # Only the output projection costs compute, the input embedding is a lookup.
+    llm = text_config.num_hidden_layers * (attention + mlp) + text_config.vocab_size * hidden
+
+    vision_config = config.vision_config
+    # Qwen2-VL calls the width `embed_dim` and uses a plain MLP, Qwen2.5-VL a gated one of `intermediate_size`.
+    embed_dim = getattr(vision_config, "embed_dim", None) or vision_config.hidden_size
+    if getattr(vision_config, "intermediate_size", None) is not None:
+        vision_mlp = 3 * embed_dim * vision_config.intermediate_size
+    else:
+        vision_mlp = 2 * embed_dim * int(embed_dim * vision_config.mlp_ratio)
+    vision = vision_config.depth * (4 * embed_dim * embed_dim + vision_mlp)
+    return {"llm": llm, "vision": vision}
+
+
+def estimate_training_flops(config, token_counts, merge_length):
+    """Training FLOPs (forward and backward) of every sample: 6 * params * tokens plus causal attention."""
+    text_config = getattr(config, "text_config", None) or config
+    params = count_parameters(config)
+    vision_tokens = token_counts["image"] + token_counts["video"]
+    lengths = (token_counts["text"] + vision_tokens).astype(np.float64)
+
+    llm_flops = 6 * params["llm"] * lengths + 6 * text_config.num_hidden_layers * text_config.hidden_size * lengths ** 2
+    # The vision tower runs on the patches before they are merged into tokens.
+    vision_flops = 6 * params["vision"] * vision_tokens.astype(np.float64) * merge_length
+    return llm_flops + vision_flops, params
+
+
+def summarize(values, num_bins):
+    values = np.asarray(values)
+    counts, bin_edges = np.histogram(values, bins=num_bins)
+    return {
+        "mean": float(values.mean()),
+        "min": int(values.min()),
+        "max": int(values.max()),
+        "percentiles": {str(p): float(np.percentile(values, p)) for p in PERCENTILES},
+        "histogram": {"bin_edges": bin_edges.tolist(), "counts": counts.tolist()},
+    }
+
+
+def profile_dataset():
+    """Reports the token and compute cost of every sample of `data_path` before training on it.
+
+    It takes the same model and data arguments as the training scripts, e.g.
+    `python -m src.dataset.profile_dataset --model_id Qwen/Qwen2.5-VL-7B-Instruct --data_path train.json --image_folder images/ --image_max_pixels 1003520`
+    Only image headers and video container metadata are read. The report goes to `output_path` as JSON, and the
+    sample lengths are stored where the token-budget sampler looks for them, so the first training run skips the scan.
+    """
+    parser = HfArgumentParser((ModelArguments, DataArguments, ProfileArguments))
+    model_args, data_args, profile_args = parser.parse_args_into_dataclasses()
+
+    if (
+        is_streaming_data_path(data_args.data_path)
+        or is_mixture_data_path(data_args.data_path)
+        or data_args.preprocessed_path is not None
+    ):
+        raise ValueError("The profiler needs a `.json` `data_path`.")
+
+    processor = AutoProcessor.from_pretrained(model_args.model_id)
+    config = AutoConfig.from_pretrained(model_args.model_id)
+    dataset = SupervisedDataset(data_args.data_path, processor, data_args, model_args.model_id)
+
+    token_counts = dataset.get_token_counts(profile_args.num_workers)
+    lengths = token_counts["text"] + token_counts["image"] + token_counts["video"]
+    length_cache_path = dataset.save_lengths(lengths)
+
+    merge_length = processor.image_processor.merge_size ** 2
+    flops, params = estimate_training_flops(config, token_counts, merge_length)
+    samples_per_second = profile_args.num_gpus * profile_args.gpu_tflops * 1e12 * profile_args.mfu / flops.mean()
+
+    worst = np.argsort(-lengths, kind="stable")[:profile_args.num_worst]
+    worst_samples = []
+    for i in worst.tolist():
+        sources = dataset.list_data_dict[i]
+        worst_samples.append({
+            "index": i,
+            "id": sources.get("id"),
+            "image": sources.get("image"),
+            "video": sources.get("video"),
+            "text_tokens": int(token_counts["text"][i]),
+            "image_tokens": int(token_counts["image"][i]),
+            "video_tokens": int(token_counts["video"][i]),
+            "total_tokens": int(lengths[i]),
+        })
+
+    report = {
+        "data_path": os.path.abspath(data_args.data_path),
+        "model_id": model_args.model_id,
+        "profile_args": asdict(profile_args),
+        "num_samples": len(lengths),
+        "length_cache_path": length_cache_path,
+        "num_over_max_seq_length": int((lengths > profile_args.max_seq_length).sum()) if profile_args.max_seq_length else None,
+        "total_tokens": int(lengths.sum()),
+        "text_tokens": summarize(token_counts["text"], profile_args.num_bins),
+        "image_tokens": summarize(token_counts["image"], profile_args.num_bins),
+        "video_tokens": summarize(token_counts["video"], profile_args.num_bins),
+        "total_sequence_length": summarize(lengths, profile_args.num_bins),
+        "compute": {
+            "llm_parameters": params["llm"],
+            "vision_parameters": params["vision"],
+            "flops_per_epoch": float(flops.sum()),
+            "mean_flops_per_sample": float(flops.mean()),
+            "estimated_step_seconds": profile_args.global_batch_size / samples_per_second,
+            "estimated_epoch_hours": len(lengths) / samples_per_second / 3600,
+        },
+        "worst_samples": worst_samples,
+    }
+
+    with open(profile_args.output_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    sequence = report["total_sequence_length"]["percentiles"]
+    print(f"Profiled {len(lengths)} samples: p50 {sequence['50']:.0f}, p99 {sequence['99']:.0f}, max {sequence['100']:.0f} tokens.")
+    if report["num_over_max_seq_length"]:
+        print(f"{report['num_over_max_seq_length']} samples are longer than max_seq_length={profile_args.max_seq_length}.")
+    print(f"Estimated {report['compute']['estimated_step_seconds']:.2f} s per step, {report['compute']['estimated_epoch_hours']:.2f} h per epoch.")
+    print(f"Report written to {profile_args.output_path}.")
+
+
+if __name__ == "__main__":
+    profile_dataset()
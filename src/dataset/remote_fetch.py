@@ -0,0 +1,206 @@
+import fcntl
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def is_remote_path(path):
+    return isinstance(path, str) and path.startswith(("http://", "https://"))
+
+
+class RemoteFetcher(object):
+    """Downloads remote images and videos into a content-addressed local disk cache.
+
+    Every process keeps one `requests.Session` with a keep-alive connection pool, rebuilt after a fork, so
+    dataloader workers reuse their connections. Downloaded files are stored under the sha256 of their
+    content (`blobs/`), and a small index maps the URL to the blob (`urls/`), so identical files behind
+    different URLs are stored once. Writes are atomic and can be shared between workers and ranks of a node.
+    When `blobs/` grows over `max_bytes`, the least recently used files are removed.
+
+    Args:
+        cache_dir: Directory of the cache.
+        max_bytes: Size cap of the downloaded files. `None` disables eviction.
+        pool_size: Number of keep-alive connections per host and process.
+        timeout: Timeout of one request in seconds.
+        max_retries: Retries of failed requests, with exponential backoff.
+        prefetch_workers: Number of threads used by `prefetch`.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None, pool_size=16, timeout=30, max_retries=3, prefetch_workers=8, evict_every=100):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.prefetch_workers = prefetch_workers
+        self.evict_every = evict_every
+        self._pid = None
+        self._session = None
+        self._executor = None
+        self._in_flight = set()
+        self._lock = threading.Lock()
+        self._num_writes = 0
+        os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+        os.makedirs(os.path.join(cache_dir, "urls"), exist_ok=True)
+
+    def __getstate__(self):
+        # Sessions, threads and locks don't survive pickling into dataloader workers.
+        state = self.__dict__.copy()
+        state.update(_pid=None, _session=None, _executor=None, _in_flight=set(), _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _check_process(self):
+        # Connections and threads can't be shared with a forked process, so every process builds its own.
+        if self._pid == os.getpid():
+            return
+        retry = Retry(total=self.max_retries, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._executor = None
+        self._in_flight = set()
+        self._pid = os.getpid()
+
+    @property
+    def session(self):
+        self._check_process()
+        return self._session
+
+    def _url_index_path(self, url):
+        return os.path.join(self.cache_dir, "urls", hashlib.sha1(url.encode("utf-8")).hexdigest())
+
+    def cached_path(self, url):
+        """Local path of a cached URL, or `None` if it hasn't been downloaded (or was evicted)."""
+        try:
+            with open(self._url_index_path(url), "r") as f:
+                blob_path = os.path.join(self.cache_dir, "blobs", f.read().strip())
+        except OSError:
+            return None
+        if not os.path.exists(blob_path):
+            return None
+        return blob_path
+
+    def fetch(self, url):
+        """Returns a local path with the content of `url`, downloading it on a cache miss."""
+        blob_path = self.cached_path(url)
+        if blob_path is not None:
+            try:
+                # The mtime is the recency used for eviction.
+                os.utime(blob_path)
+            except FileNotFoundError:
+                pass
+            else:
+                return blob_path
+
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        content = response.content
+
+        # Keep the extension, some video readers rely on it.
+        extension = os.path.splitext(urlparse(url).path)[1].lower()
+        blob_name = hashlib.sha256(content).hexdigest() + extension
+        blob_path = os.path.join(self.cache_dir, "blobs", blob_name)
+        self._atomic_write(blob_path, content)
+        self._atomic_write(self._url_index_path(url), blob_name.encode("utf-8"))
+
+        self._num_writes += 1
+        if self.max_bytes is not None and self._num_writes % self.evict_every == 0:
+            self.evict()
+        return blob_path
+
+    @staticmethod
+    def _atomic_write(path, data):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _fetch_quietly(self, url):
+        try:
+            self.fetch(url)
+        except Exception:
+            # The dataset fetches again, and reports the error, when it needs the file.
+            pass
+        finally:
+            with self._lock:
+                self._in_flight.discard(url)
+
+    def prefetch(self, urls):
+        """Starts downloading the URLs that are not cached yet in background threads."""
+        self._check_process()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.prefetch_workers)
+        for url in urls:
+            with self._lock:
+                if url in self._in_flight:
+                    continue
+                self._in_flight.add(url)
+            if self.cached_path(url) is not None:
+                with self._lock:
+                    self._in_flight.discard(url)
+                continue
+            self._executor.submit(self._fetch_quietly, url)
+
+    def evict(self):
+        """Removes the least recently used downloads until `blobs/` is under `max_bytes`."""
+        with open(os.path.join(self.cache_dir, ".evict.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            entries = []
+            total_bytes = 0
+            for entry in os.scandir(os.path.join(self.cache_dir, "blobs")):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_bytes += stat.st_size
+
+            if total_bytes <= self.max_bytes:
+                return
+            # URL index entries of removed blobs are treated as misses by `cached_path`.
+            for _, size, path in sorted(entries):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+                if total_bytes <= self.max_bytes:
+                    break
+
+
+def build_remote_fetcher(data_args):
+    """Builds the remote fetcher from `DataArguments`, or returns `None` if it is disabled."""
+    if data_args.remote_cache_dir is None:
+        return None
+    max_bytes = int(data_args.remote_cache_max_gb * 1024 ** 3) if data_args.remote_cache_max_gb is not None else None
+    return RemoteFetcher(data_args.remote_cache_dir, max_bytes=max_bytes)
+
+
+def get_remote_urls(record):
+    """Remote image and video paths of an annotation record."""
+    urls = []
+    for key in ["image", "video"]:
+        files = record.get(key)
+        if files is None:
+            continue
+        if isinstance(files, str):
+            files = [files]
+        urls.extend(file for file in files if is_remote_path(file))
+    return urls
@@ -0,0 +1,299 @@
+import itertools
+
+import numpy as np
+from torch.utils.data import BatchSampler, DataLoader, DistributedSampler, Sampler
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """Yields variable size batches whose padded token count stays under `max_batch_tokens`.
+
+    The indices are shuffled once and split into groups of `group_size`. Inside a group the samples are
+    sorted by length and greedily cut into batches, so a batch holds samples of similar length. The batches
+    are planned once, and only their order changes between epochs, so `len()` is the same every epoch and
+    the Trainer can compute the number of steps up front. A sample longer than the budget gets its own batch.
+
+    Args:
+        lengths: Estimated number of tokens of every sample.
+        max_batch_tokens: Budget of `batch_size * longest_sample` tokens per batch.
+        num_replicas: Number of processes. Every process gets the same number of batches.
+        rank: Index of the current process.
+        seed: Seed of the sample shuffle and of the per-epoch batch order.
+        shuffle: If False, batches keep the dataset order.
+        group_size: Number of samples sorted together. Larger groups pad less but are less random.
+    """
+
+    def __init__(self, lengths, max_batch_tokens, num_replicas=1, rank=0, seed=42, shuffle=True, group_size=1024):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_batch_tokens = max_batch_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.shuffle = shuffle
+        self.group_size = group_size
+        self.epoch = 0
+        self.batches = self._plan_batches()
+
+    def _plan_batches(self):
+        if self.shuffle:
+            order = np.random.default_rng(self.seed).permutation(len(self.lengths))
+        else:
+            order = np.arange(len(self.lengths))
+
+        batches = []
+        for start in range(0, len(order), self.group_size):
+            group = order[start:start + self.group_size]
+            group = group[np.argsort(-self.lengths[group], kind="stable")]
+            batch, batch_max = [], 0
+            for idx in group.tolist():
+                new_max = max(batch_max, int(self.lengths[idx]))
+                if batch and new_max * (len(batch) + 1) > self.max_batch_tokens:
+                    batches.append(batch)
+                    batch, new_max = [], int(self.lengths[idx])
+                batch.append(idx)
+                batch_max = new_max
+            if batch:
+                batches.append(batch)
+
+        # Every process has to run the same number of steps, so repeat batches to fill the last round.
+        remainder = len(batches) % self.num_replicas
+        if remainder > 0:
+            batches += [batches[i % len(batches)] for i in range(self.num_replicas - remainder)]
+        return batches
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + self.epoch + 1).permutation(len(self.batches))
+        else:
+            order = np.arange(len(self.batches))
+        for i in order[self.rank::self.num_replicas].tolist():
+            yield self.batches[i]
+
+    def __len__(self):
+        return len(self.batches) // self.num_replicas
+
+
+class ModalityGroupedBatchSampler(Sampler):
+    """Yields batches that only hold samples of one modality and one size class.
+
+    Batches are handed out in blocks of `num_replicas`, one per process, and all batches of a block share
+    the same group. So within a step either every process sees pixels or none does, and text-only steps
+    can skip the dummy vision forward on every process at once. Batches are reshuffled inside their group
+    every epoch, while the number of batches stays the same.
+
+    Args:
+        groups: Group id of every sample, e.g. a (modality, size class) pair packed into one integer.
+        batch_size: Number of samples per batch. The last batch of a group may be smaller.
+        num_replicas: Number of processes.
+        rank: Index of the current process.
+        seed: Seed of the shuffles. It is combined with the epoch.
+    """
+
+    def __init__(self, groups, batch_size, num_replicas=1, rank=0, seed=42):
+        self.groups = np.asarray(groups, dtype=np.int64)
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.group_indices = [np.flatnonzero(self.groups == group) for group in np.unique(self.groups)]
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _blocks(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        blocks = []
+        for indices in self.group_indices:
+            indices = rng.permutation(indices).tolist()
+            batches = [indices[i:i + self.batch_size] for i in range(0, len(indices), self.batch_size)]
+            # Repeat batches of the same group so that every block is full.
+            remainder = len(batches) % self.num_replicas
+            if remainder > 0:
+                batches += [batches[i % len(batches)] for i in range(self.num_replicas - remainder)]
+            blocks += [batches[i:i + self.num_replicas] for i in range(0, len(batches), self.num_replicas)]
+        return [blocks[i] for i in rng.permutation(len(blocks)).tolist()]
+
+    def __iter__(self):
+        for block in self._blocks():
+            yield block[self.rank]
+
+    def __len__(self):
+        num_batches = [-(-len(indices) // self.batch_size) for indices in self.group_indices]
+        return sum(-(-n // self.num_replicas) for n in num_batches)
+
+
+def get_modality_groups(modalities, lengths, num_size_classes=4):
+    """
+    Combines the modality and a size class into one group id per sample.
+    Size classes are length quantiles within each modality, so every modality is split the same way.
+    """
+    modalities = np.asarray(modalities, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    size_classes = np.zeros_like(modalities)
+    for modality in np.unique(modalities):
+        mask = modalities == modality
+        edges = np.quantile(lengths[mask], np.linspace(0, 1, num_size_classes + 1)[1:-1])
+        size_classes[mask] = np.searchsorted(edges, lengths[mask], side="right")
+    return modalities * num_size_classes + size_classes
+
+
+class LookaheadSampler(Sampler):
+    """Wraps a sampler and calls `prefetch_fn(indices)` with the samples it is about to yield.
+
+    It runs in the main process, ahead of the dataloader workers, so the files are already local when a
+    worker loads the sample. Works with index samplers and batch samplers. When the batches are sharded
+    across processes after this sampler (by `accelerator.prepare`), only the samples of this process' share
+    are prefetched: position `p` belongs to rank `(p // batch_size) % num_replicas`.
+
+    Args:
+        sampler: The wrapped sampler.
+        prefetch_fn: Called with a list of dataset indices.
+        lookahead: Number of positions to prefetch ahead.
+        num_replicas / rank / batch_size: Sharding applied to the yielded indices later on.
+    """
+
+    def __init__(self, sampler, prefetch_fn, lookahead=256, num_replicas=1, rank=0, batch_size=1):
+        self.sampler = sampler
+        self.prefetch_fn = prefetch_fn
+        self.lookahead = lookahead
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.batch_size = batch_size
+
+    def set_epoch(self, epoch):
+        set_sampler_epoch(self.sampler, epoch)
+
+    def _is_local(self, position):
+        return (position // self.batch_size) % self.num_replicas == self.rank
+
+    def __iter__(self):
+        items = list(self.sampler)
+        step = max(self.lookahead // 2, 1)
+        prefetched_until = 0
+        for position, item in enumerate(items):
+            # Top up the window every `step` positions instead of on every sample.
+            if position >= prefetched_until - step:
+                end = min(position + self.lookahead, len(items))
+                indices = []
+                for p in range(max(prefetched_until, position), end):
+                    if self._is_local(p):
+                        indices.extend(items[p] if isinstance(items[p], (list, tuple)) else [items[p]])
+                if len(indices) > 0:
+                    self.prefetch_fn(indices)
+                prefetched_until = end
+            yield item
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+def set_sampler_epoch(sampler, epoch):
+    """Calls `set_epoch` on the first sampler of a chain of wrapped samplers that has it."""
+    while sampler is not None and not hasattr(sampler, "set_epoch"):
+        sampler = getattr(sampler, "sampler", None)
+    if sampler is not None:
+        sampler.set_epoch(epoch)
+
+
+def find_sampler(sampler, sampler_class):
+    """Returns the first sampler of a chain of wrapped samplers that is a `sampler_class`, or `None`."""
+    while sampler is not None and not isinstance(sampler, sampler_class):
+        sampler = getattr(sampler, "sampler", None)
+    return sampler
+
+
+class ResumableSampler(Sampler):
+    """Wraps a sampler or batch sampler so that its next iteration can start after the first items.
+
+    Used to resume from a checkpoint in the middle of an epoch: only the indices are skipped, so no sample
+    is loaded or decoded to get there. The length is the one of a full epoch, except between `set_epoch` and
+    the start of the shortened iteration. The Trainer reads the number of steps of an epoch right after
+    `set_epoch` and counts the gradient accumulation steps from 0, so with the remaining length the last,
+    possibly partial, accumulation window of the resumed epoch still ends with an optimizer step.
+    """
+
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.num_skip = 0
+        self._in_skipped_epoch = False
+
+    def set_epoch(self, epoch):
+        self._in_skipped_epoch = self.num_skip > 0
+        set_sampler_epoch(self.sampler, epoch)
+
+    def skip(self, num_items):
+        """Skips the first `num_items` items of the next iteration only."""
+        self.num_skip = num_items
+
+    def __iter__(self):
+        num_skip, self.num_skip = self.num_skip, 0
+        self._in_skipped_epoch = False
+        return itertools.islice(iter(self.sampler), num_skip, None)
+
+    def __len__(self):
+        if self._in_skipped_epoch:
+            return max(len(self.sampler) - self.num_skip, 0)
+        return len(self.sampler)
+
+
+class BatchSamplerDataLoader(DataLoader):
+    """DataLoader that forwards `set_epoch` to its batch sampler, so the batch order changes every epoch."""
+
+    def set_epoch(self, epoch):
+        set_sampler_epoch(self.batch_sampler, epoch)
+
+    def skip_batches(self, num_batches):
+        """Starts the next epoch after its first `num_batches` batches, without loading them."""
+        find_sampler(self.batch_sampler, ResumableSampler).skip(num_batches)
+
+
+def build_batch_sampler_dataloader(dataset, batch_sampler, collate_fn, args):
+    """Builds the train dataloader for a batch sampler that already shards the batches per process.
+
+    Like the streaming dataloader it is not passed through `accelerator.prepare`, which would shard the
+    batches a second time. The remote files of the upcoming batches are prefetched if the dataset fetches them.
+    """
+    batch_sampler = with_lookahead(ResumableSampler(batch_sampler), dataset)
+    dataloader_params = {
+        "batch_sampler": batch_sampler,
+        "collate_fn": collate_fn,
+        "num_workers": args.dataloader_num_workers,
+        "pin_memory": args.dataloader_pin_memory,
+        "persistent_workers": args.dataloader_persistent_workers,
+    }
+    if args.dataloader_num_workers > 0:
+        dataloader_params["prefetch_factor"] = args.dataloader_prefetch_factor
+
+    return BatchSamplerDataLoader(dataset, **dataloader_params)
+
+
+def has_prefetch(dataset):
+    return getattr(dataset, "fetcher", None) is not None or getattr(dataset, "stager", None) is not None
+
+
+def with_lookahead(sampler, dataset, **kwargs):
+    """Wraps `sampler` in a `LookaheadSampler` if the dataset fetches remote or stages local files, otherwise returns it as is."""
+    if not has_prefetch(dataset):
+        return sampler
+    return LookaheadSampler(sampler, dataset.prefetch, lookahead=dataset.data_args.prefetch_lookahead, **kwargs)
+
+
+def build_distributed_dataloader(dataset, batch_size, collate_fn, args):
+    """Builds a per-process shuffled train dataloader that prefetches the remote files of upcoming samples.
+
+    The Trainer's default sampler is replaced by `accelerate` with a seedable one, which a wrapping sampler
+    would hide, so the sharding is done here with a `DistributedSampler` instead.
+    """
+    sampler = DistributedSampler(
+        dataset,
+        num_replicas=args.world_size,
+        rank=args.process_index,
+        shuffle=True,
+        seed=args.data_seed if args.data_seed is not None else args.seed,
+        drop_last=args.dataloader_drop_last,
+    )
+    batch_sampler = BatchSampler(sampler, batch_size, drop_last=args.dataloader_drop_last)
+    return build_batch_sampler_dataloader(dataset, batch_sampler, collate_fn, args)
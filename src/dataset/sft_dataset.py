@@ -1,9 +1,10 @@
-import copy
+import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict
+import numpy as np
 import torch
 import transformers
-import ujson as json
 from torch.utils.data import Dataset
 
 from src.params import DataArguments
@@ -11,12 +12,33 @@ from src.constants import (
     IGNORE_INDEX,
     DEFAULT_IM_START_TOKEN,
     DEFAULT_IM_END_TOKEN,
-    DEFAULT_IMAGE_TOKEN,
-    DEFAULT_VIDEO_TOKEN,
     SYSTEM_MESSAGE,
 )
 
-from .data_utils import get_image_info, get_video_info, llava_to_openai, pad_sequence
+from .data_utils import (
+    deduplicate_tensors,
+    estimate_image_tokens,
+    estimate_video_tokens,
+    get_image_max_pixels,
+    get_image_info,
+    get_padded_length,
+    get_rope_index,
+    get_rope_kwargs,
+    get_video_info,
+    llava_to_openai,
+    pad_to_length,
+    VisionPatchifier,
+)
+from .preprocess_sft import MODALITY_IMAGE, MODALITY_TEXT, MODALITY_VIDEO, SFTShardReader
+from .consolidate_qa import shuffle_turns
+from .conversation import ConversationEncoder
+from .data_store import SampleStore
+from .image_cache import build_image_cache, build_video_cache
+from .remote_fetch import build_remote_fetcher, get_remote_urls, is_remote_path
+from .staging import build_stager, get_local_files, resolve_local_file, resolve_local_path
+from .mixture import build_mixture_dataset, is_mixture_data_path
+from .streaming import StreamingDataset, is_streaming_data_path
+from .tar_store import TarShardStore, TarShardStreamingDataset
 
 
 
@@ -30,18 +52,38 @@ class SupervisedDataset(Dataset):
         data_args: DataArguments,
         model_id,
         padding=True,
+        max_seq_length=None,
     ):
         super(SupervisedDataset, self).__init__()
-        if isinstance(data_path, str):
-            list_data_dict = json.load(open(data_path, "r"))
+        # Samples were already tokenized and patchified offline, so we only slice the shards.
+        self.shard_reader = None
+        # Samples and images packed into tar shards, see `src.dataset.tar_store`.
+        self.image_store = TarShardStore(data_args.image_store_path) if data_args.image_store_path is not None else None
+        if data_args.preprocessed_path is not None:
+            self.shard_reader = SFTShardReader(data_args.preprocessed_path)
+            if self.shard_reader.meta.get("max_seq_length") != max_seq_length:
+                raise ValueError(
+                    f"The shards of `{data_args.preprocessed_path}` were truncated to max_seq_length="
+                    f"{self.shard_reader.meta.get('max_seq_length')}, but training uses max_seq_length={max_seq_length}. "
+                    "Rerun the preprocessing with the same `max_seq_length`."
+                )
+            list_data_dict = SampleStore([])
+        elif self.image_store is not None and not isinstance(data_path, list):
+            # Streaming datasets pass their records one at a time, the others index all records of the store.
+            list_data_dict = self.image_store.records()
+            # The length cache is keyed by the store index.
+            data_path = self.image_store.index_path
+        elif isinstance(data_path, str):
+            list_data_dict = SampleStore.from_json(data_path)
         else:
-            list_data_dict = data_path
+            list_data_dict = SampleStore(data_path)
 
         self.model_id = model_id
         self.processor = processor
         self.list_data_dict = list_data_dict
         self.data_args = data_args
         self.padding = padding
+        self.max_seq_length = max_seq_length
         self.image_min_pixel = data_args.image_min_pixels
         self.image_max_pixel = data_args.image_max_pixels
         self.video_min_pixel = data_args.video_min_pixels
@@ -51,41 +93,201 @@ class SupervisedDataset(Dataset):
         self.video_resized_w = data_args.video_resized_width
         self.video_resized_h = data_args.video_resized_height
         self.fps = data_args.fps
+        self.image_cache = build_image_cache(data_args)
+        self.video_cache = build_video_cache(data_args)
+        self.fetcher = build_remote_fetcher(data_args)
+        self.stager = build_stager(data_args)
+        self.encoder = ConversationEncoder(
+            processor, model_id, defer_vision=data_args.vision_preprocess_in_collator or data_args.uint8_pixels
+        )
+        self.data_path = data_path
 
     def __len__(self):
+        if self.shard_reader is not None:
+            return len(self.shard_reader)
         return len(self.list_data_dict)
 
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
-        sources = self.list_data_dict[i]
+        if self.shard_reader is not None:
+            return self.shard_reader[i]
+
+        return self.process_sample(self.list_data_dict[i])
+
+    def _length_cache_path(self):
+        if not isinstance(self.data_path, str):
+            return None
+        stat = os.stat(self.data_path)
+        key = "|".join(str(v) for v in [
+            os.path.abspath(self.data_path), stat.st_mtime_ns, stat.st_size, self.model_id, SYSTEM_MESSAGE,
+            self.image_min_pixel, self.image_max_pixel, self.image_resized_w, self.image_resized_h,
+            self.video_min_pixel, self.video_max_pixel, self.video_resized_w, self.video_resized_h, self.fps,
+            self.data_args.max_sample_tokens,
+        ])
+        cache_dir = self.data_args.length_cache_dir or os.path.dirname(os.path.abspath(self.data_path))
+        return os.path.join(cache_dir, f".lengths-{hashlib.sha1(key.encode()).hexdigest()[:16]}.npy")
+
+    def _image_max_pixels(self, image_files, text_tokens):
+        """`max_pixels` of every image of a sample. With `max_sample_tokens`, the images share the tokens left after the text."""
+        if self.data_args.max_sample_tokens is None or (self.image_resized_w is not None and self.image_resized_h is not None):
+            return [self.image_max_pixel] * len(image_files)
+        return get_image_max_pixels(
+            image_files, self.data_args.max_sample_tokens - text_tokens, self.image_min_pixel, self.image_max_pixel
+        )
+
+    def _vision_tokens(self, sources, text_tokens=0):
+        """Number of image and video tokens of a sample, estimated from the file headers."""
+        if "image" not in sources and "video" not in sources:
+            return 0, 0
+
+        key = "image" if "image" in sources else "video"
+        files = sources[key] if isinstance(sources[key], list) else [sources[key]]
+        if key == "image" and self.image_store is not None:
+            files = [self.image_store.open(sources["shard"], file) for file in files]
+        else:
+            files = [
+                file if is_remote_path(file) else resolve_local_path(file, self.data_args.image_folder)
+                for file in files
+            ]
+
+        if key == "image":
+            max_pixels = self._image_max_pixels(files, text_tokens)
+            return sum(
+                estimate_image_tokens(file, self.image_min_pixel, max_pixel, self.image_resized_w, self.image_resized_h)
+                for file, max_pixel in zip(files, max_pixels)
+            ), 0
+        return 0, sum(
+            estimate_video_tokens(file, self.video_min_pixel, self.video_max_pixel, self.video_resized_w, self.video_resized_h, self.fps)
+            for file in files
+        )
 
-        is_video = False
+    def get_token_counts(self, num_workers=16):
+        """
+        Estimated number of text, image and video tokens of every sample, as a dict of int64 arrays.
+        Text is tokenized in batches and vision tokens are computed from the image headers, so nothing is decoded.
+        """
+        system_message = ""
+        if len(SYSTEM_MESSAGE) > 0:
+            system_message = f"{DEFAULT_IM_START_TOKEN}system\n{SYSTEM_MESSAGE}{DEFAULT_IM_END_TOKEN}\n"
+
+        texts = []
+        num_placeholders = np.zeros(len(self.list_data_dict), dtype=np.int64)
+        for i, sources in enumerate(self.list_data_dict):
+            conversations = llava_to_openai(sources["conversations"], is_video="video" in sources)
+            texts.append(system_message + "".join(
+                f"{DEFAULT_IM_START_TOKEN}{turn['role']}\n{turn['content']}{DEFAULT_IM_END_TOKEN}\n" for turn in conversations
+            ))
+            for key in ["image", "video"]:
+                if key in sources:
+                    num_placeholders[i] = len(sources[key]) if isinstance(sources[key], list) else 1
+
+        text_tokens = np.zeros(len(texts), dtype=np.int64)
+        for start in range(0, len(texts), 1000):
+            input_ids = self.processor.tokenizer(texts[start:start + 1000], add_special_tokens=False)["input_ids"]
+            text_tokens[start:start + len(input_ids)] = [len(ids) for ids in input_ids]
+        # Every placeholder token is replaced by the tokens of its image or video.
+        text_tokens -= num_placeholders
+
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            vision_tokens = np.array(
+                list(executor.map(self._vision_tokens, self.list_data_dict, text_tokens.tolist())), dtype=np.int64
+            ).reshape(-1, 2)
+
+        return {"text": text_tokens, "image": vision_tokens[:, 0], "video": vision_tokens[:, 1]}
+
+    def get_lengths(self, num_workers=16):
+        """
+        Estimated number of tokens of every sample, used by the token-budget batch sampler.
+        The result is cached next to `data_path` (or in `length_cache_dir`).
+        """
+        if self.shard_reader is not None:
+            return self.shard_reader.get_lengths()
+
+        cache_path = self._length_cache_path()
+        if cache_path is not None and os.path.exists(cache_path):
+            return np.load(cache_path)
+
+        token_counts = self.get_token_counts(num_workers)
+        lengths = token_counts["text"] + token_counts["image"] + token_counts["video"]
+        self.save_lengths(lengths)
+        return lengths
+
+    def save_lengths(self, lengths):
+        """Stores the sample lengths where `get_lengths` looks for them."""
+        cache_path = self._length_cache_path()
+        if cache_path is None:
+            return None
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, lengths)
+        os.replace(tmp_path, cache_path)
+        return cache_path
+
+    def get_modalities(self):
+        """Modality of every sample, used to build modality-homogeneous batches."""
+        if self.shard_reader is not None:
+            return self.shard_reader.get_modalities()
+        modalities = np.full(len(self.list_data_dict), MODALITY_TEXT, dtype=np.int64)
+        for i, sources in enumerate(self.list_data_dict):
+            if "image" in sources:
+                modalities[i] = MODALITY_IMAGE
+            elif "video" in sources:
+                modalities[i] = MODALITY_VIDEO
+        return modalities
+
+    def prefetch(self, indices):
+        """Starts downloading the remote files, and staging the local files, of the given samples, see `LookaheadSampler`."""
+        records = [self.list_data_dict[i] for i in indices]
+        if self.fetcher is not None:
+            self.fetcher.prefetch([url for record in records for url in get_remote_urls(record)])
+        if self.stager is not None:
+            self.stager.prefetch([path for record in records for path in get_local_files(record, self.data_args.image_folder)])
+
+    def process_sample(self, sources) -> Dict[str, torch.Tensor]:
+        is_video = "image" not in sources and "video" in sources
+        images = None
+        videos = None
+        video_fps = None
+        conversations = sources['conversations']
+        if sources.get("shuffle_turns"):
+            # Consolidated QA pairs get a new order every time the sample is loaded, i.e. every epoch.
+            conversations = shuffle_turns(conversations)
+        conversation = llava_to_openai(conversations, is_video=is_video)
+        body_ids = self.encoder.tokenize_turns(conversation)
 
-        processor = self.processor
         if "image" in sources:
-            videos = None
-            grid_key = "image_grid_thw"
-            pixel_key = "pixel_values"
-            
             image_files = sources["image"]
             image_folder = self.data_args.image_folder
 
             if isinstance(image_files, str):
                 image_files = [image_files]
 
-            images = []
-            
+            local_files = []
+            key_paths = []
             for image_file in image_files:
-                if not os.path.exists(image_file):
-                    if not image_file.startswith("http"):
-                        image_file = os.path.join(image_folder, image_file)
-                images.append(get_image_info(image_file, self.image_min_pixel, self.image_max_pixel, self.image_resized_w, self.image_resized_h))
+                key_path = None
+                if self.image_store is not None:
+                    # Read from the shard, without touching the image folder.
+                    image_file = self.image_store.open(sources["shard"], image_file)
+                elif is_remote_path(image_file):
+                    if self.fetcher is not None:
+                        image_file = self.fetcher.fetch(image_file)
+                else:
+                    # The caches key on the original file, a staged copy gets a new mtime every time it is copied.
+                    key_path, image_file = resolve_local_file(image_file, image_folder, self.stager)
+                key_paths.append(key_path)
+                local_files.append(image_file)
+
+            text_tokens = self.encoder.num_text_tokens(conversation, body_ids) if self.data_args.max_sample_tokens is not None else 0
+            images = [
+                get_image_info(
+                    image_file, self.image_min_pixel, max_pixel, self.image_resized_w, self.image_resized_h,
+                    cache=self.image_cache, decoder=self.data_args.image_decoder, key_path=key_path,
+                )
+                for image_file, key_path, max_pixel in zip(local_files, key_paths, self._image_max_pixels(local_files, text_tokens))
+            ]
 
         elif "video" in sources:
-            is_video = True
-            images=None
-            grid_key = "video_grid_thw"
-            pixel_key = "pixel_values_videos"
-
             video_files = sources["video"]
             video_folder = self.data_args.image_folder
 
@@ -93,169 +295,261 @@ class SupervisedDataset(Dataset):
                 video_files = [video_files]
 
             videos = []
+            video_fps = []
             for video_file in video_files:
-                if not os.path.exists(video_file):
-                    if not video_file.startswith("http"):
-                        video_file = os.path.join(video_folder, video_file)
-                video_input, video_kwargs = get_video_info(video_file, self.video_min_pixel, self.video_max_pixel, self.video_resized_w, self.video_resized_h, self.data_args.fps)
-                videos.append(video_input)
-        else:
-            grid_key = None
-            pixel_key = None
-            images=None
-            videos=None
-
-        sources = copy.deepcopy(llava_to_openai(sources['conversations'], is_video=is_video))
-
-        all_input_ids = [] 
-        all_labels = []
-        all_pixel_values = []
-        all_image_grid_thw = []
-        all_second_gird = []
-
-        # Qwen2-VL uses a default system message so I've added this.
-        if len(SYSTEM_MESSAGE) > 0:
-            system_message = f"{DEFAULT_IM_START_TOKEN}system\n{SYSTEM_MESSAGE}{DEFAULT_IM_END_TOKEN}\n"
-            system_message_input_ids = processor.tokenizer(system_message, add_special_tokens=False, return_tensors='pt')['input_ids']
-            system_labels = torch.full_like(system_message_input_ids, IGNORE_INDEX) 
-            
-            all_input_ids.append(system_message_input_ids.squeeze(0))
-            all_labels.append(system_labels.squeeze(0))
-
-        for _, j in enumerate(range(0, len(sources), 2)):
-            user_input = sources[j]
-            gpt_response = sources[j + 1]
-
-            user_input = f"{DEFAULT_IM_START_TOKEN}{user_input['role']}\n{user_input['content']}{DEFAULT_IM_END_TOKEN}\n{DEFAULT_IM_START_TOKEN}{gpt_response['role']}\n"
-            gpt_response = f"{gpt_response['content']}{DEFAULT_IM_END_TOKEN}\n"
-            
-            if DEFAULT_IMAGE_TOKEN in user_input:
-                inputs = processor(text=[user_input], images=images, videos=videos, padding=False, do_resize=False, return_tensors='pt')
-                prompt_input_ids = inputs['input_ids']
-                all_pixel_values.append(inputs[pixel_key])
-                all_image_grid_thw.append(inputs[grid_key])
-            
-            elif DEFAULT_VIDEO_TOKEN in user_input:
-                if "Qwen2.5" in self.model_id:
-                    inputs = processor(text=[user_input], images=images, videos=videos, padding=False, do_resize=False, return_tensors='pt', **video_kwargs)
-                    all_second_gird.extend(inputs["second_per_grid_ts"])
+                key_path = None
+                if is_remote_path(video_file):
+                    if self.fetcher is not None:
+                        video_file = self.fetcher.fetch(video_file)
                 else:
-                    inputs = processor(text=[user_input], images=images, videos=videos, padding=False, do_resize=False, return_tensors='pt')
-                prompt_input_ids = inputs['input_ids']
-                all_pixel_values.append(inputs[pixel_key])
-                all_image_grid_thw.append(inputs[grid_key])
-
-            else:
-                prompt_input_ids = processor.tokenizer(user_input, add_special_tokens=False, padding=False, return_tensors='pt')['input_ids']
-
-            response_input_ids = processor.tokenizer(gpt_response, add_special_tokens=False, padding=False, return_tensors='pt')['input_ids']
-
-            input_ids = torch.cat([prompt_input_ids, response_input_ids], dim=1).squeeze(0)
-            labels = torch.cat(
-                [
-                    torch.tensor([IGNORE_INDEX] * len(prompt_input_ids[0])),  
-                    response_input_ids.squeeze(0),
-                ],
-                dim=0,
-            )
+                    key_path, video_file = resolve_local_file(video_file, video_folder, self.stager)
+                video_input, video_kwargs = get_video_info(video_file, self.video_min_pixel, self.video_max_pixel, self.video_resized_w, self.video_resized_h, self.data_args.fps, cache=self.video_cache, key_path=key_path)
+                videos.append(video_input)
+                video_fps.extend(video_kwargs["fps"])
 
-            all_input_ids.append(input_ids)
-            all_labels.append(labels)
-        
         # There is no need for eos or bos tokens in the input_ids
         # Qwen2-VL does not use them
-        input_ids = torch.cat(all_input_ids, dim=0).to(torch.long)
-        labels = torch.cat(all_labels, dim=0).to(torch.long)
-
-        # eos_token_id = processor.tokenizer.convert_tokens_to_ids(DEFAULT_IM_END_TOKEN)
-        # input_ids, labels = truncate_sequence(input_ids, labels, self.max_length, eos_token_id)
-
-        attention_mask = (input_ids > -1000000).to(torch.long)
-
-        data_dict = dict(
-            input_ids=input_ids,
-            attention_mask=attention_mask,
-            labels=labels,
+        return self.encoder.encode(
+            conversation, images=images, videos=videos, video_fps=video_fps, max_length=self.max_seq_length, body_ids=body_ids
         )
 
-        if pixel_key and grid_key:
-            pixel_values = torch.cat(all_pixel_values, dim=0)
-            image_thw = torch.cat(all_image_grid_thw, dim=0)
-            data_dict[pixel_key] = pixel_values
-            data_dict[grid_key] = image_thw
-
-        if len(all_second_gird) > 0:
-            second_gird = all_second_gird
-            data_dict["second_per_grid_ts"] = second_gird
-        
-        return data_dict
-
 class DataCollatorForSupervisedDataset(object):
     """Collate examples for supervised fine-tuning."""
 
-    def __init__(self, pad_token_id: int):
+    def __init__(
+        self,
+        pad_token_id: int,
+        packing=False,
+        max_seq_length=None,
+        rope_kwargs=None,
+        patchifier=None,
+        uint8_pixels=False,
+        pad_to_multiple_of=None,
+        pad_length_buckets=None,
+        dedup_images=False,
+    ):
         self.pad_token_id = pad_token_id
+        self.dedup_images = dedup_images
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.pad_length_buckets = sorted(pad_length_buckets) if pad_length_buckets else None
+        self.patchifier = patchifier
+        self.uint8_pixels = uint8_pixels
+        self.packing = packing
+        self.max_seq_length = max_seq_length
+        self.rope_kwargs = rope_kwargs
 
     def __call__(self, examples):
-        batch_input_ids = []
-        batch_label_ids = []
-        batch_pixel_values = []
-        batch_pixel_video_values = []
-        batch_video_thw = []
-        batch_image_thw = []
-        batch_second_per_grid_ts = []
-        
-        for example in examples:
-            keys = example.keys()
-            if "pixel_values_videos" in keys:
-                batch_pixel_video_values.append(example["pixel_values_videos"])
-                batch_video_thw.append(example["video_grid_thw"])
-            elif "pixel_values" in keys:
-                batch_pixel_values.append(example["pixel_values"])
-                batch_image_thw.append(example["image_grid_thw"])
-            
-            batch_input_ids.append(example["input_ids"])
-            batch_label_ids.append(example["labels"])
-
-            if "second_per_grid_ts" in keys:
-                batch_second_per_grid_ts.extend(example["second_per_grid_ts"])
-        
-        input_ids = pad_sequence(
-            batch_input_ids, padding_side='right', padding_value=self.pad_token_id
-        )
+        if self.packing:
+            data_dict = self.pack(examples)
+        else:
+            data_dict = self.pad(examples)
+        if "truncated" in examples[0]:
+            data_dict["num_truncated"] = torch.tensor(sum(example["truncated"] for example in examples), dtype=torch.long)
+        if "source" in examples[0]:
+            # Source of every sample of a data mixture, counted by the trainer.
+            data_dict["source_ids"] = torch.tensor([example["source"] for example in examples], dtype=torch.long)
+            data_dict["source_num_tokens"] = torch.tensor([len(example["input_ids"]) for example in examples], dtype=torch.long)
+        return data_dict
 
-        attention_mask = input_ids != self.pad_token_id
-        labels = pad_sequence(batch_label_ids, padding_side='right', padding_value=IGNORE_INDEX)
+    def pad(self, examples):
+        """
+        Right-pads the examples to the longest one of the batch, rounded up to `pad_to_multiple_of` or a length bucket.
+        The attention mask comes from the lengths, so a pad token id inside a sequence is still attended to.
+        """
+        lengths = torch.tensor([len(example["input_ids"]) for example in examples], dtype=torch.long)
+        padded_length = get_padded_length(int(lengths.max()), self.pad_to_multiple_of, self.pad_length_buckets)
+        attention_mask = torch.arange(padded_length) < lengths[:, None]
+
+        input_ids, _ = pad_to_length(
+            [example["input_ids"] for example in examples], padded_length, self.pad_token_id, mask=attention_mask
+        )
+        labels, _ = pad_to_length(
+            [example["labels"] for example in examples], padded_length, IGNORE_INDEX, mask=attention_mask
+        )
 
         data_dict = {
             'input_ids': input_ids,
             'labels': labels,
             'attention_mask': attention_mask,
         }
+        if self.rope_kwargs is not None:
+            data_dict.update(self.get_position_ids(examples, padded_length))
+        data_dict.update(self.collate_vision(examples))
 
-        if len(batch_pixel_values) > 0:
-            pixel_values = torch.cat(batch_pixel_values, dim=0)
-            image_thw = torch.cat(batch_image_thw, dim=0)
-            data_dict["pixel_values"] = pixel_values
-            data_dict["image_grid_thw"] = image_thw
+        return data_dict
 
-        if len(batch_pixel_video_values) > 0:
-            pixel_video_values = torch.cat(batch_pixel_video_values, dim=0)
-            video_thw = torch.cat(batch_video_thw, dim=0)
-            data_dict["pixel_values_videos"] = pixel_video_values
-            data_dict["video_grid_thw"] = video_thw
+    def get_position_ids(self, examples, padded_length):
+        """
+        mRoPE position ids and rope deltas of the right-padded batch, as `get_rope_index` of the model returns them.
+        The patched forward uses them instead of computing them on the device.
+        """
+        # Padding gets position 1, like in the model.
+        position_ids = torch.ones((3, len(examples), padded_length), dtype=torch.long)
+        rope_deltas = torch.zeros((len(examples), 1), dtype=torch.long)
+        for i, example in enumerate(examples):
+            length = len(example["input_ids"])
+            position_ids[:, i, :length], rope_delta = get_rope_index(
+                example["input_ids"],
+                image_grid_thw=example.get("image_grid_thw"),
+                video_grid_thw=example.get("video_grid_thw"),
+                second_per_grid_ts=example.get("second_per_grid_ts"),
+                **self.rope_kwargs,
+            )
+            # The model counts the delta from the padded length.
+            rope_deltas[i, 0] = rope_delta - (padded_length - length)
+        return {"position_ids": position_ids, "rope_deltas": rope_deltas}
+
+    def collate_vision(self, examples):
+        """
+        Concatenates the vision inputs of the examples in order.
+        Frames left unprocessed by the dataset (`vision_preprocess_in_collator`) are patchified and
+        normalized here for the whole batch at once, or with `uint8_pixels` packed into a flat uint8 tensor.
+        """
+        data_dict = {}
+        for pixel_key, frames_key, grid_key in [
+            ("pixel_values", "image_frames", "image_grid_thw"),
+            ("pixel_values_videos", "video_frames", "video_grid_thw"),
+        ]:
+            vision_examples = [example for example in examples if grid_key in example]
+            if len(vision_examples) == 0:
+                continue
+            data_dict[grid_key] = torch.cat([example[grid_key] for example in vision_examples], dim=0)
+            dedup = self.dedup_images and pixel_key == "pixel_values"
+            if frames_key in vision_examples[0]:
+                frames_list = [frames for example in vision_examples for frames in example[frames_key]]
+                if dedup:
+                    frames_list = self.deduplicate(frames_list, data_dict)
+                if self.uint8_pixels:
+                    # Patchify and normalize run on the device, in the model forward.
+                    data_dict[pixel_key] = self.patchifier.flatten_frames(frames_list, is_video=frames_key == "video_frames")
+                else:
+                    data_dict[pixel_key] = self.patchifier(frames_list)
+            elif dedup:
+                # Split the patches of every example into its images.
+                pixels_list = [
+                    pixels
+                    for example in vision_examples
+                    for pixels in example[pixel_key].split(example[grid_key].prod(dim=-1).tolist())
+                ]
+                data_dict[pixel_key] = torch.cat(self.deduplicate(pixels_list, data_dict), dim=0)
+            else:
+                data_dict[pixel_key] = torch.cat([example[pixel_key] for example in vision_examples], dim=0)
 
+        batch_second_per_grid_ts = [second for example in examples for second in example.get("second_per_grid_ts", [])]
         if len(batch_second_per_grid_ts) > 0:
             data_dict["second_per_grid_ts"] = batch_second_per_grid_ts
 
         return data_dict
-    
-def make_supervised_data_module(model_id, processor, data_args):
+
+    def deduplicate(self, images, data_dict):
+        """
+        Keeps one copy of every distinct image of the batch. When there are copies, `image_dedup_index` maps
+        every image of `image_grid_thw` to its copy, and the model forward encodes each distinct image once.
+        """
+        unique, index = deduplicate_tensors(images)
+        if len(unique) < len(images):
+            data_dict["image_dedup_index"] = index
+        return unique
+
+    def pack(self, examples):
+        """
+        Packs the examples into rows of at most `max_seq_length` tokens (first-fit decreasing).
+        Instead of an attention mask it returns `cu_seq_lens` over the flattened batch, so the varlen
+        flash-attention path only attends within each sample, and mRoPE position ids that restart per sample.
+        A sample longer than `max_seq_length` gets a row of its own.
+        """
+        lengths = [len(example["input_ids"]) for example in examples]
+        rows = []
+        row_lengths = []
+        for idx in sorted(range(len(examples)), key=lambda i: -lengths[i]):
+            for row_id, row_length in enumerate(row_lengths):
+                if row_length + lengths[idx] <= self.max_seq_length:
+                    rows[row_id].append(idx)
+                    row_lengths[row_id] += lengths[idx]
+                    break
+            else:
+                rows.append([idx])
+                row_lengths.append(lengths[idx])
+
+        row_len = max(row_lengths)
+        input_ids = torch.full((len(rows), row_len), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(rows), row_len), IGNORE_INDEX, dtype=torch.long)
+        position_ids = torch.zeros((3, len(rows), row_len), dtype=torch.long)
+        cu_seq_lens = [0]
+
+        # The vision features are scattered into the image tokens in row-major order,
+        # so the pixel values have to follow the packed order as well.
+        packed_examples = []
+        for row_id, row in enumerate(rows):
+            offset = 0
+            for idx in row:
+                example = examples[idx]
+                length = lengths[idx]
+                input_ids[row_id, offset:offset + length] = example["input_ids"]
+                labels[row_id, offset:offset + length] = example["labels"]
+                # The first token must not be predicted from the end of the previous sample.
+                labels[row_id, offset] = IGNORE_INDEX
+                position_ids[:, row_id, offset:offset + length], _ = get_rope_index(
+                    example["input_ids"],
+                    image_grid_thw=example.get("image_grid_thw"),
+                    video_grid_thw=example.get("video_grid_thw"),
+                    second_per_grid_ts=example.get("second_per_grid_ts"),
+                    **self.rope_kwargs,
+                )
+                offset += length
+                cu_seq_lens.append(cu_seq_lens[-1] + length)
+                packed_examples.append(example)
+            if offset < row_len:
+                # Padding is its own segment, so real tokens never attend to it.
+                position_ids[:, row_id, offset:] = torch.arange(row_len - offset)
+                cu_seq_lens.append(cu_seq_lens[-1] + row_len - offset)
+
+        data_dict = {
+            'input_ids': input_ids,
+            'labels': labels,
+            'position_ids': position_ids,
+            'cu_seq_lens': torch.tensor(cu_seq_lens, dtype=torch.int32),
+        }
+        data_dict.update(self.collate_vision(packed_examples))
+
+        return data_dict
+
+def make_supervised_data_module(model_id, processor, data_args, packing=False, max_seq_length=None):
     """Make dataset and collator for supervised fine-tuning."""
-    sft_dataset = SupervisedDataset(
-        data_path=data_args.data_path, processor=processor, data_args=data_args, model_id=model_id
+    if is_mixture_data_path(data_args.data_path):
+        sft_dataset = build_mixture_dataset(data_args, lambda source_data_args: SupervisedDataset(
+            data_path=[], processor=processor, data_args=source_data_args, model_id=model_id, max_seq_length=max_seq_length
+        ))
+    elif data_args.image_store_path is not None and data_args.stream_store_shards:
+        sft_dataset = TarShardStreamingDataset(
+            SupervisedDataset(
+                data_path=[], processor=processor, data_args=data_args, model_id=model_id, max_seq_length=max_seq_length
+            ),
+        )
+    elif data_args.lazy_preprocess and is_streaming_data_path(data_args.data_path):
+        sft_dataset = StreamingDataset(
+            data_path=data_args.data_path,
+            dataset=SupervisedDataset(
+                data_path=[], processor=processor, data_args=data_args, model_id=model_id, max_seq_length=max_seq_length
+            ),
+            shuffle_buffer_size=data_args.shuffle_buffer_size,
+        )
+    else:
+        sft_dataset = SupervisedDataset(
+            data_path=data_args.data_path, processor=processor, data_args=data_args, model_id=model_id,
+            max_seq_length=max_seq_length,
+        )
+    data_collator = DataCollatorForSupervisedDataset(
+        pad_token_id=processor.tokenizer.pad_token_id,
+        packing=packing,
+        max_seq_length=max_seq_length,
+        rope_kwargs=get_rope_kwargs(model_id) if packing or data_args.precompute_position_ids else None,
+        patchifier=VisionPatchifier.from_image_processor(processor.image_processor),
+        uint8_pixels=data_args.uint8_pixels,
+        pad_to_multiple_of=data_args.pad_to_multiple_of,
+        pad_length_buckets=[int(length) for length in data_args.pad_length_buckets.split(",")] if data_args.pad_length_buckets else None,
+        dedup_images=data_args.dedup_batch_images,
     )
-    data_collator = DataCollatorForSupervisedDataset(pad_token_id=processor.tokenizer.pad_token_id)
 
     return dict(train_dataset=sft_dataset,
                 eval_dataset=None,
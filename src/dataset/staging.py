@@ -0,0 +1,147 @@
+import hashlib
+import os
+import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .remote_fetch import is_remote_path
+
+
+class LocalStager(object):
+    """Copies the image and video files of upcoming samples from shared storage to a node-local directory.
+
+    `prefetch` is called by `LookaheadSampler` from the main process with the samples the sampler is about
+    to yield, and copies their files in background threads. The dataset then reads the local copy, or the
+    original file if the copy isn't there yet. Files are only kept while they are in one of the last
+    `keep_prefetches` prefetch windows: a file that no window references anymore was consumed and is removed.
+    Every rank stages into its own subdirectory, so ranks never remove files another rank still needs.
+
+    Args:
+        staging_dir: Node-local directory, e.g. on NVMe.
+        num_threads: Number of copy threads.
+        keep_prefetches: Number of prefetch windows whose files are kept. With `LookaheadSampler` a window
+            covers half the lookahead, so the default keeps the files of about one lookahead behind the sampler.
+    """
+
+    def __init__(self, staging_dir, num_threads=8, keep_prefetches=4):
+        self.staging_dir = os.path.join(staging_dir, f"rank-{os.environ.get('RANK', '0')}")
+        self.num_threads = num_threads
+        self.keep_prefetches = keep_prefetches
+        self._pid = None
+        self._executor = None
+        self._in_flight = set()
+        self._windows = deque()
+        self._lock = threading.Lock()
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # Threads and locks don't survive pickling into dataloader workers.
+        state = self.__dict__.copy()
+        state.update(_pid=None, _executor=None, _in_flight=set(), _windows=deque(), _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def staged_path(self, path):
+        key = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()
+        # Keep the extension, some video readers rely on it.
+        return os.path.join(self.staging_dir, key[:2], key + os.path.splitext(path)[1].lower())
+
+    def resolve(self, path, folder):
+        """
+        `(original path, path to read)` of a local image or video path of an annotation, see `resolve_local_file`.
+        The staged copies are looked up first, on local disk, so a staged file costs no metadata call on the
+        shared storage. Only a file that isn't staged is resolved against the shared storage.
+        """
+        candidates = [path] if folder is None or os.path.isabs(path) else [path, os.path.join(folder, path)]
+        for candidate in candidates:
+            staged_path = self.staged_path(candidate)
+            if os.path.exists(staged_path):
+                return candidate, staged_path
+        path = resolve_local_path(path, folder)
+        return path, path
+
+    def _copy(self, path):
+        try:
+            staged_path = self.staged_path(path)
+            if not os.path.exists(staged_path):
+                os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+                tmp_path = f"{staged_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                shutil.copyfile(path, tmp_path)
+                os.replace(tmp_path, staged_path)
+        except OSError:
+            # The dataset reads the original file, and reports the error, when it needs it.
+            pass
+        finally:
+            with self._lock:
+                self._in_flight.discard(path)
+
+    def prefetch(self, paths):
+        """Starts copying the files that are not staged yet, and removes the files of expired windows."""
+        if self._pid != os.getpid():
+            self._executor = None
+            self._in_flight = set()
+            self._pid = os.getpid()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+
+        window = set(path for path in paths if isinstance(path, str) and not is_remote_path(path))
+        for path in window:
+            with self._lock:
+                if path in self._in_flight:
+                    continue
+                self._in_flight.add(path)
+            self._executor.submit(self._copy, path)
+
+        self._windows.append(window)
+        if len(self._windows) > self.keep_prefetches:
+            expired = self._windows.popleft()
+            for path in expired.difference(*self._windows):
+                try:
+                    os.remove(self.staged_path(path))
+                except FileNotFoundError:
+                    pass
+
+
+def build_stager(data_args):
+    """Builds the local stager from `DataArguments`, or returns `None` if it is disabled."""
+    if data_args.staging_dir is None:
+        return None
+    return LocalStager(data_args.staging_dir, num_threads=data_args.staging_threads)
+
+
+def resolve_local_path(path, folder):
+    """
+    Path of a local image or video of an annotation: `path` itself if it is absolute or exists relative to the
+    working directory, otherwise `path` under `folder`. The datasets, the stager and the caches all resolve it this way.
+    """
+    if folder is None or os.path.isabs(path) or os.path.exists(path):
+        return path
+    return os.path.join(folder, path)
+
+
+def resolve_local_file(path, folder, stager=None):
+    """
+    `(original path, path to read)` of a local image or video path of an annotation. The caches key on the
+    original path, the file is read from its staged copy if `stager` has one.
+    """
+    if stager is not None:
+        return stager.resolve(path, folder)
+    path = resolve_local_path(path, folder)
+    return path, path
+
+
+def get_local_files(record, folder):
+    """Local image and video paths of an annotation record, resolved with `resolve_local_path`."""
+    files = []
+    for key in ["image", "video"]:
+        paths = record.get(key)
+        if paths is None:
+            continue
+        if isinstance(paths, str):
+            paths = [paths]
+        files.extend(resolve_local_path(path, folder) for path in paths if not is_remote_path(path))
+    return files
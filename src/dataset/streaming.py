@@ -0,0 +1,183 @@
+import itertools
+import os
+import random
+
+import ujson as json
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+
+
+def is_streaming_data_path(data_path):
+    return isinstance(data_path, str) and data_path.endswith(".jsonl")
+
+
+class StreamingDataset(IterableDataset):
+    """Streams a JSONL annotation file instead of loading it into memory.
+
+    The file is split into byte ranges, one per (rank, dataloader worker), so every reader only touches
+    its own part of the file. Records are shuffled through a fixed size buffer and turned into model
+    inputs by `dataset.process_sample`, where `dataset` is one of the map-style dataset classes.
+    The readers hold different numbers of records, so every reader starts its next epoch as soon as its
+    part runs out and the stream never ends: all ranks then run the same number of steps (`max_steps`).
+
+    Args:
+        data_path: Path to a JSONL file with one sample per line.
+        dataset: Map-style dataset whose `process_sample(sources)` builds the model inputs.
+        shuffle_buffer_size: Number of records kept in the shuffle buffer. `0` disables shuffling.
+        seed: Base seed of the shuffle buffer. It is combined with the epoch and the shard id.
+        mini_repeat_count: Number of times each sample is yielded in a row (used for GRPO generations).
+    """
+
+    def __init__(self, data_path, dataset, shuffle_buffer_size=1000, seed=42, mini_repeat_count=1):
+        super(StreamingDataset, self).__init__()
+        self.data_path = data_path
+        self.dataset = dataset
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.mini_repeat_count = mini_repeat_count
+        self.epoch = 0
+        self.rank = int(os.environ.get("RANK", 0))
+        self.world_size = int(os.environ.get("WORLD_SIZE", 1))
+        # (num_batches, batch_size, num_workers) already consumed by the dataloader, see `skip_batches`.
+        self._resume = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def skip_batches(self, num_batches, batch_size, num_workers):
+        """Makes the next iteration start after the first `num_batches` batches of a dataloader with this layout."""
+        self._resume = (num_batches, batch_size, max(num_workers, 1))
+
+    def clear_skip(self):
+        self._resume = None
+
+    def _num_skip_records(self):
+        if self._resume is None:
+            return 0
+        num_batches, batch_size, num_workers = self._resume
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        # The dataloader takes its batches from the workers in turn, and every batch comes from a single worker.
+        worker_batches = max(num_batches - worker_id + num_workers - 1, 0) // num_workers
+        return worker_batches * batch_size // self.mini_repeat_count
+
+    def set_rank(self, rank, world_size):
+        self.rank = rank
+        self.world_size = world_size
+
+    def _shard_info(self):
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        worker_id = worker_info.id if worker_info is not None else 0
+        return self.rank * num_workers + worker_id, self.world_size * num_workers
+
+    def iter_records(self, shard_id, num_shards):
+        """Yields the parsed records whose line starts inside this shard's byte range."""
+        file_size = os.path.getsize(self.data_path)
+        start = file_size * shard_id // num_shards
+        end = file_size * (shard_id + 1) // num_shards
+
+        with open(self.data_path, "rb") as f:
+            if start > 0:
+                # A line belongs to the shard in which it starts, so skip the partial line we landed in.
+                f.seek(start - 1)
+                f.readline()
+            while f.tell() < end:
+                line = f.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    def _shuffled(self, records, rng):
+        if self.shuffle_buffer_size <= 0:
+            yield from records
+            return
+
+        buffer = []
+        for record in records:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(record)
+                continue
+            idx = rng.randrange(len(buffer))
+            yield buffer[idx]
+            buffer[idx] = record
+
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        # Read the skip when the iterator is created, so it only applies to one epoch.
+        num_skip = self._num_skip_records()
+        self._resume = None
+        return self._iter_samples(num_skip)
+
+    def iter_shuffled_records(self, epoch):
+        """Yields the records of this process' and worker's shard in the shuffled order of `epoch`."""
+        shard_id, num_shards = self._shard_info()
+        rng = random.Random((self.seed * 1000003 + epoch) * 1000003 + shard_id)
+        return self._shuffled(self.iter_records(shard_id, num_shards), rng)
+
+    def iter_cycled_records(self):
+        """Yields the shuffled records of this process' and worker's shard forever, one epoch after the other."""
+        epoch = self.epoch
+        while True:
+            num_records = 0
+            for record in self.iter_shuffled_records(epoch):
+                num_records += 1
+                yield record
+            if num_records == 0:
+                shard_id, num_shards = self._shard_info()
+                raise ValueError(
+                    f"Shard {shard_id} of {num_shards} has no records. Use fewer dataloader workers or processes."
+                )
+            epoch += 1
+
+    def _iter_samples(self, num_skip):
+        # Skipped records are only parsed and shuffled, so the shuffle order is the same as without resuming.
+        records = itertools.islice(self.iter_cycled_records(), num_skip, None)
+        for record in records:
+            data_dict = self.dataset.process_sample(record)
+            for _ in range(self.mini_repeat_count):
+                yield data_dict
+
+
+class StreamingDataLoader(DataLoader):
+    """DataLoader that forwards `set_epoch` to its streaming dataset, so the shuffle changes every epoch."""
+
+    def set_epoch(self, epoch):
+        self.dataset.set_epoch(epoch)
+
+    def skip_batches(self, num_batches):
+        """Starts the next epoch after its first `num_batches` batches, without processing their samples."""
+        self.dataset.skip_batches(num_batches, self.batch_size, self.num_workers)
+
+    def __iter__(self):
+        iterator = super().__iter__()
+        # The workers (or the single-process iterator) took their copy of the skip, later epochs start from the beginning.
+        self.dataset.clear_skip()
+        return iterator
+
+
+def build_streaming_dataloader(dataset, batch_size, collate_fn, args):
+    """Builds the train dataloader for a `StreamingDataset`.
+
+    It is intentionally not passed through `accelerator.prepare`, which would either broadcast batches from
+    rank 0 or make every rank read the whole stream. Each rank reads its own byte range instead and the
+    Trainer moves the batches to the device in `_prepare_inputs`.
+    """
+    if args.max_steps <= 0:
+        raise ValueError("Streaming datasets have no length, so `max_steps` must be set.")
+
+    dataset.set_rank(args.process_index, args.world_size)
+    dataloader_params = {
+        "batch_size": batch_size,
+        "collate_fn": collate_fn,
+        "num_workers": args.dataloader_num_workers,
+        "pin_memory": args.dataloader_pin_memory,
+        "persistent_workers": args.dataloader_persistent_workers,
+    }
+    if args.dataloader_num_workers > 0:
+        dataloader_params["prefetch_factor"] = args.dataloader_prefetch_factor
+
+    return StreamingDataLoader(dataset, **dataloader_params)
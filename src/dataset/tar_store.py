@@ -0,0 +1,232 @@
+import io
+import os
+import random
+import tarfile
+from dataclasses import dataclass, field
+
+import ujson as json
+from tqdm import tqdm
+from transformers import HfArgumentParser
+
+from .data_store import SampleStore
+from .streaming import StreamingDataset
+
+STORE_INDEX_NAME = "index.json"
+RECORDS_MEMBER_NAME = "__records__.jsonl"
+
+
+@dataclass
+class PackArguments:
+    data_path: str = field(default=None, metadata={"help": "LLaVA-format JSON (or JSONL) annotation file to pack."})
+    image_folder: str = field(default=None, metadata={"help": "Folder the relative image paths of `data_path` are under."})
+    output_dir: str = field(default=None, metadata={"help": "Directory to write the tar shards and their index to."})
+    max_shard_mb: int = field(default=1024, metadata={"help": "A new shard is started once a shard holds this many MB of images."})
+
+
+def member_name(image_file):
+    """Name of an image inside a shard: its path in the annotation, made relative."""
+    return os.path.normpath(image_file).lstrip("/")
+
+
+def _record_images(record):
+    if "image" not in record:
+        return []
+    return record["image"] if isinstance(record["image"], list) else [record["image"]]
+
+
+def pack_tar_shards(records, image_folder, output_dir, max_shard_bytes=1024 ** 3):
+    """
+    Writes the images of `records` and the records themselves into tar shards of about `max_shard_bytes`.
+    Records of the same image are kept together, so an image is only stored twice when it appears in
+    multi-image records.
+    Each shard ends with its records as JSONL, and `index.json` holds the offset of every member.
+    Videos are not packed and keep their paths.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # Records of the same image are next to each other after sorting, so they land in the same shard.
+    records = sorted(records, key=lambda record: tuple(_record_images(record)))
+
+    shard_names = []
+    shard_records = []
+    shard_members = set()
+    shard_bytes = 0
+    tar = None
+
+    def close_shard():
+        tar.addfile(*_records_member(shard_records))
+        tar.close()
+
+    for record in tqdm(records, desc="Packing"):
+        names = [member_name(image_file) for image_file in _record_images(record)]
+        # A full shard still takes the records whose images it already holds.
+        if tar is None or (shard_bytes >= max_shard_bytes and not all(name in shard_members for name in names)):
+            if tar is not None:
+                close_shard()
+            shard_names.append(f"shard-{len(shard_names):05d}.tar")
+            tar = tarfile.open(os.path.join(output_dir, shard_names[-1]), "w")
+            shard_records, shard_members, shard_bytes = [], set(), 0
+
+        for image_file in _record_images(record):
+            if image_file.startswith("http"):
+                raise ValueError(f"Remote image {image_file} can't be packed, download it first.")
+            name = member_name(image_file)
+            if name in shard_members:
+                continue
+            path = image_file if os.path.exists(image_file) else os.path.join(image_folder, image_file)
+            tar.add(path, arcname=name)
+            shard_members.add(name)
+            shard_bytes += os.path.getsize(path)
+        shard_records.append(dict(record, shard=len(shard_names) - 1))
+
+    if tar is not None:
+        close_shard()
+
+    shards = []
+    for shard_name in shard_names:
+        # The data offsets are only known once the headers are written, so they are read back.
+        with tarfile.open(os.path.join(output_dir, shard_name), "r") as shard:
+            members = {member.name: [member.offset_data, member.size] for member in shard.getmembers() if member.isfile()}
+        shards.append({"path": shard_name, "members": members})
+
+    with open(os.path.join(output_dir, STORE_INDEX_NAME), "w") as f:
+        json.dump({"num_records": len(records), "shards": shards}, f)
+    return shards
+
+
+def _records_member(records):
+    data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+    info = tarfile.TarInfo(RECORDS_MEMBER_NAME)
+    info.size = len(data)
+    return info, io.BytesIO(data)
+
+
+def is_tar_store_path(path):
+    return isinstance(path, str) and os.path.isfile(os.path.join(path, STORE_INDEX_NAME))
+
+
+class TarShardStore(object):
+    """Reads samples and images from the tar shards written by `pack_tar_shards`.
+
+    On a network filesystem, opening and stat-ing hundreds of thousands of small files costs more than reading
+    them. Here every member is read with one `pread` at the offset recorded in `index.json`, from a shard file
+    that every process opens once. A whole shard can also be read with one sequential read (`load_shard`), after
+    which its images are served from memory.
+
+    Args:
+        store_dir: Directory with the shards and `index.json`.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, STORE_INDEX_NAME), "r") as f:
+            self.shards = json.load(f)["shards"]
+        self._pid = None
+        self._files = {}
+        self._loaded = None
+
+    def __getstate__(self):
+        # File descriptors are not shared with the dataloader workers, they open their own.
+        state = self.__dict__.copy()
+        state.update(_pid=None, _files={}, _loaded=None)
+        return state
+
+    def __len__(self):
+        return len(self.shards)
+
+    @property
+    def index_path(self):
+        return os.path.join(self.store_dir, STORE_INDEX_NAME)
+
+    def _fd(self, shard):
+        if self._pid != os.getpid():
+            self._files = {}
+            self._pid = os.getpid()
+        if shard not in self._files:
+            self._files[shard] = os.open(os.path.join(self.store_dir, self.shards[shard]["path"]), os.O_RDONLY)
+        return self._files[shard]
+
+    def read(self, shard, name):
+        """Bytes of a member of a shard."""
+        offset, size = self.shards[shard]["members"][name]
+        if self._loaded is not None and self._loaded[0] == shard:
+            return self._loaded[1][offset:offset + size]
+        return os.pread(self._fd(shard), size, offset)
+
+    def open(self, shard, image_file):
+        """File object of an image of a record, for `PIL.Image.open`."""
+        return io.BytesIO(self.read(shard, member_name(image_file)))
+
+    def load_shard(self, shard):
+        """Reads a whole shard into memory. Its members are read from there until another shard is loaded."""
+        self._loaded = None
+        with open(os.path.join(self.store_dir, self.shards[shard]["path"]), "rb") as f:
+            self._loaded = (shard, memoryview(f.read()))
+
+    def shard_records(self, shard):
+        """Records of one shard, each with its shard id in `shard`."""
+        data = bytes(self.read(shard, RECORDS_MEMBER_NAME)).decode("utf-8")
+        return [json.loads(line) for line in data.split("\n") if line]
+
+    def records(self):
+        """Records of all shards, for random access by index."""
+        return SampleStore([record for shard in range(len(self)) for record in self.shard_records(shard)])
+
+
+class TarShardStreamingDataset(StreamingDataset):
+    """Streams the shards of a `TarShardStore` in a new shuffled order every epoch.
+
+    The shards are split between the ranks and dataloader workers. Every reader loads its shards one at a time
+    with a single sequential read and yields their records in shuffled order, so the images are read from memory.
+    Readers whose shards run out start their next epoch, so unequal shards don't desynchronize the ranks, but
+    every reader needs at least one shard.
+
+    Args:
+        dataset: Map-style dataset reading its images from the store, whose `process_sample(sources)` builds the model inputs.
+        seed: Seed of the shard and record order. It is combined with the epoch and the shard id.
+        mini_repeat_count: Number of times each sample is yielded in a row (used for GRPO generations).
+    """
+
+    def __init__(self, dataset, seed=42, mini_repeat_count=1):
+        super(TarShardStreamingDataset, self).__init__(
+            data_path=None, dataset=dataset, shuffle_buffer_size=0, seed=seed, mini_repeat_count=mini_repeat_count
+        )
+        self.store = dataset.image_store
+
+    def iter_shuffled_records(self, epoch):
+        shard_id, num_shards = self._shard_info()
+        if len(self.store) < num_shards:
+            raise ValueError(
+                f"The image store has {len(self.store)} shards for {num_shards} readers (processes x dataloader workers). "
+                "Pack it into more shards (smaller `max_shard_mb`) or use fewer dataloader workers."
+            )
+        # Every reader shuffles the shards with the same seed, then takes its own part of them.
+        shards = list(range(len(self.store)))
+        random.Random(self.seed * 1000003 + epoch).shuffle(shards)
+        rng = random.Random((self.seed * 1000003 + epoch) * 1000003 + shard_id)
+        for shard in shards[shard_id::num_shards]:
+            self.store.load_shard(shard)
+            records = self.store.shard_records(shard)
+            rng.shuffle(records)
+            yield from records
+
+
+def pack_dataset():
+    """Packs a LLaVA-format dataset into tar shards, e.g.
+    `python -m src.dataset.tar_store --data_path train.json --image_folder images/ --output_dir shards/`
+    """
+    parser = HfArgumentParser(PackArguments)
+    args, = parser.parse_args_into_dataclasses()
+
+    if args.data_path.endswith(".jsonl"):
+        with open(args.data_path, "r") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(args.data_path, "r") as f:
+            records = json.load(f)
+
+    shards = pack_tar_shards(records, args.image_folder, args.output_dir, max_shard_bytes=args.max_shard_mb * 1024 ** 2)
+    print(f"Packed {len(records)} samples into {len(shards)} shards in {args.output_dir}.")
+
+
+if __name__ == "__main__":
+    pack_dataset()
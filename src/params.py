@@ -31,6 +31,10 @@ class TrainingArguments(HFTrainingArguments):
                 "Maximum sequence length. Sequences will be right padded (and possibly truncated)."
         },
     )
+    packing: bool = field(
+        default=False,
+        metadata={"help": "Pack several samples into one row of up to `max_seq_length` tokens. Requires flash-attention-2."}
+    )
 
     double_quant: bool = field(
         default=True,
@@ -57,6 +61,14 @@ class TrainingArguments(HFTrainingArguments):
     lora_namespan_exclude: str = field(default=None, metadata={"help": "List of namespan to exclude for LoRA"})
     num_lora_modules: int = -1
     use_liger: bool = True
+    max_batch_tokens: Optional[int] = field(
+        default=None,
+        metadata={"help": "Form variable size batches with at most this many (padded) tokens instead of a fixed `per_device_train_batch_size`."}
+    )
+    group_by_modality: bool = field(
+        default=False,
+        metadata={"help": "Only batch samples of the same modality and size class, and skip the dummy vision forward on text-only steps."}
+    )
 
 @dataclass
 class DPOArguments(DPOConfigTRL):
@@ -171,16 +183,97 @@ class GRPOArguments(GRPOConfigTRL):
 @dataclass
 class DataArguments:
     data_path: str = field(
-        default=None, metadata={"help": "Path to the training data."}
+        default=None, metadata={"help": "Path to the training data, or a `.yaml` data mixture of weighted `.jsonl` sources (streamed, requires `max_steps`)."}
+    )
+    lazy_preprocess: bool = field(
+        default=False,
+        metadata={"help": "Stream a `.jsonl` data_path per rank and worker instead of loading it at startup. Requires `max_steps`."}
     )
-    lazy_preprocess: bool = False
+    shuffle_buffer_size: int = field(default=1000, metadata={"help": "Shuffle buffer size used when streaming."})
     image_folder: Optional[str] = field(default=None)
     image_min_pixels: Optional[int] = field(default=3136)
     image_max_pixels: Optional[int] = field(default=12845056)
+    max_sample_tokens: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Target number of tokens per sample. The images of a sample share the tokens left after its text, "
+                    "so samples with many images get a lower resolution instead of a longer sequence. "
+                    "`image_min_pixels` and `image_max_pixels` still bound every image."
+        },
+    )
     video_min_pixels: Optional[int] = field(default=100352)
     video_max_pixels: Optional[int] = field(default=602112)
+    image_decoder: str = field(
+        default="pil",
+        metadata={
+            "help": "Image decoder: `pil`, `pil_draft` or `turbojpeg` (needs PyTurboJPEG). The last two decode large JPEGs "
+                    "at a reduced resolution that is still above the resized size. Compare them with `scripts/benchmark_decoders.py`."
+        }
+    )
+    image_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory to cache the decoded and resized images in. Can be shared by all ranks on a node."}
+    )
+    image_cache_max_gb: Optional[float] = field(default=100.0, metadata={"help": "Size cap of `image_cache_dir` in GB."})
+    image_cache_memory_items: int = field(default=0, metadata={"help": "Number of decoded images kept in memory per dataloader worker."})
+    video_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory to cache the sampled and resized video frames in. Fill it ahead of time with `src.dataset.prepopulate_cache`."}
+    )
+    video_cache_max_gb: Optional[float] = field(default=500.0, metadata={"help": "Size cap of `video_cache_dir` in GB."})
+    remote_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory to cache `http(s)://` images and videos in. Enables pooled connections and prefetching."}
+    )
+    remote_cache_max_gb: Optional[float] = field(default=100.0, metadata={"help": "Size cap of `remote_cache_dir` in GB."})
+    staging_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Node-local directory (e.g. on NVMe) the image and video files of the upcoming samples are copied to ahead of time."}
+    )
+    staging_threads: int = field(default=8, metadata={"help": "Number of threads copying files to `staging_dir`."})
+    prefetch_lookahead: int = field(default=256, metadata={"help": "Number of upcoming samples whose remote files are prefetched, or local files staged."})
+    vision_preprocess_in_collator: bool = field(
+        default=False,
+        metadata={"help": "Workers only decode and resize. The collator patchifies and normalizes the whole batch at once."}
+    )
+    uint8_pixels: bool = field(
+        default=False,
+        metadata={"help": "Send the resized images to the device as uint8 and patchify / normalize them in the model forward."}
+    )
+    pad_to_multiple_of: Optional[int] = field(
+        default=None,
+        metadata={"help": "Pad every batch to a multiple of this length, so the kernels and allocators see few distinct shapes."}
+    )
+    pad_length_buckets: Optional[str] = field(
+        default=None,
+        metadata={"help": "Comma-separated lengths to pad the batches to, e.g. `1024,2048,4096,8192`. Longer batches fall back to `pad_to_multiple_of`."}
+    )
+    precompute_position_ids: bool = field(
+        default=False,
+        metadata={"help": "Compute the mRoPE position ids in the collator, on the dataloader workers, instead of in the model forward."}
+    )
+    dedup_batch_images: bool = field(
+        default=False,
+        metadata={"help": "Encode every distinct image of a batch once in the vision tower, even if several samples use it."}
+    )
     image_resized_width: int = field(default=None)
     image_resized_height: int = field(default=None)
     video_resized_width: int = field(default=None)
     video_resized_height: int = field(default=None)
-    fps: float = 1.0
\ No newline at end of file
+    fps: float = 1.0
+    preprocessed_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory of shards written by `src.dataset.preprocess_sft`. When set, samples are read from the shards instead of `data_path`."}
+    )
+    image_store_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory of tar shards written by `src.dataset.tar_store`. When set, samples and images are read from the shards instead of `data_path` and `image_folder`."}
+    )
+    stream_store_shards: bool = field(
+        default=False,
+        metadata={"help": "Stream the shards of `image_store_path` in a new shuffled order every epoch instead of indexing the samples at random."}
+    )
+    length_cache_dir: Optional[str] = field(
+        default=None,
+        metadata={"help": "Directory to cache the estimated sample lengths used by `max_batch_tokens`. Defaults to the directory of `data_path`."}
+    )
\ No newline at end of file
@@ -9,6 +9,7 @@ import transformers.models.qwen2_5_vl.modeling_qwen2_5_vl
 from liger_kernel.transformers.fused_linear_cross_entropy import (
     LigerFusedLinearCrossEntropyLoss
 )
+from src.dataset.data_utils import VisionPatchifier
 
 def replace_qwen_2_with_mixed_modality_forward(use_liger=True):
     if use_liger:
@@ -22,6 +23,92 @@ def replace_qwen2_5_with_mixed_modality_forward(use_liger=True):
     else:
         transformers.models.qwen2_5_vl.modeling_qwen2_5_vl.Qwen2_5_VLForConditionalGeneration.forward = qwen2_5_mixed_modality_forward
 
+# Boundaries of the packed samples in the current batch, read by `packed_flash_attention_forward`.
+# It is kept until the next forward call, because gradient checkpointing recomputes the attention layers
+# during backward, outside of the model forward.
+_packed_sequences = {"cu_seq_lens": None, "max_seq_len": None}
+
+def set_packed_sequences(cu_seq_lens=None):
+    if cu_seq_lens is None:
+        _packed_sequences["cu_seq_lens"] = None
+        _packed_sequences["max_seq_len"] = None
+    else:
+        _packed_sequences["cu_seq_lens"] = cu_seq_lens.to(torch.int32)
+        _packed_sequences["max_seq_len"] = int((cu_seq_lens[1:] - cu_seq_lens[:-1]).max())
+
+def _make_packed_flash_attention_forward(flash_attention_forward):
+    def packed_flash_attention_forward(
+        query_states,
+        key_states,
+        value_states,
+        attention_mask,
+        query_length,
+        is_causal,
+        dropout=0.0,
+        softmax_scale=None,
+        **kwargs,
+    ):
+        cu_seq_lens = _packed_sequences["cu_seq_lens"]
+        if cu_seq_lens is None:
+            return flash_attention_forward(
+                query_states, key_states, value_states, attention_mask, query_length, is_causal,
+                dropout=dropout, softmax_scale=softmax_scale, **kwargs
+            )
+
+        from flash_attn import flash_attn_varlen_func
+
+        batch_size, seq_length, num_heads, head_dim = query_states.shape
+        cu_seq_lens = cu_seq_lens.to(query_states.device)
+        max_seq_len = _packed_sequences["max_seq_len"]
+        attn_output = flash_attn_varlen_func(
+            query_states.reshape(batch_size * seq_length, num_heads, head_dim),
+            key_states.reshape(batch_size * seq_length, key_states.shape[2], head_dim),
+            value_states.reshape(batch_size * seq_length, value_states.shape[2], head_dim),
+            cu_seqlens_q=cu_seq_lens,
+            cu_seqlens_k=cu_seq_lens,
+            max_seqlen_q=max_seq_len,
+            max_seqlen_k=max_seq_len,
+            dropout_p=dropout,
+            softmax_scale=softmax_scale,
+            causal=is_causal,
+        )
+        return attn_output.view(batch_size, seq_length, num_heads, head_dim)
+
+    return packed_flash_attention_forward
+
+def replace_flash_attention_with_packing():
+    """Lets the flash-attention-2 layers of the language model attend only within each packed sample."""
+    for module in [transformers.models.qwen2_vl.modeling_qwen2_vl, transformers.models.qwen2_5_vl.modeling_qwen2_5_vl]:
+        if not hasattr(module, "_flash_attention_forward"):
+            raise ImportError(f"`{module.__name__}` has no `_flash_attention_forward`, sequence packing is not supported.")
+        module._flash_attention_forward = _make_packed_flash_attention_forward(module._flash_attention_forward)
+
+def get_unique_image_grid(image_grid_thw, image_dedup_index=None):
+    """Grids of the distinct images of a deduplicated batch (`dedup_batch_images`), in the order of `pixel_values`."""
+    if image_dedup_index is None:
+        return image_grid_thw
+    unique_grid_thw = image_grid_thw.new_zeros((int(image_dedup_index.max()) + 1, 3))
+    unique_grid_thw[image_dedup_index] = image_grid_thw
+    return unique_grid_thw
+
+def expand_deduplicated_embeds(self, image_embeds, unique_grid_thw, image_dedup_index=None):
+    """
+    Copies the features of every distinct image to all the images that use it.
+    The gradients of the copies are summed into the shared features by autograd.
+    """
+    if image_dedup_index is None:
+        return image_embeds
+    merge_length = self.config.vision_config.spatial_merge_size ** 2
+    image_embeds = image_embeds.split((unique_grid_thw.prod(dim=-1) // merge_length).tolist())
+    return torch.cat([image_embeds[i] for i in image_dedup_index.tolist()], dim=0)
+
+def patchify_uint8_pixels(self, pixels, grid_thw, is_video=False):
+    """Normalizes and patchifies the flat uint8 pixels of `uint8_pixels` batches on the device."""
+    if getattr(self, "_patchifier", None) is None:
+        self._patchifier = VisionPatchifier.from_vision_config(self.config.vision_config)
+    frames_list = self._patchifier.unflatten_frames(pixels, grid_thw, is_video=is_video)
+    return self._patchifier(frames_list, dtype=self.visual.dtype)
+
 def qwen_2_mixed_modality_forward_with_flce(
     self,
     input_ids: torch.LongTensor = None,
@@ -41,6 +128,8 @@ def qwen_2_mixed_modality_forward_with_flce(
     rope_deltas: Optional[torch.LongTensor] = None,
     cache_position: Optional[torch.LongTensor] = None,
     second_per_grid_ts: Optional[torch.Tensor] = None,
+    cu_seq_lens: Optional[torch.Tensor] = None,
+    image_dedup_index: Optional[torch.LongTensor] = None,
 ):
     
     output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
@@ -48,12 +137,14 @@ def qwen_2_mixed_modality_forward_with_flce(
         output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
     )
     return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+    set_packed_sequences(cu_seq_lens)
 
     if inputs_embeds is None:
         inputs_embeds = self.model.embed_tokens(input_ids)
 
         # Pass dummy image and dummy grid to the visual model to avoid deepspeed error.
-        if pixel_values is None and pixel_values_videos is None:
+        # With modality-grouped batches every process skips it on the same step, so it can be left out.
+        if pixel_values is None and pixel_values_videos is None and not getattr(self, "skip_dummy_vision_forward", False):
             # Create dummy pixel_values and grid_thw for avoiding deepspeed error.
             dummy_pixel = torch.zeros(784, 1176).to(self.visual.get_device())
             dummy_grid = torch.tensor([[1, 28, 28]]).to(self.visual.get_device())
@@ -66,8 +157,12 @@ def qwen_2_mixed_modality_forward_with_flce(
             inputs_embeds += image_embeds.mean() * 0
 
         if pixel_values is not None:
+            unique_grid_thw = get_unique_image_grid(image_grid_thw, image_dedup_index)
+            if pixel_values.dtype == torch.uint8:
+                pixel_values = patchify_uint8_pixels(self, pixel_values, unique_grid_thw, is_video=False)
             pixel_values = pixel_values.type(self.visual.get_dtype())
-            image_embeds = self.visual(pixel_values, grid_thw=image_grid_thw)
+            image_embeds = self.visual(pixel_values, grid_thw=unique_grid_thw)
+            image_embeds = expand_deduplicated_embeds(self, image_embeds, unique_grid_thw, image_dedup_index)
             n_image_tokens = (input_ids == self.config.image_token_id).sum().item()
             n_image_features = image_embeds.shape[0]
             if n_image_tokens != n_image_features:
@@ -84,6 +179,8 @@ def qwen_2_mixed_modality_forward_with_flce(
             inputs_embeds = inputs_embeds.masked_scatter(image_mask, image_embeds)
 
         if pixel_values_videos is not None:
+            if pixel_values_videos.dtype == torch.uint8:
+                pixel_values_videos = patchify_uint8_pixels(self, pixel_values_videos, video_grid_thw, is_video=True)
             pixel_values_videos = pixel_values_videos.type(self.visual.get_dtype())
             video_embeds = self.visual(pixel_values_videos, grid_thw=video_grid_thw)
             n_video_tokens = (input_ids == self.config.video_token_id).sum().item()
@@ -104,6 +201,10 @@ def qwen_2_mixed_modality_forward_with_flce(
         if attention_mask is not None:
             attention_mask = attention_mask.to(inputs_embeds.device)
 
+    if position_ids is not None and rope_deltas is not None:
+        # Precomputed by the data collator (`precompute_position_ids`).
+        self.rope_deltas = rope_deltas
+
     # if we get 4D attention mask we cannot calculate rope deltas anymore. TODO @raushan fixme
     if position_ids is None and (attention_mask is None or attention_mask.ndim == 2):
         # calculate RoPE index once per generation in the pre-fill stage only
@@ -198,6 +299,8 @@ def qwen_2_mixed_modality_forward(
     rope_deltas: Optional[torch.LongTensor] = None,
     cache_position: Optional[torch.LongTensor] = None,
     second_per_grid_ts: Optional[torch.Tensor] = None,
+    cu_seq_lens: Optional[torch.Tensor] = None,
+    image_dedup_index: Optional[torch.LongTensor] = None,
 ):
     
     output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
@@ -205,12 +308,14 @@ def qwen_2_mixed_modality_forward(
         output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
     )
     return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+    set_packed_sequences(cu_seq_lens)
 
     if inputs_embeds is None:
         inputs_embeds = self.model.embed_tokens(input_ids)
 
         # Pass dummy image and dummy grid to the visual model to avoid deepspeed error.
-        if pixel_values is None and pixel_values_videos is None:
+        # With modality-grouped batches every process skips it on the same step, so it can be left out.
+        if pixel_values is None and pixel_values_videos is None and not getattr(self, "skip_dummy_vision_forward", False):
             # Create dummy pixel_values and grid_thw for avoiding deepspeed error.
             dummy_pixel = torch.zeros(784, 1176).to(self.visual.get_device())
             dummy_grid = torch.tensor([[1, 28, 28]]).to(self.visual.get_device())
@@ -223,8 +328,12 @@ def qwen_2_mixed_modality_forward(
             inputs_embeds += image_embeds.mean() * 0
 
         if pixel_values is not None:
+            unique_grid_thw = get_unique_image_grid(image_grid_thw, image_dedup_index)
+            if pixel_values.dtype == torch.uint8:
+                pixel_values = patchify_uint8_pixels(self, pixel_values, unique_grid_thw, is_video=False)
             pixel_values = pixel_values.type(self.visual.get_dtype())
-            image_embeds = self.visual(pixel_values, grid_thw=image_grid_thw)
+            image_embeds = self.visual(pixel_values, grid_thw=unique_grid_thw)
+            image_embeds = expand_deduplicated_embeds(self, image_embeds, unique_grid_thw, image_dedup_index)
             n_image_tokens = (input_ids == self.config.image_token_id).sum().item()
             n_image_features = image_embeds.shape[0]
             if n_image_tokens != n_image_features:
@@ -241,6 +350,8 @@ def qwen_2_mixed_modality_forward(
             inputs_embeds = inputs_embeds.masked_scatter(image_mask, image_embeds)
 
         if pixel_values_videos is not None:
+            if pixel_values_videos.dtype == torch.uint8:
+                pixel_values_videos = patchify_uint8_pixels(self, pixel_values_videos, video_grid_thw, is_video=True)
             pixel_values_videos = pixel_values_videos.type(self.visual.get_dtype())
             video_embeds = self.visual(pixel_values_videos, grid_thw=video_grid_thw)
             n_video_tokens = (input_ids == self.config.video_token_id).sum().item()
@@ -261,6 +372,10 @@ def qwen_2_mixed_modality_forward(
         if attention_mask is not None:
             attention_mask = attention_mask.to(inputs_embeds.device)
 
+    if position_ids is not None and rope_deltas is not None:
+        # Precomputed by the data collator (`precompute_position_ids`).
+        self.rope_deltas = rope_deltas
+
     # if we get 4D attention mask we cannot calculate rope deltas anymore. TODO @raushan fixme
     if position_ids is None and (attention_mask is None or attention_mask.ndim == 2):
         # calculate RoPE index once per generation in the pre-fill stage only
@@ -342,6 +457,8 @@ def qwen2_5_mixed_modality_forward_with_flce(
     rope_deltas: Optional[torch.LongTensor] = None,
     cache_position: Optional[torch.LongTensor] = None,
     second_per_grid_ts: Optional[torch.Tensor] = None,
+    cu_seq_lens: Optional[torch.Tensor] = None,
+    image_dedup_index: Optional[torch.LongTensor] = None,
 ) -> Union[Tuple, Qwen2_5_VLCausalLMOutputWithPast]:
 
     output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
@@ -349,12 +466,14 @@ def qwen2_5_mixed_modality_forward_with_flce(
         output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
     )
     return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+    set_packed_sequences(cu_seq_lens)
 
     if inputs_embeds is None:
         inputs_embeds = self.model.embed_tokens(input_ids)
     
         # Pass dummy image and dummy grid to the visual model to avoid deepspeed error.
-        if pixel_values is None and pixel_values_videos is None:
+        # With modality-grouped batches every process skips it on the same step, so it can be left out.
+        if pixel_values is None and pixel_values_videos is None and not getattr(self, "skip_dummy_vision_forward", False):
             # Create dummy pixel_values and grid_thw for avoiding deepspeed error.
             dummy_pixel = torch.zeros(784, 1176).to(self.visual.device)
             dummy_grid = torch.tensor([[1, 28, 28]]).to(self.visual.device)
@@ -367,8 +486,12 @@ def qwen2_5_mixed_modality_forward_with_flce(
             inputs_embeds += image_embeds.mean() * 0
             
         if pixel_values is not None:
+            unique_grid_thw = get_unique_image_grid(image_grid_thw, image_dedup_index)
+            if pixel_values.dtype == torch.uint8:
+                pixel_values = patchify_uint8_pixels(self, pixel_values, unique_grid_thw, is_video=False)
             pixel_values = pixel_values.type(self.visual.dtype)
-            image_embeds = self.visual(pixel_values, grid_thw=image_grid_thw)
+            image_embeds = self.visual(pixel_values, grid_thw=unique_grid_thw)
+            image_embeds = expand_deduplicated_embeds(self, image_embeds, unique_grid_thw, image_dedup_index)
             n_image_tokens = (input_ids == self.config.image_token_id).sum().item()
             n_image_features = image_embeds.shape[0]
             if n_image_tokens != n_image_features:
@@ -385,6 +508,8 @@ def qwen2_5_mixed_modality_forward_with_flce(
             inputs_embeds = inputs_embeds.masked_scatter(image_mask, image_embeds)
 
         if pixel_values_videos is not None:
+            if pixel_values_videos.dtype == torch.uint8:
+                pixel_values_videos = patchify_uint8_pixels(self, pixel_values_videos, video_grid_thw, is_video=True)
             pixel_values_videos = pixel_values_videos.type(self.visual.dtype)
             video_embeds = self.visual(pixel_values_videos, grid_thw=video_grid_thw)
             n_video_tokens = (input_ids == self.config.video_token_id).sum().item()
@@ -405,6 +530,10 @@ def qwen2_5_mixed_modality_forward_with_flce(
         if attention_mask is not None:
             attention_mask = attention_mask.to(inputs_embeds.device)
 
+    if position_ids is not None and rope_deltas is not None:
+        # Precomputed by the data collator (`precompute_position_ids`).
+        self.rope_deltas = rope_deltas
+
     # if we get 4D attention mask we cannot calculate rope deltas anymore. TODO @raushan fixme
     if position_ids is None and (attention_mask is None or attention_mask.ndim == 2):
         # calculate RoPE index once per generation in the pre-fill stage only
@@ -510,6 +639,8 @@ def qwen2_5_mixed_modality_forward(
     rope_deltas: Optional[torch.LongTensor] = None,
     cache_position: Optional[torch.LongTensor] = None,
     second_per_grid_ts: Optional[torch.Tensor] = None,
+    cu_seq_lens: Optional[torch.Tensor] = None,
+    image_dedup_index: Optional[torch.LongTensor] = None,
 ) -> Union[Tuple, Qwen2_5_VLCausalLMOutputWithPast]:
 
     output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
@@ -517,12 +648,14 @@ def qwen2_5_mixed_modality_forward(
         output_hidden_states if output_hidden_states is not None else self.config.output_hidden_states
     )
     return_dict = return_dict if return_dict is not None else self.config.use_return_dict
+    set_packed_sequences(cu_seq_lens)
 
     if inputs_embeds is None:
         inputs_embeds = self.model.embed_tokens(input_ids)
     
         # Pass dummy image and dummy grid to the visual model to avoid deepspeed error.
-        if pixel_values is None and pixel_values_videos is None:
+        # With modality-grouped batches every process skips it on the same step, so it can be left out.
+        if pixel_values is None and pixel_values_videos is None and not getattr(self, "skip_dummy_vision_forward", False):
             # Create dummy pixel_values and grid_thw for avoiding deepspeed error.
             dummy_pixel = torch.zeros(784, 1176).to(self.visual.device)
             dummy_grid = torch.tensor([[1, 28, 28]]).to(self.visual.device)
@@ -535,8 +668,12 @@ def qwen2_5_mixed_modality_forward(
             inputs_embeds += image_embeds.mean() * 0
             
         if pixel_values is not None:
+            unique_grid_thw = get_unique_image_grid(image_grid_thw, image_dedup_index)
+            if pixel_values.dtype == torch.uint8:
+                pixel_values = patchify_uint8_pixels(self, pixel_values, unique_grid_thw, is_video=False)
             pixel_values = pixel_values.type(self.visual.dtype)
-            image_embeds = self.visual(pixel_values, grid_thw=image_grid_thw)
+            image_embeds = self.visual(pixel_values, grid_thw=unique_grid_thw)
+            image_embeds = expand_deduplicated_embeds(self, image_embeds, unique_grid_thw, image_dedup_index)
             n_image_tokens = (input_ids == self.config.image_token_id).sum().item()
             n_image_features = image_embeds.shape[0]
             if n_image_tokens != n_image_features:
@@ -553,6 +690,8 @@ def qwen2_5_mixed_modality_forward(
             inputs_embeds = inputs_embeds.masked_scatter(image_mask, image_embeds)
 
         if pixel_values_videos is not None:
+            if pixel_values_videos.dtype == torch.uint8:
+                pixel_values_videos = patchify_uint8_pixels(self, pixel_values_videos, video_grid_thw, is_video=True)
             pixel_values_videos = pixel_values_videos.type(self.visual.dtype)
             video_embeds = self.visual(pixel_values_videos, grid_thw=video_grid_thw)
             n_video_tokens = (input_ids == self.config.video_token_id).sum().item()
@@ -573,6 +712,10 @@ def qwen2_5_mixed_modality_forward(
         if attention_mask is not None:
             attention_mask = attention_mask.to(inputs_embeds.device)
 
+    if position_ids is not None and rope_deltas is not None:
+        # Precomputed by the data collator (`precompute_position_ids`).
+        self.rope_deltas = rope_deltas
+
     # if we get 4D attention mask we cannot calculate rope deltas anymore. TODO @raushan fixme
     if position_ids is None and (attention_mask is None or attention_mask.ndim == 2):
         # calculate RoPE index once per generation in the pre-fill stage only
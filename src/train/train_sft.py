@@ -9,7 +9,7 @@ from src.params import DataArguments, ModelArguments, TrainingArguments
 from train.train_utils import get_peft_state_maybe_zero_3, get_peft_state_non_lora_maybe_zero_3, safe_save_model_for_hf_trainer
 import pathlib
 from liger_kernel.transformers import apply_liger_kernel_to_qwen2_vl, apply_liger_kernel_to_qwen2_5_vl
-from monkey_patch_forward import replace_qwen2_5_with_mixed_modality_forward, replace_qwen_2_with_mixed_modality_forward
+from monkey_patch_forward import replace_qwen2_5_with_mixed_modality_forward, replace_qwen_2_with_mixed_modality_forward, replace_flash_attention_with_packing
 
 local_rank = None
 
@@ -77,6 +77,11 @@ def train():
         # This is becuase mixed-modality training monkey-patches the model forward method.
         if use_liger:
             apply_liger_kernel_to_qwen2_vl(fused_linear_cross_entropy=False)
+
+    if training_args.packing:
+        if training_args.disable_flash_attn2:
+            raise ValueError("`packing` needs flash-attention-2, so `disable_flash_attn2` must be False.")
+        replace_flash_attention_with_packing()
     
 
     if training_args.lora_enable and not training_args.freeze_llm:
@@ -133,6 +138,8 @@ def train():
         )
 
     model.config.use_cache = False
+    # Text-only steps hit every process at once, so the dummy vision forward isn't needed to keep them in sync.
+    model.skip_dummy_vision_forward = training_args.group_by_modality
     model_to_configure = model
     configure_llm(model_to_configure, training_args)
     configure_vision_tower(model_to_configure, training_args, compute_dtype, training_args.device)
@@ -198,7 +205,9 @@ def train():
 
     data_module = make_supervised_data_module(model_id=model_args.model_id,
                                               processor=processor,
-                                              data_args=data_args)
+                                              data_args=data_args,
+                                              packing=training_args.packing,
+                                              max_seq_length=training_args.max_seq_length)
 
     trainer = QwenSFTTrainer(
         model=model,
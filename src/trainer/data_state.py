@@ -0,0 +1,98 @@
+import json
+import os
+
+from transformers import TrainerCallback
+from transformers.trainer import PREFIX_CHECKPOINT_DIR, logger
+from transformers.trainer_utils import get_last_checkpoint, has_length
+
+DATA_STATE_NAME = "data_state.json"
+
+
+def get_data_position(global_step, num_batches, gradient_accumulation_steps):
+    """Epoch and number of batches consumed in it after `global_step` optimizer steps, counted like the HF Trainer does."""
+    if num_batches is None:
+        # Dataloaders without a length (streaming) run a single epoch of `max_steps` steps.
+        return 0, global_step * gradient_accumulation_steps
+    steps_per_epoch = max(num_batches // gradient_accumulation_steps, 1)
+    return global_step // steps_per_epoch, (global_step % steps_per_epoch) * gradient_accumulation_steps
+
+
+def get_data_layout(args, dataloader):
+    """Everything that decides which samples the dataloader yields. A data state only applies to the same layout."""
+    return {
+        "dataloader": type(dataloader).__name__,
+        "world_size": args.world_size,
+        "num_workers": args.dataloader_num_workers,
+        "per_device_train_batch_size": args.per_device_train_batch_size,
+        "gradient_accumulation_steps": args.gradient_accumulation_steps,
+        "seed": args.seed,
+        "data_seed": args.data_seed,
+        "max_batch_tokens": getattr(args, "max_batch_tokens", None),
+        "group_by_modality": getattr(args, "group_by_modality", False),
+    }
+
+
+class DataStateCallback(TrainerCallback):
+    """Saves the position of the train dataloader in the data next to every checkpoint, see `load_data_state`."""
+
+    def on_save(self, args, state, control, train_dataloader=None, **kwargs):
+        if not args.should_save or train_dataloader is None:
+            return
+        num_batches = len(train_dataloader) if has_length(train_dataloader) else None
+        epoch, batches_in_epoch = get_data_position(state.global_step, num_batches, args.gradient_accumulation_steps)
+        data_state = {
+            "global_step": state.global_step,
+            "epoch": epoch,
+            "batches_in_epoch": batches_in_epoch,
+            "layout": get_data_layout(args, train_dataloader),
+        }
+        checkpoint_dir = os.path.join(args.output_dir, f"{PREFIX_CHECKPOINT_DIR}-{state.global_step}")
+        if os.path.isdir(checkpoint_dir):
+            with open(os.path.join(checkpoint_dir, DATA_STATE_NAME), "w") as f:
+                json.dump(data_state, f, indent=2)
+
+
+def resolve_resume_checkpoint(resume_from_checkpoint, output_dir):
+    """The checkpoint `Trainer.train(resume_from_checkpoint=...)` resumes from, or `None`."""
+    if isinstance(resume_from_checkpoint, bool):
+        return get_last_checkpoint(output_dir) if resume_from_checkpoint else None
+    return resume_from_checkpoint
+
+
+def load_data_state(checkpoint, args, dataloader):
+    """
+    Number of batches of the current epoch that were consumed before `checkpoint`, or `None` if the checkpoint
+    has no data state or it was saved with another data layout. In that case the Trainer skips the batches itself.
+    """
+    if checkpoint is None:
+        return None
+    path = os.path.join(checkpoint, DATA_STATE_NAME)
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        data_state = json.load(f)
+
+    layout = get_data_layout(args, dataloader)
+    if data_state["layout"] != layout:
+        logger.warning(
+            f"The data layout changed since {checkpoint} was saved ({data_state['layout']} -> {layout}), "
+            "falling back to skipping the consumed batches by iterating the dataloader."
+        )
+        return None
+    return data_state["batches_in_epoch"]
+
+
+def restore_data_state(dataloader, checkpoint, args, skip_batches=None):
+    """
+    Makes `dataloader` start after the batches consumed before `checkpoint`, by skipping indices instead of
+    loading the samples. `skip_batches` defaults to `dataloader.skip_batches`; without either nothing is done.
+    """
+    skip_batches = skip_batches or getattr(dataloader, "skip_batches", None)
+    if skip_batches is None:
+        return
+    num_batches = load_data_state(checkpoint, args, dataloader)
+    if num_batches is None:
+        return
+    skip_batches(num_batches)
+    # The batches are already skipped, so the Trainer must not iterate over them a second time.
+    args.ignore_data_skip = True
@@ -11,6 +11,9 @@ from transformers.trainer import (
 from trl import DPOTrainer
 from trl.trainer.utils import pad_to_length, flush_left, selective_log_softmax
 from train.train_utils import get_peft_state_non_lora_maybe_zero_3
+from src.dataset.samplers import build_distributed_dataloader, has_prefetch
+from src.dataset.streaming import StreamingDataset, build_streaming_dataloader
+from src.trainer.data_state import DataStateCallback, resolve_resume_checkpoint, restore_data_state
 
 def maybe_zero_3(param, ignore_status=False, name=None):
     from deepspeed import zero
@@ -31,6 +34,13 @@ class QwenDPOTrainer(DPOTrainer):
     def __init__(self, processing_class, *args, **kwargs):
         super(QwenDPOTrainer, self).__init__(processing_class=processing_class, *args, **kwargs)
         self.processor = processing_class
+        self._resume_checkpoint = None
+        self.add_callback(DataStateCallback())
+
+    def train(self, resume_from_checkpoint=None, *args, **kwargs):
+        # Kept to restore the position in the data once the train dataloader is built.
+        self._resume_checkpoint = resolve_resume_checkpoint(resume_from_checkpoint, self.args.output_dir)
+        return super(QwenDPOTrainer, self).train(resume_from_checkpoint, *args, **kwargs)
 
     def _prepare_dataset(
         self,
@@ -41,6 +51,24 @@ class QwenDPOTrainer(DPOTrainer):
     ):
         return dataset
 
+    def get_train_dataloader(self):
+        dataloader = self._build_train_dataloader()
+        restore_data_state(dataloader, self._resume_checkpoint, self.args)
+        return dataloader
+
+    def _build_train_dataloader(self):
+        if isinstance(self.train_dataset, StreamingDataset):
+            if self.precompute_ref_log_probs:
+                raise ValueError("`precompute_ref_log_probs` needs a full pass over the data and is not supported when streaming.")
+            return build_streaming_dataloader(
+                self.train_dataset, self._train_batch_size, self.data_collator, self.args
+            )
+        # `precompute_ref_log_probs` runs its own pass over the data in the parent's dataloader, where the
+        # remote files are still fetched on demand.
+        if has_prefetch(self.train_dataset) and not self.precompute_ref_log_probs:
+            return build_distributed_dataloader(self.train_dataset, self._train_batch_size, self.data_collator, self.args)
+        return super().get_train_dataloader()
+
     @staticmethod
     def concatenated_inputs(
         batch: dict[str, Union[list, torch.LongTensor]], padding_value: int
@@ -57,6 +57,9 @@ from trl.trainer.utils import (
 )
 
 from src.train.train_utils import get_peft_state_non_lora_maybe_zero_3
+from src.dataset.samplers import ResumableSampler, find_sampler, with_lookahead
+from src.dataset.streaming import StreamingDataset, build_streaming_dataloader
+from src.trainer.data_state import DataStateCallback, resolve_resume_checkpoint, restore_data_state
 from src.constants import MULTIMODAL_KEYWORDS
 
 from qwen_vl_utils import process_vision_info
@@ -95,7 +98,8 @@ class RepeatSampler(Sampler):
         shuffle (`bool`, *optional*, defaults to `True`):
             Whether to shuffle the dataset.
         seed (`int` or `None`, *optional*, defaults to `None`):
-            Random seed for reproducibility (only affects this sampler).
+            Random seed for reproducibility (only affects this sampler). It is combined with the epoch set by
+            `set_epoch`, so a resumed run replays the permutation of the epoch it stopped in.
 
     Example:
     ```python
@@ -145,14 +149,20 @@ class RepeatSampler(Sampler):
         self.num_samples = len(data_source)
         self.shuffle = shuffle
         self.seed = seed
+        self.epoch = 0
 
         if shuffle:
             self.generator = torch.Generator()  # Create a local random generator
             if seed is not None:
                 self.generator.manual_seed(seed)
 
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
     def __iter__(self):
         if self.shuffle:
+            if self.seed is not None:
+                self.generator.manual_seed(self.seed + self.epoch)
             # E.g., [2, 4, 3, 1, 0, 6, 5] (num_samples = 7)
             indexes = torch.randperm(self.num_samples, generator=self.generator).tolist()
         else:
@@ -620,6 +630,14 @@ class QwenGRPOTrainer(Trainer):
                 else:
                     self.reward_funcs[i] = self.accelerator.prepare_model(reward_func, evaluation_mode=True)
 
+        self._resume_checkpoint = None
+        self.add_callback(DataStateCallback())
+
+    def train(self, resume_from_checkpoint=None, *args, **kwargs):
+        # Kept to restore the position in the data once the train dataloader is built.
+        self._resume_checkpoint = resolve_resume_checkpoint(resume_from_checkpoint, self.args.output_dir)
+        return super(QwenGRPOTrainer, self).train(resume_from_checkpoint, *args, **kwargs)
+
     def _set_signature_columns_if_needed(self):
         # If `self.args.remove_unused_columns` is True, non-signature columns are removed.
         # By default, this method sets `self._signature_columns` to the model's expected inputs.
@@ -643,6 +661,21 @@ class QwenGRPOTrainer(Trainer):
 
         train_dataset = self.train_dataset
         data_collator = self.data_collator
+
+        if isinstance(train_dataset, StreamingDataset):
+            # Each prompt is repeated `num_generations` times in a row inside a rank, instead of being spread
+            # across ranks by `RepeatSampler`, so the local batch has to hold whole groups.
+            local_batch_size = self._train_batch_size * self.args.gradient_accumulation_steps
+            if local_batch_size % self.num_generations != 0:
+                raise ValueError(
+                    f"When streaming, per_device_train_batch_size * gradient_accumulation_steps ({local_batch_size}) "
+                    f"must be divisible by num_generations ({self.num_generations})."
+                )
+            train_dataset.mini_repeat_count = self.num_generations
+            dataloader = build_streaming_dataloader(train_dataset, local_batch_size, data_collator, self.args)
+            restore_data_state(dataloader, self._resume_checkpoint, self.args)
+            return dataloader
+
         if is_datasets_available() and isinstance(train_dataset, datasets.Dataset):
             train_dataset = self._remove_unused_columns(train_dataset, description="training")
         else:
@@ -662,7 +695,19 @@ class QwenGRPOTrainer(Trainer):
             dataloader_params["worker_init_fn"] = seed_worker
             dataloader_params["prefetch_factor"] = self.args.dataloader_prefetch_factor
 
-        return self.accelerator.prepare(DataLoader(train_dataset, **dataloader_params))
+        dataloader = self.accelerator.prepare(DataLoader(train_dataset, **dataloader_params))
+
+        sampler = find_sampler(dataloader_params.get("sampler"), ResumableSampler)
+        if sampler is not None:
+            # Every process draws the same indices and takes every `num_processes`-th batch of them.
+            num_indices_per_batch = dataloader_params["batch_size"] * self.accelerator.num_processes
+            restore_data_state(
+                dataloader,
+                self._resume_checkpoint,
+                self.args,
+                skip_batches=lambda num_batches: sampler.skip(num_batches * num_indices_per_batch),
+            )
+        return dataloader
 
     def _get_train_sampler(self) -> Sampler:
         # Returns a sampler that
@@ -695,13 +740,22 @@ class QwenGRPOTrainer(Trainer):
             * self.accelerator.num_processes
             * self.args.gradient_accumulation_steps
         )
-        return RepeatSampler(
+        sampler = ResumableSampler(RepeatSampler(
             data_source=self.train_dataset,
             mini_repeat_count=self.num_generations,
             batch_size=effective_batch_size // self.num_generations,
             repeat_count=self.num_iterations * self.args.gradient_accumulation_steps,
             shuffle=self.shuffle_dataset,
             seed=self.args.seed,
+        ))
+        # Every process draws the same indices and `accelerator.prepare` hands out consecutive batches of
+        # `_train_batch_size * gradient_accumulation_steps`, so each process prefetches only its own share.
+        return with_lookahead(
+            sampler,
+            self.train_dataset,
+            num_replicas=self.accelerator.num_processes,
+            rank=self.accelerator.process_index,
+            batch_size=self._train_batch_size * self.args.gradient_accumulation_steps,
         )
 
     def _get_eval_sampler(self, eval_dataset) -> Sampler:
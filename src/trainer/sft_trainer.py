@@ -1,4 +1,5 @@
 import os
+import numpy as np
 import torch
 import torch.nn as nn
 
@@ -14,6 +15,17 @@ from transformers.trainer import (
     SaveStrategy
 )
 from train.train_utils import get_peft_state_maybe_zero_3, get_peft_state_non_lora_maybe_zero_3
+from src.dataset.mixture import MixtureDataset
+from src.dataset.streaming import StreamingDataset, build_streaming_dataloader
+from src.trainer.data_state import DataStateCallback, resolve_resume_checkpoint, restore_data_state
+from src.dataset.samplers import (
+    ModalityGroupedBatchSampler,
+    TokenBudgetBatchSampler,
+    build_batch_sampler_dataloader,
+    build_distributed_dataloader,
+    get_modality_groups,
+    has_prefetch,
+)
 
 def maybe_zero_3(param, ignore_status=False, name=None):
     from deepspeed import zero
@@ -33,6 +45,96 @@ class QwenSFTTrainer(Trainer):
 
     def __init__(self, *args, **kwargs):
         super(QwenSFTTrainer, self).__init__(*args, **kwargs)
+        # Number of samples truncated to `max_seq_length` on this process, reported in the logs.
+        self._num_truncated = 0
+        # Samples and tokens seen per source of a data mixture on this process, reported in the logs.
+        self._source_num_samples = None
+        self._source_num_tokens = None
+        if isinstance(self.train_dataset, MixtureDataset):
+            self._source_num_samples = torch.zeros(len(self.train_dataset.names), dtype=torch.long)
+            self._source_num_tokens = torch.zeros(len(self.train_dataset.names), dtype=torch.long)
+        self._resume_checkpoint = None
+        self.add_callback(DataStateCallback())
+
+    def train(self, resume_from_checkpoint=None, *args, **kwargs):
+        # Kept to restore the position in the data once the train dataloader is built.
+        self._resume_checkpoint = resolve_resume_checkpoint(resume_from_checkpoint, self.args.output_dir)
+        return super(QwenSFTTrainer, self).train(resume_from_checkpoint, *args, **kwargs)
+
+    def get_train_dataloader(self):
+        dataloader = self._build_train_dataloader()
+        restore_data_state(dataloader, self._resume_checkpoint, self.args)
+        return dataloader
+
+    def _build_train_dataloader(self):
+        if isinstance(self.train_dataset, StreamingDataset):
+            if self.args.max_batch_tokens is not None or self.args.group_by_modality:
+                raise ValueError("`max_batch_tokens` and `group_by_modality` need sample lengths, so they can't be used with a streaming dataset.")
+            return build_streaming_dataloader(
+                self.train_dataset, self._train_batch_size, self.data_collator, self.args
+            )
+        if self.args.max_batch_tokens is not None and self.args.group_by_modality:
+            raise ValueError("`max_batch_tokens` and `group_by_modality` can't be used together.")
+        if self.args.max_batch_tokens is not None:
+            return self._get_token_budget_dataloader()
+        if self.args.group_by_modality:
+            return self._get_modality_grouped_dataloader()
+        if has_prefetch(self.train_dataset):
+            return build_distributed_dataloader(self.train_dataset, self._train_batch_size, self.data_collator, self.args)
+        return super().get_train_dataloader()
+
+    def _get_token_budget_dataloader(self):
+        # The main process estimates the lengths and writes the cache, the others read it.
+        with self.args.main_process_first(desc="Estimating sample lengths"):
+            lengths = self.train_dataset.get_lengths()
+        if self.train_dataset.max_seq_length is not None:
+            lengths = np.minimum(lengths, self.train_dataset.max_seq_length)
+        batch_sampler = TokenBudgetBatchSampler(
+            lengths,
+            self.args.max_batch_tokens,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+            seed=self.args.data_seed if self.args.data_seed is not None else self.args.seed,
+        )
+        return build_batch_sampler_dataloader(self.train_dataset, batch_sampler, self.data_collator, self.args)
+
+    def _get_modality_grouped_dataloader(self):
+        with self.args.main_process_first(desc="Estimating sample lengths"):
+            lengths = self.train_dataset.get_lengths()
+        groups = get_modality_groups(self.train_dataset.get_modalities(), lengths)
+        batch_sampler = ModalityGroupedBatchSampler(
+            groups,
+            self._train_batch_size,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+            seed=self.args.data_seed if self.args.data_seed is not None else self.args.seed,
+        )
+        return build_batch_sampler_dataloader(self.train_dataset, batch_sampler, self.data_collator, self.args)
+
+    def compute_loss(self, model, inputs, return_outputs=False, num_items_in_batch=None):
+        num_truncated = inputs.pop("num_truncated", None)
+        if num_truncated is not None and model.training:
+            self._num_truncated += int(num_truncated)
+        source_ids = inputs.pop("source_ids", None)
+        source_num_tokens = inputs.pop("source_num_tokens", None)
+        if source_ids is not None and self._source_num_samples is not None and model.training:
+            source_ids = source_ids.cpu()
+            self._source_num_samples.index_add_(0, source_ids, torch.ones_like(source_ids))
+            self._source_num_tokens.index_add_(0, source_ids, source_num_tokens.cpu())
+        return super().compute_loss(model, inputs, return_outputs=return_outputs, num_items_in_batch=num_items_in_batch)
+
+    def log(self, logs, start_time=None):
+        # Training logs are written on every process, so the counts can be summed across processes here.
+        if "loss" in logs:
+            num_truncated = torch.tensor(self._num_truncated, device=self.args.device)
+            logs["num_truncated"] = int(self.accelerator.reduce(num_truncated, reduction="sum"))
+            if self._source_num_samples is not None:
+                num_samples = self.accelerator.reduce(self._source_num_samples.to(self.args.device), reduction="sum").tolist()
+                num_tokens = self.accelerator.reduce(self._source_num_tokens.to(self.args.device), reduction="sum").tolist()
+                for name, source_samples, source_tokens in zip(self.train_dataset.names, num_samples, num_tokens):
+                    logs[f"samples/{name}"] = source_samples
+                    logs[f"tokens/{name}"] = source_tokens
+        super().log(logs, start_time=start_time)
 
     def create_optimizer(self):
         """
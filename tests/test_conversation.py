@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+for module in ["torch", "numpy", "PIL", "transformers", "qwen_vl_utils"]:
+    pytest.importorskip(module)
+
+import torch
+import transformers
+from PIL import Image
+
+from src.constants import (
+    DEFAULT_IM_END_TOKEN,
+    DEFAULT_IM_START_TOKEN,
+    DEFAULT_IMAGE_TOKEN,
+    IGNORE_INDEX,
+    SYSTEM_MESSAGE,
+)
+from src.dataset.conversation import ConversationEncoder
+from src.dataset.data_utils import llava_to_openai
+
+# Any Qwen2-VL / Qwen2.5-VL checkpoint works, only its processor is loaded.
+MODEL_ID = os.environ.get("TEST_MODEL_ID", "Qwen/Qwen2-VL-2B-Instruct")
+
+
+@pytest.fixture(scope="module")
+def processor():
+    try:
+        return transformers.AutoProcessor.from_pretrained(MODEL_ID)
+    except (OSError, ValueError) as e:
+        pytest.skip(f"The processor of {MODEL_ID} is not available: {e}")
+
+
+def encode_with_processor(processor, conversation, images=None):
+    """The per-turn processor calls `SupervisedDataset` made before `ConversationEncoder`."""
+    tokenizer = processor.tokenizer
+    all_input_ids = []
+    all_labels = []
+    data_dict = {}
+    if len(SYSTEM_MESSAGE) > 0:
+        system_ids = tokenizer(
+            f"{DEFAULT_IM_START_TOKEN}system\n{SYSTEM_MESSAGE}{DEFAULT_IM_END_TOKEN}\n", add_special_tokens=False, return_tensors="pt"
+        )["input_ids"][0]
+        all_input_ids.append(system_ids)
+        all_labels.append(torch.full_like(system_ids, IGNORE_INDEX))
+
+    for j in range(0, len(conversation), 2):
+        user_input = (
+            f"{DEFAULT_IM_START_TOKEN}{conversation[j]['role']}\n{conversation[j]['content']}{DEFAULT_IM_END_TOKEN}\n"
+            f"{DEFAULT_IM_START_TOKEN}{conversation[j + 1]['role']}\n"
+        )
+        gpt_response = f"{conversation[j + 1]['content']}{DEFAULT_IM_END_TOKEN}\n"
+        if DEFAULT_IMAGE_TOKEN in user_input:
+            inputs = processor(text=[user_input], images=images, padding=False, do_resize=False, return_tensors="pt")
+            data_dict["pixel_values"] = inputs["pixel_values"]
+            data_dict["image_grid_thw"] = inputs["image_grid_thw"]
+            prompt_ids = inputs["input_ids"][0]
+        else:
+            prompt_ids = tokenizer(user_input, add_special_tokens=False, return_tensors="pt")["input_ids"][0]
+        response_ids = tokenizer(gpt_response, add_special_tokens=False, return_tensors="pt")["input_ids"][0]
+
+        all_input_ids.extend([prompt_ids, response_ids])
+        all_labels.extend([torch.full_like(prompt_ids, IGNORE_INDEX), response_ids])
+
+    data_dict["input_ids"] = torch.cat(all_input_ids).long()
+    data_dict["labels"] = torch.cat(all_labels).long()
+    return data_dict
+
+
+def test_text_conversation_matches_the_processor(processor):
+    conversation = llava_to_openai([
+        {"from": "human", "value": "What is the capital of France?"},
+        {"from": "gpt", "value": "Paris.\n\nIt is also its largest city."},
+        {"from": "human", "value": "  And of Italy? 意大利"},
+        {"from": "gpt", "value": "Rome"},
+    ])
+    encoder = ConversationEncoder(processor, MODEL_ID)
+    data_dict = encoder.encode(conversation)
+    expected = encode_with_processor(processor, conversation)
+
+    assert torch.equal(data_dict["input_ids"], expected["input_ids"])
+    assert torch.equal(data_dict["labels"], expected["labels"])
+    assert encoder.num_text_tokens(conversation) == len(expected["input_ids"])
+
+
+def test_image_conversation_matches_the_processor(processor):
+    conversation = llava_to_openai([
+        {"from": "human", "value": "<image>\nDescribe the image."},
+        {"from": "gpt", "value": "A red rectangle."},
+        {"from": "human", "value": "Is it square?"},
+        {"from": "gpt", "value": "No."},
+    ])
+    # The sizes are multiples of the merged patch size, as after `get_image_info`.
+    images = [Image.new("RGB", (84, 56), color=(200, 30, 60))]
+    encoder = ConversationEncoder(processor, MODEL_ID)
+    body_ids = encoder.tokenize_turns(conversation)
+    data_dict = encoder.encode(conversation, images=images, body_ids=body_ids)
+    expected = encode_with_processor(processor, conversation, images=images)
+
+    assert torch.equal(data_dict["input_ids"], expected["input_ids"])
+    assert torch.equal(data_dict["labels"], expected["labels"])
+    assert torch.equal(data_dict["image_grid_thw"], expected["image_grid_thw"])
+    assert torch.allclose(data_dict["pixel_values"], expected["pixel_values"])
+
+    num_image_tokens = int(expected["image_grid_thw"].prod()) // processor.image_processor.merge_size ** 2
+    assert encoder.num_text_tokens(conversation, body_ids) == len(expected["input_ids"]) - num_image_tokens
@@ -0,0 +1,84 @@
+import pytest
+
+# The collator is imported from `sft_dataset`, which imports the whole data pipeline.
+for module in ["torch", "numpy", "PIL", "transformers", "qwen_vl_utils", "ujson", "tqdm", "requests"]:
+    pytest.importorskip(module)
+
+import torch
+
+from src.constants import IGNORE_INDEX
+from src.dataset.sft_dataset import DataCollatorForSupervisedDataset
+
+VISION_START_ID = 151652
+VISION_END_ID = 151653
+IMAGE_PAD_ID = 151655
+VIDEO_PAD_ID = 151656
+ROPE_KWARGS = dict(
+    spatial_merge_size=2,
+    image_token_id=IMAGE_PAD_ID,
+    video_token_id=VIDEO_PAD_ID,
+    vision_start_token_id=VISION_START_ID,
+    tokens_per_second=None,
+)
+
+
+def text_example(length, first_token):
+    input_ids = torch.arange(first_token, first_token + length)
+    return {"input_ids": input_ids, "labels": input_ids.clone()}
+
+
+def image_example():
+    # A 4x4 patch grid is merged into 2x2 image tokens.
+    input_ids = torch.tensor([11, VISION_START_ID] + [IMAGE_PAD_ID] * 4 + [VISION_END_ID, 12])
+    return {
+        "input_ids": input_ids,
+        "labels": input_ids.clone(),
+        "pixel_values": torch.zeros(16, 1176),
+        "image_grid_thw": torch.tensor([[1, 4, 4]]),
+    }
+
+
+def test_pack_masks_segment_starts_and_restarts_positions():
+    examples = [text_example(5, 100), text_example(4, 200), image_example()]
+    collator = DataCollatorForSupervisedDataset(pad_token_id=0, packing=True, max_seq_length=12, rope_kwargs=ROPE_KWARGS)
+    batch = collator(examples)
+
+    # First-fit decreasing: the image sample (8 tokens) and the 4-token sample share the first row.
+    assert batch["input_ids"].shape == (2, 12)
+    assert batch["input_ids"][0, :8].tolist() == examples[2]["input_ids"].tolist()
+    assert batch["input_ids"][0, 8:].tolist() == examples[1]["input_ids"].tolist()
+    assert batch["input_ids"][1, :5].tolist() == examples[0]["input_ids"].tolist()
+    assert batch["cu_seq_lens"].tolist() == [0, 8, 12, 17, 24]
+
+    labels = batch["labels"]
+    # The first token of every sample is not predicted from the end of the previous one.
+    assert labels[0, 0] == IGNORE_INDEX and labels[0, 8] == IGNORE_INDEX and labels[1, 0] == IGNORE_INDEX
+    assert labels[0, 1:8].tolist() == examples[2]["labels"][1:].tolist()
+    assert labels[0, 9:].tolist() == examples[1]["labels"][1:].tolist()
+    assert labels[1, 1:5].tolist() == examples[0]["labels"][1:].tolist()
+    assert (labels[1, 5:] == IGNORE_INDEX).all()
+
+    position_ids = batch["position_ids"]
+    # mRoPE (temporal, height, width) positions of the image sample: the image tokens follow a 2x2 grid.
+    assert position_ids[:, 0, :8].tolist() == [
+        [0, 1, 2, 2, 2, 2, 4, 5],
+        [0, 1, 2, 2, 3, 3, 4, 5],
+        [0, 1, 2, 3, 2, 3, 4, 5],
+    ]
+    # Positions restart at every sample and in the padding segment.
+    assert (position_ids[:, 0, 8:] == torch.arange(4)).all()
+    assert (position_ids[:, 1, :5] == torch.arange(5)).all()
+    assert (position_ids[:, 1, 5:] == torch.arange(7)).all()
+
+    assert batch["image_grid_thw"].tolist() == [[1, 4, 4]]
+    assert batch["pixel_values"].shape == (16, 1176)
+
+
+def test_pack_gives_overlong_samples_their_own_row():
+    examples = [text_example(10, 100), text_example(3, 200)]
+    collator = DataCollatorForSupervisedDataset(pad_token_id=0, packing=True, max_seq_length=8, rope_kwargs=ROPE_KWARGS)
+    batch = collator(examples)
+
+    assert batch["input_ids"].shape == (2, 10)
+    assert batch["cu_seq_lens"].tolist() == [0, 10, 13, 20]
+    assert (batch["labels"][1, 3:] == IGNORE_INDEX).all()
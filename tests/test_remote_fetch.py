@@ -0,0 +1,73 @@
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+requests = pytest.importorskip("requests")
+
+from src.dataset.remote_fetch import RemoteFetcher
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / "www"
+    root.mkdir()
+    (root / "image.jpg").write_bytes(b"image bytes")
+    (root / "flaky.jpg").write_bytes(b"flaky bytes")
+    num_requests = {}
+
+    class Handler(SimpleHTTPRequestHandler):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, directory=str(root), **kwargs)
+
+        def do_GET(self):
+            num_requests[self.path] = num_requests.get(self.path, 0) + 1
+            if self.path == "/flaky.jpg" and num_requests[self.path] == 1:
+                self.send_error(503)
+                return
+            super().do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", num_requests
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetch_and_cache_hit(server, tmp_path):
+    base_url, num_requests = server
+    fetcher = RemoteFetcher(str(tmp_path / "cache"), timeout=5)
+    url = f"{base_url}/image.jpg"
+
+    assert fetcher.cached_path(url) is None
+    path = fetcher.fetch(url)
+    assert path.endswith(".jpg")
+    with open(path, "rb") as f:
+        assert f.read() == b"image bytes"
+
+    assert fetcher.fetch(url) == path
+    assert fetcher.cached_path(url) == path
+    assert num_requests["/image.jpg"] == 1
+
+
+def test_fetch_retries_transient_errors(server, tmp_path):
+    base_url, num_requests = server
+    fetcher = RemoteFetcher(str(tmp_path / "cache"), timeout=5)
+
+    with open(fetcher.fetch(f"{base_url}/flaky.jpg"), "rb") as f:
+        assert f.read() == b"flaky bytes"
+    assert num_requests["/flaky.jpg"] == 2
+
+
+def test_fetch_missing_url_raises(server, tmp_path):
+    base_url, _ = server
+    fetcher = RemoteFetcher(str(tmp_path / "cache"), timeout=5)
+    url = f"{base_url}/missing.jpg"
+
+    with pytest.raises(requests.HTTPError):
+        fetcher.fetch(url)
+    assert fetcher.cached_path(url) is None
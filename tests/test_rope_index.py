@@ -0,0 +1,87 @@
+import importlib
+from types import SimpleNamespace
+
+import pytest
+
+# The collator is imported from `sft_dataset`, which imports the whole data pipeline.
+for module in ["torch", "numpy", "PIL", "transformers", "qwen_vl_utils", "ujson", "tqdm", "requests"]:
+    pytest.importorskip(module)
+
+import torch
+import transformers
+
+from src.dataset.sft_dataset import DataCollatorForSupervisedDataset
+
+VISION_START_ID = 151652
+VISION_END_ID = 151653
+IMAGE_PAD_ID = 151655
+VIDEO_PAD_ID = 151656
+
+
+def model_get_rope_index(model_type, config):
+    """`get_rope_index` of the model, bound to a stand-in that only has the config."""
+    module = importlib.import_module(f"transformers.models.{model_type}.modeling_{model_type}")
+    prefix = "Qwen2_5_VL" if model_type == "qwen2_5_vl" else "Qwen2VL"
+    for class_name in [f"{prefix}Model", f"{prefix}ForConditionalGeneration"]:
+        model_class = getattr(module, class_name, None)
+        if model_class is not None and hasattr(model_class, "get_rope_index"):
+            return lambda **kwargs: model_class.get_rope_index(SimpleNamespace(config=config), **kwargs)
+    pytest.skip(f"{model_type} has no get_rope_index")
+
+
+def vision_block(pad_id, num_tokens):
+    return [VISION_START_ID] + [pad_id] * num_tokens + [VISION_END_ID]
+
+
+def make_examples(with_second_per_grid_ts):
+    video = {
+        # Two temporal patches of a 4x4 grid, merged into 2 x 2x2 tokens.
+        "input_ids": torch.tensor([11] + vision_block(VIDEO_PAD_ID, 8) + [12, 13, 14]),
+        "video_grid_thw": torch.tensor([[2, 4, 4]]),
+        "pixel_values_videos": torch.zeros(32, 1176),
+    }
+    if with_second_per_grid_ts:
+        video["second_per_grid_ts"] = [1.0]
+    examples = [
+        {
+            "input_ids": torch.tensor([11, 12] + vision_block(IMAGE_PAD_ID, 4) + [13] + vision_block(IMAGE_PAD_ID, 2) + [14]),
+            "image_grid_thw": torch.tensor([[1, 4, 4], [1, 2, 4]]),
+            "pixel_values": torch.zeros(24, 1176),
+        },
+        {"input_ids": torch.tensor([11, 12, 13])},
+        video,
+    ]
+    for example in examples:
+        example["labels"] = example["input_ids"].clone()
+    return examples
+
+
+@pytest.mark.parametrize("model_type", ["qwen2_vl", "qwen2_5_vl"])
+def test_position_ids_match_the_model(model_type):
+    token_ids = dict(image_token_id=IMAGE_PAD_ID, video_token_id=VIDEO_PAD_ID, vision_start_token_id=VISION_START_ID)
+    if model_type == "qwen2_5_vl":
+        config = transformers.Qwen2_5_VLConfig(**token_ids)
+        tokens_per_second = config.vision_config.tokens_per_second
+    else:
+        config = transformers.Qwen2VLConfig(**token_ids)
+        tokens_per_second = None
+    examples = make_examples(with_second_per_grid_ts=model_type == "qwen2_5_vl")
+
+    collator = DataCollatorForSupervisedDataset(
+        pad_token_id=0,
+        rope_kwargs=dict(spatial_merge_size=config.vision_config.spatial_merge_size, tokens_per_second=tokens_per_second, **token_ids),
+    )
+    batch = collator(examples)
+
+    kwargs = dict(
+        input_ids=batch["input_ids"],
+        image_grid_thw=batch["image_grid_thw"],
+        video_grid_thw=batch["video_grid_thw"],
+        attention_mask=batch["attention_mask"].long(),
+    )
+    if model_type == "qwen2_5_vl":
+        kwargs["second_per_grid_ts"] = torch.tensor(batch["second_per_grid_ts"])
+    position_ids, rope_deltas = model_get_rope_index(model_type, config)(**kwargs)
+
+    assert torch.equal(batch["position_ids"], position_ids)
+    assert torch.equal(batch["rope_deltas"], rope_deltas)
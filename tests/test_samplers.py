@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("torch")
+
+from src.dataset.samplers import ResumableSampler
+
+
+def optimizer_steps(num_batches, gradient_accumulation_steps):
+    """Batches of an epoch after which the Trainer steps the optimizer: every full window and the last batch."""
+    return [
+        step for step in range(num_batches)
+        if (step + 1) % gradient_accumulation_steps == 0 or step + 1 == num_batches
+    ]
+
+
+def test_resumed_epoch_reports_the_remaining_length():
+    sampler = ResumableSampler(list(range(10)))
+    sampler.skip(8)
+    # The Trainer computes the number of steps of the run from the full length.
+    assert len(sampler) == 10
+
+    sampler.set_epoch(1)
+    assert len(sampler) == 2
+    assert list(sampler) == [8, 9]
+    assert len(sampler) == 10
+
+    sampler.set_epoch(2)
+    assert len(sampler) == 10
+    assert list(sampler) == list(range(10))
+
+
+@pytest.mark.parametrize("num_batches", [10, 12])
+def test_resumed_epoch_steps_the_optimizer_like_a_full_epoch(num_batches):
+    gradient_accumulation_steps = 4
+    sampler = ResumableSampler(list(range(num_batches)))
+    sampler.skip(gradient_accumulation_steps)
+    sampler.set_epoch(0)
+
+    resumed_steps = [gradient_accumulation_steps + step for step in optimizer_steps(len(sampler), gradient_accumulation_steps)]
+    full_steps = optimizer_steps(num_batches, gradient_accumulation_steps)
+    assert resumed_steps == full_steps[1:]
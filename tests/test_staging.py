@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+pytest.importorskip("requests")
+
+from src.dataset import staging
+from src.dataset.staging import LocalStager, get_local_files, resolve_local_file, resolve_local_path
+
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "images").mkdir()
+    (tmp_path / "images" / "a.jpg").write_bytes(b"a")
+    # Relative to the working directory, not to the image folder.
+    (tmp_path / "local").mkdir()
+    (tmp_path / "local" / "b.jpg").write_bytes(b"b")
+    return tmp_path
+
+
+def test_resolve_local_path(files):
+    assert resolve_local_path("a.jpg", "images") == os.path.join("images", "a.jpg")
+    assert resolve_local_path("local/b.jpg", "images") == "local/b.jpg"
+    assert resolve_local_path(str(files / "local" / "b.jpg"), "images") == str(files / "local" / "b.jpg")
+    assert resolve_local_file("a.jpg", "images") == (os.path.join("images", "a.jpg"),) * 2
+
+
+def test_staged_files_are_found_without_touching_the_originals(files, monkeypatch):
+    stager = LocalStager(str(files / "staging"))
+    record = {"image": ["a.jpg", "local/b.jpg"]}
+    stager.prefetch(get_local_files(record, "images"))
+    stager._executor.shutdown(wait=True)
+
+    expected = {path: resolve_local_path(path, "images") for path in ["a.jpg", "local/b.jpg"]}
+
+    def fail(path, folder):
+        raise AssertionError(f"{path} was resolved on the shared storage")
+
+    monkeypatch.setattr(staging, "resolve_local_path", fail)
+    for path, content in [("a.jpg", b"a"), ("local/b.jpg", b"b")]:
+        original, read_path = resolve_local_file(path, "images", stager)
+        # The caches key on the original path, the bytes come from the staged copy.
+        assert original == expected[path]
+        assert read_path.startswith(stager.staging_dir)
+        with open(read_path, "rb") as f:
+            assert f.read() == content
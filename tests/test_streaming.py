@@ -0,0 +1,79 @@
+import itertools
+import json
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("ujson")
+
+from src.dataset.streaming import StreamingDataset, build_streaming_dataloader
+
+
+class RecordDataset(object):
+    """Map-style dataset stand-in whose samples are the records themselves."""
+
+    def process_sample(self, sources):
+        return sources
+
+
+class TrainingArguments(object):
+    max_steps = 10
+    gradient_accumulation_steps = 3
+    world_size = 2
+    dataloader_num_workers = 0
+    dataloader_pin_memory = False
+    dataloader_persistent_workers = False
+
+    def __init__(self, process_index):
+        self.process_index = process_index
+
+
+@pytest.fixture
+def skewed_jsonl(tmp_path):
+    # The first half of the file holds a few long records and the second half many short ones,
+    # so the byte ranges of the two ranks hold very different numbers of records.
+    path = tmp_path / "train.jsonl"
+    with open(path, "w") as f:
+        for i in range(4):
+            f.write(json.dumps({"id": i, "text": "x" * 500}) + "\n")
+        for i in range(4, 100):
+            f.write(json.dumps({"id": i}) + "\n")
+    return str(path)
+
+
+def build_dataloader(data_path, rank):
+    args = TrainingArguments(rank)
+    dataset = StreamingDataset(data_path, RecordDataset(), shuffle_buffer_size=8)
+    return build_streaming_dataloader(dataset, batch_size=2, collate_fn=list, args=args), args
+
+
+def test_ranks_run_the_same_number_of_batches(skewed_jsonl):
+    num_records = [
+        sum(1 for _ in StreamingDataset(skewed_jsonl, RecordDataset()).iter_records(rank, 2)) for rank in range(2)
+    ]
+    assert num_records[0] < num_records[1]
+
+    for rank in range(2):
+        dataloader, args = build_dataloader(skewed_jsonl, rank)
+        num_batches = args.max_steps * args.gradient_accumulation_steps
+        batches = list(itertools.islice(dataloader, num_batches))
+        assert len(batches) == num_batches
+        assert all(len(batch) == 2 for batch in batches)
+
+
+def test_resume_matches_the_cycled_stream(skewed_jsonl):
+    dataloader, _ = build_dataloader(skewed_jsonl, 0)
+    batches = list(itertools.islice(dataloader, 12))
+
+    dataloader, _ = build_dataloader(skewed_jsonl, 0)
+    dataloader.skip_batches(6)
+    assert list(itertools.islice(dataloader, 6)) == batches[6:]
+
+
+def test_empty_shard_raises(tmp_path):
+    path = tmp_path / "train.jsonl"
+    path.write_text(json.dumps({"id": 0}) + "\n")
+    dataset = StreamingDataset(str(path), RecordDataset())
+    dataset.set_rank(1, 2)
+    with pytest.raises(ValueError):
+        next(iter(dataset))
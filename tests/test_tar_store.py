@@ -0,0 +1,70 @@
+import itertools
+import os
+
+import pytest
+
+for module in ["torch", "numpy", "PIL", "transformers", "qwen_vl_utils", "ujson", "tqdm"]:
+    pytest.importorskip(module)
+
+from PIL import Image
+
+from src.dataset.data_utils import estimate_image_tokens, get_image_info
+from src.dataset.tar_store import TarShardStore, TarShardStreamingDataset, pack_tar_shards
+
+MIN_PIXELS = 4 * 28 * 28
+MAX_PIXELS = 64 * 28 * 28
+
+
+@pytest.fixture
+def store(tmp_path):
+    image_folder = tmp_path / "images"
+    image_folder.mkdir()
+    Image.new("RGB", (300, 200), color=(200, 30, 60)).save(image_folder / "red.png")
+    Image.new("RGB", (120, 160), color=(10, 120, 240)).save(image_folder / "blue.jpg")
+    records = [
+        {"id": "0", "image": "red.png", "conversations": []},
+        {"id": "1", "image": "blue.jpg", "conversations": []},
+    ]
+    pack_tar_shards(records, str(image_folder), str(tmp_path / "shards"))
+    return TarShardStore(str(tmp_path / "shards")), image_folder
+
+
+@pytest.mark.parametrize("decoder", ["pil", "pil_draft"])
+def test_get_image_info_reads_store_images(store, decoder):
+    store, image_folder = store
+    for record in store.records():
+        image = get_image_info(
+            store.open(record["shard"], record["image"]), MIN_PIXELS, MAX_PIXELS, None, None, decoder=decoder
+        )
+        expected = get_image_info(str(image_folder / record["image"]), MIN_PIXELS, MAX_PIXELS, None, None)
+        assert image.size == expected.size
+        assert image.getpixel((0, 0)) == expected.getpixel((0, 0))
+
+
+def test_estimate_image_tokens_reads_store_images(store):
+    store, image_folder = store
+    for record in store.records():
+        image_file = store.open(record["shard"], record["image"])
+        assert estimate_image_tokens(image_file, MIN_PIXELS, MAX_PIXELS, None, None) == estimate_image_tokens(
+            os.path.join(image_folder, record["image"]), MIN_PIXELS, MAX_PIXELS, None, None
+        )
+        # The header was read for the estimate, the image is still decoded from the start.
+        assert get_image_info(image_file, MIN_PIXELS, MAX_PIXELS, None, None).size[0] > 0
+
+
+class StoreDataset(object):
+    def __init__(self, image_store):
+        self.image_store = image_store
+
+    def process_sample(self, sources):
+        return sources
+
+
+def test_streaming_needs_a_shard_per_reader(store):
+    store, _ = store
+    dataset = TarShardStreamingDataset(StoreDataset(store))
+    assert len(list(itertools.islice(dataset, 5))) == 5
+
+    dataset.set_rank(0, len(store) + 1)
+    with pytest.raises(ValueError):
+        next(iter(dataset))